@@ -23,6 +23,7 @@ import bpy
 from bpy.props import (
         BoolProperty,
         FloatProperty,
+        IntProperty,
         StringProperty,
         EnumProperty
         )
@@ -56,6 +57,12 @@ class ImportData3d(bpy.types.Operator, ImportHelper):
         default=True
         )
 
+    update_materials: BoolProperty(
+        name='Update Materials',
+        description='Replace the materials of earlier imports of this file if they changed, existing users are remapped',
+        default=False
+        )
+
     import_hierarchy: BoolProperty(
         name='Import Hierarchy',
         description='Import objects with parent-child relations.',
@@ -87,12 +94,96 @@ class ImportData3d(bpy.types.Operator, ImportHelper):
         default=True
     )
 
+    import_proxies: BoolProperty(
+        name='Bounding Box Proxies',
+        description='Import a box per mesh, load the geometry of selected proxies later (Object > Load Data3d Geometry)',
+        default=False
+    )
+
+    instance_products: BoolProperty(
+        name='Instance Products',
+        description='Import each product once and place its occurrences as collection instances',
+        default=False
+    )
+
+    use_product_cache: BoolProperty(
+        name='Product Cache',
+        description='Reuse the products built by earlier imports from a local cache, products are instanced',
+        default=False
+    )
+
+    lod_mode: EnumProperty(
+        name='Level of Detail',
+        description='Simplify the meshes while importing',
+        default='FULL',
+        items=[
+            ('FULL', 'full resolution', '', 0),
+            ('RATIO', 'triangle ratio', '', 1),
+            ('BUDGET', 'triangle budget', '', 2)
+            ]
+    )
+
+    lod_ratio: FloatProperty(
+        name='Ratio',
+        description='The fraction of triangles to keep',
+        default=0.25,
+        min=0.0,
+        max=1.0,
+        subtype='FACTOR'
+    )
+
+    lod_triangle_budget: IntProperty(
+        name='Triangle Budget',
+        description='The maximum number of triangles',
+        default=1000000,
+        min=0
+    )
+
+    lod_scope: EnumProperty(
+        name='Budget Scope',
+        description='Apply the triangle budget to the whole scene or to each product',
+        default='SCENE',
+        items=[
+            ('SCENE', 'scene', '', 0),
+            ('PRODUCT', 'per product', '', 1)
+            ]
+    )
+
+    use_modal: BoolProperty(
+        name='Background Import',
+        description='Import in time slices and keep the interface responsive, press Esc to cancel',
+        default=False
+    )
+
     config_logger: BoolProperty(
         name='Configure logger',
         description='Configure and format log output',
         default=True
     )
 
+    metrics_report: BoolProperty(
+        name='Write Metrics Report',
+        description='Write per-phase and per-mesh timings as json report next to the file',
+        default=False
+    )
+
+    trace_memory: BoolProperty(
+        name='Trace Memory',
+        description='Record the peak memory of the metrics report (slow)',
+        default=False
+    )
+
+    profile_mode: EnumProperty(
+        name='Profiler',
+        description='Profile the run and write the profile and flamegraph stacks next to the file',
+        default='NONE',
+        items=[
+            ('NONE', 'none', '', 0),
+            ('CPROFILE', 'cProfile (.pstats)', '', 1),
+            ('SAMPLING', 'sampling (collapsed stacks)', '', 2)
+            ]
+    )
+
     def draw(self, context):
         layout = self.layout
         layout.prop(self, 'import_materials')
@@ -105,20 +196,131 @@ class ImportData3d(bpy.types.Operator, ImportHelper):
             #row.prop(self, "create cycles material")
             row = box.row()
             row.prop(self, "import_place_holder_images")
+            row = box.row()
+            row.prop(self, "update_materials")
 
         layout.prop(self, 'import_hierarchy')
+        layout.prop(self, 'import_proxies')
+        layout.prop(self, 'instance_products')
+        layout.prop(self, 'use_product_cache')
+
+        layout.prop(self, 'lod_mode')
+        if self.lod_mode == 'RATIO':
+            layout.prop(self, 'lod_ratio')
+        elif self.lod_mode == 'BUDGET':
+            box = layout.box()
+            box.prop(self, 'lod_triangle_budget')
+            box.prop(self, 'lod_scope')
+
+        layout.prop(self, 'use_modal')
 
         layout.prop(self, "axis_forward")
         layout.prop(self, "axis_up")
 
+        box = layout.box()
+        box.label(text='Performance')
+        box.prop(self, 'metrics_report')
+        box.prop(self, 'trace_memory')
+        box.prop(self, 'profile_mode')
+
     def execute(self, context):
         from . import import_data3d
         keywords = self.as_keywords(ignore=('axis_forward',
                                             'axis_up',
-                                            'filter_glob'))
+                                            'filter_glob',
+                                            'use_modal'))
         keywords['global_matrix'] = axis_conversion(from_forward=self.axis_forward, from_up=self.axis_up).to_4x4()
+
+        if self.use_modal and context.window:
+            wm = context.window_manager
+            self._job = import_data3d.ImportJob(**keywords)
+            self._timer = wm.event_timer_add(0.01, window=context.window)
+            wm.progress_begin(0, 100)
+            wm.modal_handler_add(self)
+            return {'RUNNING_MODAL'}
+
         return import_data3d.load(**keywords)
 
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            self._job.cancel()
+            self.finish_modal(context)
+            self.report({'WARNING'}, 'Data3d import cancelled')
+            return {'CANCELLED'}
+
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+
+        try:
+            finished = self._job.step()
+        except Exception:
+            self._job.cancel()
+            self.finish_modal(context)
+            raise
+
+        progress = int(self._job.progress * 100)
+        context.window_manager.progress_update(progress)
+        context.workspace.status_text_set('Importing Data3d: %d%% (Esc to cancel)' % progress)
+
+        if finished:
+            self.finish_modal(context)
+            return {'FINISHED'}
+        return {'PASS_THROUGH'}
+
+    def finish_modal(self, context):
+        wm = context.window_manager
+        wm.event_timer_remove(self._timer)
+        wm.progress_end()
+        context.workspace.status_text_set(None)
+
+class LoadData3dProxies(bpy.types.Operator):
+    """ Replace the selected Data3d bounding box proxies with their geometry """
+
+    bl_idname = 'object.data3d_load_proxies'
+    bl_label = 'Load Data3d Geometry'
+    bl_options = {'REGISTER', 'UNDO'}
+
+    import_materials: BoolProperty(
+        name='Import Materials',
+        description='Import Materials and Textures.',
+        default=True
+        )
+
+    # Hidden context
+    import_al_metadata: EnumProperty(
+        name='DATA3D Metadata',
+        description='Import Archilogic Metadata',
+        default='BASIC',
+        items=[
+            ('NONE', 'none', '', 0),
+            ('BASIC', 'basic material metadata', '', 1),
+            ('ADVANCED', 'advanced material metadata', '', 2)
+            ]
+    )
+
+    smooth_split_normals: BoolProperty(
+        name='Autodetect smooth vertices from custom split normals.',
+        description='Autosmooth vertex normals.',
+        default=True
+    )
+
+    import_place_holder_images: BoolProperty(
+        name='Placeholder Images',
+        description='Import a placeholder image if the source image is unavailable',
+        default=True
+    )
+
+    @classmethod
+    def poll(cls, context):
+        from . import import_data3d
+        return len(import_data3d.get_proxy_objects(context.selected_objects)) > 0
+
+    def execute(self, context):
+        from . import import_data3d
+        keywords = self.as_keywords()
+        return import_data3d.load_proxies(context.selected_objects, **keywords)
+
+
 @orientation_helper(axis_forward='-Z', axis_up='Y')
 class ExportData3d(bpy.types.Operator, ExportHelper):
     """ Export the scene as an Archilogic Data3d File """
@@ -170,12 +372,58 @@ class ExportData3d(bpy.types.Operator, ExportHelper):
         default=True
     )
 
+    metrics_report: BoolProperty(
+        name='Write Metrics Report',
+        description='Write per-phase and per-mesh timings as json report next to the file',
+        default=False
+    )
+
+    trace_memory: BoolProperty(
+        name='Trace Memory',
+        description='Record the peak memory of the metrics report (slow)',
+        default=False
+    )
+
+    profile_mode: EnumProperty(
+        name='Profiler',
+        description='Profile the run and write the profile and flamegraph stacks next to the file',
+        default='NONE',
+        items=[
+            ('NONE', 'none', '', 0),
+            ('CPROFILE', 'cProfile (.pstats)', '', 1),
+            ('SAMPLING', 'sampling (collapsed stacks)', '', 2)
+            ]
+    )
+
+    incremental: BoolProperty(
+        name='Incremental',
+        description='Keep the parsed meshes between exports, only the objects changed since the last export are parsed',
+        default=False
+    )
+
+    export_workers: IntProperty(
+        name='Compression Threads',
+        description='Compress the data3d.buffer payload in parallel on this many threads (0: main thread only)',
+        default=4,
+        min=0,
+        max=64
+    )
+
     def draw(self, context):
         layout = self.layout
         layout.prop(self, 'export_format')
         layout.prop(self, 'use_selection')
         layout.prop(self, 'export_images')
         layout.prop(self, 'export_al_metadata')
+        layout.prop(self, 'incremental')
+        if self.export_format == 'INTERLEAVED':
+            layout.prop(self, 'export_workers')
+
+        box = layout.box()
+        box.label(text='Performance')
+        box.prop(self, 'metrics_report')
+        box.prop(self, 'trace_memory')
+        box.prop(self, 'profile_mode')
 
     def execute(self, context):
         from . import export_data3d
@@ -199,25 +447,36 @@ def menu_func_import(self, context):
 def menu_func_export(self, context):
     self.layout.operator(ExportData3d.bl_idname, text='Archilogic Data3d (data3d.buffer/data3d.json)')
 
+
+def menu_func_object(self, context):
+    self.layout.operator(LoadData3dProxies.bl_idname)
+
 classes = (
     ImportData3d,
+    LoadData3dProxies,
     ExportData3d,
 )
 
 def register():
     from bpy.utils import register_class
+    from . import export_data3d
     for cls in classes:
         register_class(cls)
+    export_data3d.register_handlers()
     bpy.types.TOPBAR_MT_file_import.append(menu_func_import)
     bpy.types.TOPBAR_MT_file_export.append(menu_func_export)
+    bpy.types.VIEW3D_MT_object.append(menu_func_object)
 
 
 def unregister():
     from bpy.utils import unregister_class
+    from . import export_data3d
     for cls in reversed(classes):
         unregister_class(cls)
+    export_data3d.unregister_handlers()
     bpy.types.TOPBAR_MT_file_import.remove(menu_func_import)
     bpy.types.TOPBAR_MT_file_export.remove(menu_func_export)
+    bpy.types.VIEW3D_MT_object.remove(menu_func_object)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,188 @@
+import os
+import re
+import logging
+import tempfile
+
+import bpy
+
+from io_scene_data3d.hash_utils import HASH_PROPERTY, content_hash
+from io_scene_data3d.material_utils import NODE_LIBRARY_VERSION_KEY
+
+# Global Variables
+D = bpy.data
+
+__all__ = ['get_product_hash', 'load_product', 'save_product']
+
+CACHE_DIR_NAME = 'data3d-product-cache'
+CACHE_VERSION = 1
+CACHE_SUFFIX = '.blend'
+# The cache is pruned to this size, least recently used products first.
+DEFAULT_CACHE_SIZE = 2 * 2**30
+
+log = logging.getLogger('archilogic')
+
+# The suffix blender appends to clashing data block names.
+NAME_SUFFIX = re.compile(r'\.\d{3}$')
+
+
+def get_cache_dir(cache_dir=None):
+    """ Get the product cache directory and create it if necessary.
+        Kwargs:
+            cache_dir ('str') - The cache directory, defaults to the temporary directory.
+        Returns:
+            cache_dir ('str') - The product cache directory.
+    """
+    cache_dir = cache_dir or os.path.join(tempfile.gettempdir(), CACHE_DIR_NAME)
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def get_product_hash(d3d_obj, settings):
+    """ Hash the product: its mesh and material definitions, the payload of its meshes and the import settings
+        that change the built product.
+        Args:
+            d3d_obj ('Data3dObject') - The data3d object of the product.
+            settings ('dict') - The import settings that affect the product.
+        Returns:
+            _ ('str') - The hex digest.
+    """
+    # The payload offsets and lengths are left out, the payload itself is hashed. The same product hashes equal
+    # at any position in any file.
+    structure = {'version': CACHE_VERSION,
+                 'meshes': d3d_obj.get_mesh_structure(payload_lengths=False),
+                 'materials': d3d_obj.materials,
+                 'settings': settings}
+    chunks = [chunk for mesh_key in sorted(d3d_obj.mesh_references) for chunk in d3d_obj.get_mesh_payload(mesh_key)]
+    return content_hash(structure, *chunks)
+
+
+def get_cache_path(product_id, product_hash, cache_dir=None):
+    """ Get the cache file of the product.
+        Args:
+            product_id ('str') - The productResourceId.
+            product_hash ('str') - The product hash, see get_product_hash.
+        Kwargs:
+            cache_dir ('str') - The cache directory.
+        Returns:
+            _ ('str') - The path to the cached .blend file.
+    """
+    name = re.sub(r'[^\w\-]', '_', product_id)[:64]
+    return os.path.join(get_cache_dir(cache_dir), name + '-' + product_hash + CACHE_SUFFIX)
+
+
+def load_product(product_id, product_hash, cache_dir=None):
+    """ Append the product collection from the cache.
+        Args:
+            product_id ('str') - The productResourceId.
+            product_hash ('str') - The product hash, see get_product_hash.
+        Kwargs:
+            cache_dir ('str') - The cache directory.
+        Returns:
+            collection ('bpy.types.Collection') - The appended product collection, None if the product is not cached.
+    """
+    path = get_cache_path(product_id, product_hash, cache_dir)
+    if not os.path.isfile(path):
+        return None
+
+    existing = {'materials': set(D.materials), 'node_groups': set(D.node_groups), 'images': set(D.images)}
+    try:
+        with D.libraries.load(path, link=False) as (data_from, data_to):
+            data_to.collections = data_from.collections[:1]
+    except (OSError, RuntimeError):
+        log.warning('Product cache file could not be read: %s', path)
+        return None
+    if not data_to.collections or data_to.collections[0] is None:
+        return None
+    # Append copies the dependencies as well, replace the copies by the data blocks that exist already
+    merge_appended(existing)
+
+    # Touch the file, eviction removes the least recently used products
+    os.utime(path, None)
+    return data_to.collections[0]
+
+
+def _get_merge_keys():
+    """ The keys that identify equal data blocks: the material content hash, the node library version of the
+        node groups and the file path of the images.
+    """
+    def material_key(material):
+        return material.get(HASH_PROPERTY)
+
+    def node_group_key(node_group):
+        version = node_group.get(NODE_LIBRARY_VERSION_KEY)
+        return (NAME_SUFFIX.sub('', node_group.name), version) if version else None
+
+    def image_key(image):
+        return os.path.normpath(bpy.path.abspath(image.filepath)) if image.filepath else None
+
+    # Materials first, their removal releases the node groups and images of the copies
+    return (('materials', material_key), ('node_groups', node_group_key), ('images', image_key))
+
+
+def merge_appended(existing):
+    """ Remap the users of the appended materials, node groups and images to the equal data blocks that existed
+        before the append and remove the appended copies.
+        Args:
+            existing ('dict') - The data collection names -> the sets of data blocks before the append.
+    """
+    for collection_name, get_key in _get_merge_keys():
+        data_blocks = getattr(D, collection_name)
+        index = {}
+        for data_block in existing[collection_name]:
+            key = get_key(data_block)
+            if key is not None:
+                index.setdefault(key, data_block)
+
+        for data_block in [data_block for data_block in data_blocks if data_block not in existing[collection_name]]:
+            key = get_key(data_block)
+            if key is not None and key in index:
+                data_block.user_remap(index[key])
+                data_blocks.remove(data_block)
+
+
+def save_product(collection, product_id, product_hash, cache_dir=None, max_size=DEFAULT_CACHE_SIZE):
+    """ Write the product collection with its objects, meshes and materials to the cache.
+        Args:
+            collection ('bpy.types.Collection') - The built product collection.
+            product_id ('str') - The productResourceId.
+            product_hash ('str') - The product hash, see get_product_hash.
+        Kwargs:
+            cache_dir ('str') - The cache directory.
+            max_size ('int') - The cache size in bytes.
+    """
+    path = get_cache_path(product_id, product_hash, cache_dir)
+    # Write next to the target and rename, other sessions never read a partial file
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        D.libraries.write(temp_path, {collection}, compress=True)
+        os.replace(temp_path, path)
+    except (OSError, RuntimeError):
+        log.warning('Product cache file could not be written: %s', path)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return
+    evict(os.path.dirname(path), max_size)
+
+
+def evict(cache_dir, max_size):
+    """ Remove the least recently used products until the cache fits the size.
+        Args:
+            cache_dir ('str') - The cache directory.
+            max_size ('int') - The cache size in bytes.
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.endswith(CACHE_SUFFIX):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    size = sum(entry[1] for entry in entries)
+    for _, file_size, path in sorted(entries):
+        if size <= max_size:
+            break
+        try:
+            os.remove(path)
+            size -= file_size
+            log.debug('Evicted cached product: %s', path)
+        except OSError:
+            pass
@@ -11,12 +11,23 @@ import random
 import copy
 
 import array
+import mmap
+import shutil
+import tempfile
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 
-__all__ = ['deserialize_data3d', 'serialize_data3d']
+from io_scene_data3d.hash_utils import content_hash
+
+__all__ = ['deserialize_data3d', 'serialize_data3d', 'Data3dBufferWriter', 'Data3dJsonWriter', 'PayloadBlock']
 
 HEADER_BYTE_LENGTH = 16
 MAGIC_NUMBER = '\x44\x33\x44\x41' #Fixme reverse byteorder: '\x41\x44\x33\x44' #AD3D encoded as ASCII characters in hex
 VERSION = 1
+# The staged payload is copied to the output file in chunks of this size.
+PAYLOAD_CHUNK_SIZE = 2**20
+# The compression level of the gzip members, the same as gzip.open.
+COMPRESS_LEVEL = 9
 SUFFIX_JSON = 'data3d.json'
 SUFFIX_BUFFER = 'data3d.buffer'
 SUFFIX_GZIP = 'gz'
@@ -118,13 +129,20 @@ class D3D:
     ...
 
 
+# The payload references of the buffer meshes, they depend on the position of the mesh in the payload
+PAYLOAD_OFFSET_KEYS = (D3D.b_coords_offset, D3D.b_normals_offset, D3D.b_uvs_offset, D3D.b_uvs2_offset)
+PAYLOAD_LENGTH_KEYS = (D3D.b_coords_length, D3D.b_normals_length, D3D.b_uvs_length, D3D.b_uvs2_length)
+
+
 class Data3dObject(object):
     """
         Attributes:
             node_id ('str') - The nodeId of the object or a generated Id.
+            has_node_id ('bool') - The node_id is the nodeId of the file, not generated.
+            child_index ('int') - The index of the object in the children of its parent.
             parent ('Data3dObject') -
             children ('list(Data3dObject)') - The children of the D3D Object.
-            file_buffer ('bytearray') - The file buffer in memory, if import source is binary.
+            file_buffer ('bytearray') - The file buffer in memory (or mapped), if import source is binary.
             payload_byte_offset('int') - The payload byte offset for accessing geometry data.
             materials ('list(dict)') - The object materials as raw json data.
             position ('list(int)') - The relative position of the object.
@@ -132,14 +150,18 @@ class Data3dObject(object):
             bl_objects ('list(bpy.types.Object)') - The blender object for this data3d object
             mat_hash_map ('dict') - The HashMap of the object material keys -> blender materials.
             mesh_references('dict') - The mesh keys of the D3D object.
+            bytes_decoded ('int') - The number of payload bytes decoded for this object.
     """
 
     def __init__(self, node, parent=None, file_buffer=None, payload_byte_offset=0):
         self.node_id = node[D3D.node_id] if D3D.node_id in node else _id_generator(12)
+        self.has_node_id = D3D.node_id in node
+        self.child_index = 0
         self.parent = None
         self.children = []
         self.file_buffer = file_buffer
         self.payload_byte_offset = payload_byte_offset
+        self.bytes_decoded = 0
 
         self.materials = node[D3D.o_materials] if D3D.o_materials in node else []
         self.position = node[D3D.o_position] if D3D.o_position in node else [0, 0, 0]
@@ -165,35 +187,29 @@ class Data3dObject(object):
                 mesh_data ('dict') - The data of the mesh
         """
 
+        # Vertex location, normal and uv coordinates are kept as flat float arrays, referenced by indices
+        # (3 floats per location & normal, 2 floats per uv).
         def from_buffer(m):
             data = {}
             data['verts_loc_raw'] = self._get_data_from_buffer(m[D3D.b_coords_offset], m[D3D.b_coords_length])
-            
-            unpacked_normals = self._get_data_from_buffer(m[D3D.b_normals_offset], m[D3D.b_normals_length])
-            data['verts_nor'] = [tuple(unpacked_normals[x:x+3]) for x in range(0, len(unpacked_normals), 3)]
-            del unpacked_normals
+            data['verts_nor'] = self._get_data_from_buffer(m[D3D.b_normals_offset], m[D3D.b_normals_length])
 
             if has_uvs:
-                unpacked_uvs = self._get_data_from_buffer(mesh[D3D.b_uvs_offset], mesh[D3D.b_uvs_length])
-                data['verts_uvs'] = [tuple(unpacked_uvs[x:x+2]) for x in range(0, len(unpacked_uvs), 2)]
-                del unpacked_uvs
+                data['verts_uvs'] = self._get_data_from_buffer(m[D3D.b_uvs_offset], m[D3D.b_uvs_length])
 
             if has_uvs2:
-                unpacked_uvs2 = self._get_data_from_buffer(m[D3D.b_uvs2_offset], m[D3D.b_uvs2_length])
-                data['verts_uvs2'] = [tuple(unpacked_uvs2[x:x+2]) for x in range(0, len(unpacked_uvs2), 2)]
-                del unpacked_uvs2
+                data['verts_uvs2'] = self._get_data_from_buffer(m[D3D.b_uvs2_offset], m[D3D.b_uvs2_length])
             return data
 
         def from_json(m):
             data = {}
-            # Vertex location, normal and uv coordinates, referenced by indices
             data['verts_loc_raw'] = m[D3D.v_coords]
-            data['verts_nor'] = [tuple(m[D3D.v_normals][x:x+3]) for x in range(0, len(m[D3D.v_normals]), 3)]
+            data['verts_nor'] = m[D3D.v_normals]
 
             if has_uvs:
-                data['verts_uvs'] = [tuple(m[D3D.uv_coords][x:x+2]) for x in range(0, len(m[D3D.uv_coords]), 2)]
+                data['verts_uvs'] = m[D3D.uv_coords]
             if has_uvs2:
-                data['verts_uvs2'] = [tuple(m[D3D.uv2_coords][x:x+2]) for x in range(0, len(m[D3D.uv2_coords]), 2)]
+                data['verts_uvs2'] = m[D3D.uv2_coords]
 
             return data
 
@@ -222,13 +238,9 @@ class Data3dObject(object):
         if D3D.m_material in mesh:
             mesh_data['material'] = mesh[D3D.m_material]
 
+        # All faces are trigons in loop order (triangle soup), the flat arrays are used as they are
         mesh_data.update(raw_mesh_data)
 
-        v_indices = range(int(len(mesh_data['verts_loc_raw'])/3))
-        face_vertex_indices = [tuple(v_indices[x:x+3]) for x in range(0, len(v_indices), 3)]
-
-        mesh_data['face_indices'] = face_vertex_indices
-
         return mesh_data
 
     def _get_data_from_buffer(self, offset, length):
@@ -242,6 +254,7 @@ class Data3dObject(object):
         start = self.payload_byte_offset + (offset * 4)
         end = start + (length * 4)
         binary_data = self.file_buffer[start:end]
+        self.bytes_decoded += len(binary_data)
         float_array = array.array('f')
         float_array.frombytes(binary_data)
         return float_array
@@ -250,7 +263,8 @@ class Data3dObject(object):
     def _handle_double_sided_faces(orig_mesh):
         """ Split double sided faces from mesh into a new mesh object
         """
-        orig_faces = orig_mesh['face_indices']
+        v_indices = range(len(orig_mesh['verts_loc_raw']) // 3)
+        orig_faces = [tuple(v_indices[x:x+3]) for x in range(0, len(v_indices), 3)]
         hashed_faces = {}
         ss_faces = []
         ds_faces = []
@@ -288,8 +302,21 @@ class Data3dObject(object):
             Args:
                 child ('Data3dObject')- The child object.
         """
+        child.child_index = len(self.children)
         self.children.append(child)
 
+    def get_node_path(self):
+        """ Get the path of the node that is stable across deserializations of the same file: the nodeId or,
+            for nodes without nodeId (their node_id is generated), the child indices below the parent path.
+            Returns:
+                _ ('str') - The node path.
+        """
+        if self.has_node_id:
+            return self.node_id
+        if self.parent is None:
+            return ''
+        return '%s/%d' % (self.parent.get_node_path(), self.child_index)
+
     def get_mesh_data(self, mesh_key, handle_double_sided=False):
         """ Get the mesh_data for the specified mesh key.
             Args:
@@ -321,6 +348,68 @@ class Data3dObject(object):
         else:
             return False
 
+    def get_mesh_bounds(self, mesh_key):
+        """ Get the bounding box of the mesh, only the position range of the payload is decoded.
+            Args:
+                mesh_key ('str') - The mesh key.
+            Returns:
+                bounds ('tuple(list(float))') - The minimum and maximum corner in mesh space, None if the mesh is empty.
+        """
+        mesh = self.mesh_references[mesh_key]
+        if D3D.b_coords_offset in mesh:
+            positions = self._get_data_from_buffer(mesh[D3D.b_coords_offset], mesh[D3D.b_coords_length])
+        else:
+            positions = mesh.get(D3D.v_coords, [])
+        if len(positions) < 3:
+            return None
+        axes = [positions[i::3] for i in range(3)]
+        return [min(axis) for axis in axes], [max(axis) for axis in axes]
+
+    def get_mesh_payload(self, mesh_key):
+        """ Get the raw payload bytes of the mesh (positions, normals, uvs and lightmap uvs), without decoding.
+            Args:
+                mesh_key ('str') - The mesh key.
+            Returns:
+                chunks ('list(bytes)') - The payload ranges of the mesh, empty if the mesh is stored as json.
+        """
+        mesh = self.mesh_references[mesh_key]
+        chunks = []
+        for offset_key, length_key in ((D3D.b_coords_offset, D3D.b_coords_length),
+                                       (D3D.b_normals_offset, D3D.b_normals_length),
+                                       (D3D.b_uvs_offset, D3D.b_uvs_length),
+                                       (D3D.b_uvs2_offset, D3D.b_uvs2_length)):
+            if offset_key in mesh:
+                start = self.payload_byte_offset + (mesh[offset_key] * 4)
+                chunks.append(bytes(self.file_buffer[start:start + (mesh[length_key] * 4)]))
+        return chunks
+
+    def get_mesh_structure(self, payload_lengths=True):
+        """ Get the mesh definitions without the payload offsets, equal meshes have an equal structure at any
+            payload position and in any file.
+            Kwargs:
+                payload_lengths ('bool') - Keep the payload lengths.
+            Returns:
+                meshes ('dict') - The mesh keys -> the mesh definitions.
+        """
+        skip_keys = set(PAYLOAD_OFFSET_KEYS)
+        if not payload_lengths:
+            skip_keys.update(PAYLOAD_LENGTH_KEYS)
+        return {mesh_key: {key: value for key, value in mesh.items() if key not in skip_keys}
+                for mesh_key, mesh in self.mesh_references.items()}
+
+    def get_triangle_count(self):
+        """ Get the triangle count of all meshes from the structure, without decoding the payload.
+            Returns:
+                triangle_count ('int') - The number of triangles.
+        """
+        triangle_count = 0
+        for mesh in self.mesh_references.values():
+            if D3D.b_coords_length in mesh:
+                triangle_count += mesh[D3D.b_coords_length] // 9
+            elif D3D.v_coords in mesh:
+                triangle_count += len(mesh[D3D.v_coords]) // 9
+        return triangle_count
+
 
 # Temp debugging
 def _dump_json_to_file(j, output_path):
@@ -478,10 +567,13 @@ def _from_data3d_json(input_path):
     return data3d_objects
 
 
-def _from_data3d_buffer(input_path):
+def _from_data3d_buffer(input_path, lazy_payload=False):
     """ Import data3d from data3d.buffer file.
         Args:
             input_path ('str') - The path to the input file.
+        Kwargs:
+            lazy_payload ('bool') - Map the file instead of reading it, only the accessed payload ranges are read.
+                                    Compressed files are always read completely.
         Returns:
             data3d_objects ('list(Data3dObject)') - The deserialized data3d ad Data3dObjects.
     """
@@ -499,6 +591,11 @@ def _from_data3d_buffer(input_path):
             f.close()
             return buf
 
+        elif lazy_payload:
+            # The mapping stays valid after the file is closed, pages are read on access
+            with open(file_path, 'rb') as f:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
         else:
             buf = bytearray(os.path.getsize(file_path))
             with open(file_path, 'rb') as f:
@@ -552,18 +649,55 @@ def _from_data3d_buffer(input_path):
     return data3d_objects
 
 
-def _to_data3d_json(data3d, output_path):
-    """ Export data3d to data3d.json file.
+def _get_json_output_path(output_path):
+    """ Ensure the data3d.json suffix of the output path.
         Args:
-            data3d ('dict') - The parsed data3d geometry as a dictionary.
             output_path ('str') - The path to the output file.
+        Returns:
+            path ('str') - The data3d.json output path.
     """
-    # Ensure suffix
     path = output_path
     if not path.endswith(SUFFIX_JSON):
         root = os.path.dirname(path)
         filename = os.path.basename(path).split('.', 1)[0] + '.' + SUFFIX_JSON
         path = '/'.join([root, filename])
+    return path
+
+
+def _get_buffer_output_path(output_path, compress_file):
+    """ Ensure the data3d.buffer (gz.data3d.buffer if compressed) suffix of the output path.
+        Args:
+            output_path ('str') - The path to the output file.
+            compress_file ('bool') - Gzip the output file.
+        Returns:
+            _ ('str') - The data3d.buffer output path.
+    """
+    source_name = os.path.basename(output_path)
+
+    if source_name.endswith('.'.join([SUFFIX_GZIP, SUFFIX_BUFFER])):
+        filename = '.'.join(source_name.split('.')[:-3])
+    else:
+        filename = '.'.join(source_name.split('.')[:-2])
+
+    path = os.path.dirname(output_path)
+
+    log.debug('filename %s, pathname %s', filename, path)
+
+    if compress_file:
+        filename = '.'.join([filename, SUFFIX_GZIP, SUFFIX_BUFFER])
+    else:
+        filename = '.'.join([filename, SUFFIX_BUFFER])
+    return '/'.join([path, filename])
+
+
+def _to_data3d_json(data3d, output_path):
+    """ Export data3d to data3d.json file.
+        Args:
+            data3d ('dict') - The parsed data3d geometry as a dictionary.
+            output_path ('str') - The path to the output file.
+    """
+    # Ensure suffix
+    path = _get_json_output_path(output_path)
 
     log.debug('Output path: %s', path)
     with open(path, 'w', encoding='utf-8') as file:
@@ -577,116 +711,367 @@ def _to_data3d_buffer(data3d, output_path, compress_file):
             output_path ('str') - The path to the output file.
             compress_file ('bool') - Gzip the output file.
     """
-    def create_header(s_length, p_length):
-        """ Create the data3d.buffer header from magic number, version and data.
+    root = copy.deepcopy(data3d[D3D.r_container])
+    meshes = root.pop(D3D.o_meshes, None)
+    with Data3dBufferWriter(output_path, root, compress_file=compress_file) as writer:
+        # Flattened Data3d dictionary with no hierarchy
+        if meshes is not None:
+            for mesh_key in meshes:
+                writer.add_mesh(mesh_key, meshes[mesh_key])
+
+
+class PayloadBlock(object):
+    """ The self contained payload of a group of meshes (e.g. the meshes of one object), see
+        Data3dBufferWriter.encode_block. A compressed block is one gzip member, it can be added to later files as is.
+        Attributes:
+            meshes ('OrderedDict') - The mesh keys -> data3d meshes, the payload offsets are relative to the block.
+            length ('int') - The number of floats in the block.
+            compressed ('bool') - The block data is a gzip member.
+    """
+
+    def __init__(self, meshes, length, data, compressed):
+        self.meshes = meshes
+        self.length = length
+        self.compressed = compressed
+        self._data = data
+
+    @property
+    def data(self):
+        """ The block bytes, waits for the compression if it runs on a thread pool. """
+        if isinstance(self._data, Future):
+            self._data = self._data.result()
+        return self._data
+
+
+class Data3dBufferWriter(object):
+    """ Stream a data3d.buffer file. The payload of each mesh is staged in a temporary file as soon as the mesh
+        is encoded, only the structure (root meshes or the child nodes) is kept in memory until the file is written
+        on close.
+        The compressed file is a sequence of gzip members (header & structure first, then the payload chunks),
+        which is a valid gzip stream. With compress_workers the payload chunks are compressed on a thread pool
+        while the meshes are added, and written in order.
+        Identical attribute arrays (linked duplicates, instanced products) are written once, the meshes share the
+        payload range. Payload blocks (encode_block) keep their own gzip member and can be reused by later files.
+        Attributes:
+            output_path ('str') - The path to the output file.
+            root ('dict') - The root object of the structure, the meshes and children are added to it.
+            compress_file ('bool') - Gzip the output file.
+            compress_workers ('int') - The number of compression threads, 0 compresses on the calling thread.
+            deduplicate ('bool') - Share the payload range of identical attribute arrays.
+    """
+
+    # The payload attributes, positions and normals are always written, uvs only if present
+    PAYLOAD_KEYS = ((D3D.v_coords, D3D.b_coords_offset, D3D.b_coords_length, True),
+                    (D3D.v_normals, D3D.b_normals_offset, D3D.b_normals_length, True),
+                    (D3D.uv_coords, D3D.b_uvs_offset, D3D.b_uvs_length, False),
+                    (D3D.uv2_coords, D3D.b_uvs2_offset, D3D.b_uvs2_length, False))
+
+    def __init__(self, output_path, root, compress_file=True, compress_workers=0, deduplicate=True):
+        self.output_path = output_path
+        self.root = root
+        self.compress_file = compress_file
+        self.compress_workers = compress_workers if compress_file else 0
+        self.deduplicate = deduplicate
+
+        self._meshes = self.root.setdefault(D3D.o_meshes, {})
+        self._payload_file = tempfile.TemporaryFile()
+        self._payload_length = 0
+        # The content hash of the written arrays -> their payload offset
+        self._payload_offsets = {}
+        self._shared_length = 0
+        # The uncompressed payload is collected into chunks, each chunk becomes one gzip member
+        self._chunk = bytearray()
+        self._pending = deque()
+        self._executor = ThreadPoolExecutor(self.compress_workers) if self.compress_workers else None
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._closed = True
+            self._shutdown()
+            self._payload_file.close()
+
+    def add_mesh(self, mesh_key, mesh):
+        """ Add the mesh to the root, its float arrays are moved to the payload and replaced by offset & length.
+            Args:
+                mesh_key ('str') - The mesh key.
+                mesh ('dict') - The data3d mesh with the float arrays (lists or float32 arrays).
+        """
+        self._meshes[mesh_key] = self.encode_mesh(mesh)
+
+    def add_child(self, child):
+        """ Add a child node to the root, its meshes are encoded with encode_mesh already.
             Args:
-                s_length ('int') - The byte length of the structure.
-                p_length ('int') - The byte length of the payload.
+                child ('dict') - The data3d object with its children.
+        """
+        self.root.setdefault(D3D.o_children, []).append(child)
+
+    def encode_mesh(self, mesh):
+        """ Move the float arrays of the mesh to the payload. The encoded mesh can be used by several nodes.
+            Args:
+                mesh ('dict') - The data3d mesh with the float arrays (lists or float32 arrays).
+            Returns:
+                mesh ('dict') - The data3d mesh with payload offset & length instead of the float arrays.
+        """
+        mesh = dict(mesh)
+        for coords_key, offset_key, length_key, required in self.PAYLOAD_KEYS:
+            values = mesh.pop(coords_key, None)
+            if values is None or not (required or len(values)):
+                continue
+            mesh[length_key] = len(values)
+            mesh[offset_key] = self._write_payload(values)
+        return mesh
+
+    def encode_block(self, meshes):
+        """ Encode the meshes into a self contained payload block, it is not written yet (see add_block). The block
+            of a compressed file is one gzip member, compressed on the thread pool if there is one.
+            Args:
+                meshes ('dict') - The mesh keys -> data3d meshes with the float arrays (lists or float32 arrays).
+            Returns:
+                block ('PayloadBlock') - The encoded block.
+        """
+        data = bytearray()
+        encoded = OrderedDict()
+        for mesh_key, mesh in meshes.items():
+            mesh = dict(mesh)
+            for coords_key, offset_key, length_key, required in self.PAYLOAD_KEYS:
+                values = mesh.pop(coords_key, None)
+                if values is None or not (required or len(values)):
+                    continue
+                mesh[length_key] = len(values)
+                mesh[offset_key] = len(data) // 4
+                data += self._pack(values)
+            encoded[mesh_key] = mesh
+
+        length = len(data) // 4
+        data = bytes(data)
+        if self.compress_file and self._executor is not None:
+            data = self._executor.submit(gzip.compress, data, COMPRESS_LEVEL)
+        elif self.compress_file:
+            data = gzip.compress(data, COMPRESS_LEVEL)
+        return PayloadBlock(encoded, length, data, self.compress_file)
+
+    def add_block(self, block):
+        """ Append the payload block, a compressed block is copied as it is.
+            Args:
+                block ('PayloadBlock') - The block, encoded by this or an earlier writer.
             Returns:
-                _ ('bytearray') - The created header.
+                meshes ('OrderedDict') - The mesh keys -> data3d meshes with the payload offsets of this file.
         """
-        return bytearray(MAGIC_NUMBER, 'ascii') + binary_pack('i', [VERSION, s_length, p_length])
+        if block.compressed != self.compress_file:
+            raise ValueError('Can not add payload block, the compression differs from the file compression.')
+
+        offset = self._payload_length
+        self._payload_length += block.length
+        if self.compress_file:
+            # The collected chunk ends its member before the block member
+            self._flush_chunk()
+            self._add_member(block._data if isinstance(block._data, Future) else block.data)
+        else:
+            self._payload_file.write(block.data)
+
+        meshes = OrderedDict()
+        for mesh_key, mesh in block.meshes.items():
+            mesh = dict(mesh)
+            for _, offset_key, _, _ in self.PAYLOAD_KEYS:
+                if offset_key in mesh:
+                    mesh[offset_key] += offset
+            meshes[mesh_key] = mesh
+        return meshes
+
+    @staticmethod
+    def _pack(values):
+        # float32 arrays are packed as they are, lists are packed by array
+        return values.tobytes() if hasattr(values, 'tobytes') else array.array('f', values).tobytes()
 
-    def extract_buffer_data(d):
-        """ Extracts payload data from data3d dict, adds offset & length data to dict.
+    def _write_payload(self, values):
+        """ Append the values to the payload, unless the identical array was written before.
             Args:
-                d ('dict') - The parsed data3d geometry as a dictionary.
+                values ('list', 'ndarray', 'array') - The float values.
             Returns:
-                s ('dict') - The modified structure dictionary.
-                p ('list(float)') - The payload list of floats.
+                offset ('int') - The payload offset of the values (in floats).
         """
-        s = copy.deepcopy(d)
-        p = []
+        data = self._pack(values)
+        if self.deduplicate:
+            key = content_hash(data)
+            if key in self._payload_offsets:
+                self._shared_length += len(data) // 4
+                return self._payload_offsets[key]
+            self._payload_offsets[key] = self._payload_length
+
+        offset = self._payload_length
+        self._payload_length += len(data) // 4
+        self._write_data(data)
+        return offset
+
+    def _write_data(self, data):
+        if not self.compress_file:
+            self._payload_file.write(data)
+            return
+        self._chunk += data
+        if len(self._chunk) >= PAYLOAD_CHUNK_SIZE:
+            self._flush_chunk()
+
+    def _flush_chunk(self):
+        """ Compress the collected payload chunk into a gzip member, on the thread pool if there is one. """
+        if not self._chunk:
+            return
+        data, self._chunk = bytes(self._chunk), bytearray()
+        if self._executor is None:
+            self._add_member(gzip.compress(data, COMPRESS_LEVEL))
+        else:
+            self._add_member(self._executor.submit(gzip.compress, data, COMPRESS_LEVEL))
 
-        root = s[D3D.r_container]
-        # Flattened Data3d dictionary with no hierarchy
-        if D3D.o_meshes in root:
-            meshes = root[D3D.o_meshes]
-            for mesh_key in meshes:
-                mesh = meshes[mesh_key]
-                v_loc = mesh.pop(D3D.v_coords, None)
-                v_norm = mesh.pop(D3D.v_normals, None)
-                v_uvs = mesh.pop(D3D.uv_coords, None)
-                v_uvs2 = mesh.pop(D3D.uv2_coords, None)
-
-                mesh[D3D.b_coords_length] = len(v_loc)
-                mesh[D3D.b_coords_offset] = len(p)
-                p.extend(v_loc)
-
-                mesh[D3D.b_normals_length] = len(v_norm)
-                mesh[D3D.b_normals_offset] = len(p)
-                p.extend(v_norm)
-
-                if v_uvs:
-                    mesh[D3D.b_uvs_length] = len(v_uvs)
-                    mesh[D3D.b_uvs_offset] = len(p)
-                    p.extend(v_uvs)
-
-                if v_uvs2:
-                    mesh[D3D.b_uvs2_length] = len(v_uvs2)
-                    mesh[D3D.b_uvs2_offset] = len(p)
-                    p.extend(v_uvs2)
-        return s, p
-
-    structure, payload = extract_buffer_data(data3d)
-    structure_json = json.dumps(structure, indent=None, skipkeys=False)
-    structure['version'] = VERSION
-
-    if not len(structure_json) % 2:
-        structure_json += ' '
+    def _add_member(self, member):
+        """ Queue the gzip member (bytes or the future of the compression) and write the finished members in order,
+            wait if too many chunks are in flight (bounded memory).
+        """
+        self._pending.append(member)
+        while self._pending and (not isinstance(self._pending[0], Future) or self._pending[0].done()
+                                 or len(self._pending) > 2 * self.compress_workers):
+            member = self._pending.popleft()
+            self._payload_file.write(member.result() if isinstance(member, Future) else member)
+
+    def _shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def close(self):
+        """ Write the header, the structure and the staged payload to the output file.
+            Returns:
+                path ('str') - The path to the written file, None if the writer was closed already.
+        """
+        if self._closed:
+            return None
+        self._closed = True
 
-    # Temp
-    #_dump_json_to_file(structure, dump_file)
+        try:
+            if self.compress_file:
+                self._flush_chunk()
+                while self._pending:
+                    member = self._pending.popleft()
+                    self._payload_file.write(member.result() if isinstance(member, Future) else member)
+        finally:
+            self._shutdown()
 
-    structure_byte_array = bytearray(structure_json, 'utf-16')
-    structure_byte_length = len(structure_byte_array)
-    payload_byte_array = binary_pack('f', payload)
-    payload_byte_length = len(payload_byte_array)
+        if self._shared_length:
+            log.debug('Shared payload: %d of %d bytes', self._shared_length * 4,
+                      (self._payload_length + self._shared_length) * 4)
 
-    header = create_header(structure_byte_length, payload_byte_length)
+        structure = {D3D.r_container: self.root}
+        structure_json = json.dumps(structure, indent=None, skipkeys=False)
 
-    # Validation Warnings
-    # Validation Errors
-    if len(header) != HEADER_BYTE_LENGTH:
-        raise Exception('Can not serialize data3d buffer. Wrong header size: ' + str(len(header)) + ' Expected: ' + str(HEADER_BYTE_LENGTH))
+        if not len(structure_json) % 2:
+            structure_json += ' '
 
-    source_name = os.path.basename(output_path)
+        structure_byte_array = bytearray(structure_json, 'utf-16')
+        payload_byte_length = self._payload_length * 4
+        header = bytearray(MAGIC_NUMBER, 'ascii') + binary_pack('i', [VERSION, len(structure_byte_array), payload_byte_length])
 
-    if source_name.endswith('.'.join([SUFFIX_GZIP, SUFFIX_BUFFER])):
-        filename = '.'.join(source_name.split('.')[:-3])
-    else:
-        filename = '.'.join(source_name.split('.')[:-2])
+        # Validation Errors
+        if len(header) != HEADER_BYTE_LENGTH:
+            raise Exception('Can not serialize data3d buffer. Wrong header size: ' + str(len(header)) + ' Expected: ' + str(HEADER_BYTE_LENGTH))
 
-    path = os.path.dirname(output_path)
+        path = _get_buffer_output_path(self.output_path, self.compress_file)
+        try:
+            with open(path, 'wb') as buffer_file:
+                if self.compress_file:
+                    buffer_file.write(gzip.compress(bytes(header + structure_byte_array), COMPRESS_LEVEL))
+                else:
+                    buffer_file.write(header)
+                    buffer_file.write(structure_byte_array)
+                # The staged payload is already compressed (gzip members) if the file is compressed
+                self._payload_file.seek(0)
+                shutil.copyfileobj(self._payload_file, buffer_file, PAYLOAD_CHUNK_SIZE)
+        finally:
+            self._payload_file.close()
+        log.info('output_path %s', path)
+        return path
+
+
+class Data3dJsonWriter(object):
+    """ Stream a data3d.json file, each child object is written as soon as it is added.
+        Attributes:
+            output_path ('str') - The path to the output file.
+    """
 
-    log.debug('filename %s, pathname %s', filename, path)
+    def __init__(self, output_path, root):
+        self.output_path = _get_json_output_path(output_path)
+        log.debug('Output path: %s', self.output_path)
+
+        self._file = open(self.output_path, 'w', encoding='utf-8')
+        self._child_count = 0
+        self._closed = False
+        # The same layout as _to_json of the complete dictionary, the children are the last root key
+        indent = ' ' * 4
+        self._file.write('{\n' + indent + '"' + D3D.r_container + '": {\n')
+        for key, value in root.items():
+            self._file.write(indent * 2 + '"' + str(key) + '": ' + _to_json(value, 2) + ',\n')
+        self._file.write(indent * 2 + '"' + D3D.o_children + '": [')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif not self._closed:
+            self._closed = True
+            self._file.close()
+            os.remove(self.output_path)
 
-    if compress_file:
-        filename = '.'.join([filename, SUFFIX_GZIP, SUFFIX_BUFFER])
-        with gzip.open('/'.join([path, filename]), 'wb') as buffer_file:
-            buffer_file.write(header)
-            buffer_file.write(structure_byte_array)
-            buffer_file.write(payload_byte_array)
-    else:
-        filename = '.'.join([filename, SUFFIX_BUFFER])
-        with open('/'.join([path, filename]), 'wb') as buffer_file:
-            buffer_file.write(header)
-            buffer_file.write(structure_byte_array)
-            buffer_file.write(payload_byte_array)
-    log.info('output_path %s', '/'.join([path, filename]))
+    def add_child(self, child):
+        """ Write the child object.
+            Args:
+                child ('dict') - The data3d object.
+        """
+        if self._child_count:
+            self._file.write(',')
+        self._file.write(_to_json(child, 3))
+        self._child_count += 1
+
+    def encode_mesh(self, mesh):
+        """ The json meshes keep their float arrays (lists), see Data3dBufferWriter.encode_mesh.
+            Args:
+                mesh ('dict') - The data3d mesh.
+            Returns:
+                mesh ('dict') - The same data3d mesh.
+        """
+        return mesh
+
+    def close(self):
+        """ Close the children and the root object.
+            Returns:
+                path ('str') - The path to the written file, None if the writer was closed already.
+        """
+        if self._closed:
+            return None
+        self._closed = True
+
+        self._file.write(']\n' + ' ' * 4 + '}\n}')
+        self._file.close()
+        return self.output_path
 
 
 # Public functions
-def deserialize_data3d(input_path, from_buffer):
+def deserialize_data3d(input_path, from_buffer, lazy_payload=False):
     """ Deserialize data3d from .json or .buffer input.
         Args:
             input_path ('str') - The path to the data3d file.
             from_buffer ('bool') - Import format is buffer.
+        Kwargs:
+            lazy_payload ('bool') - Only read the payload ranges that are accessed (buffer format).
         Returns:
             _ ('list(Data3dObject)') - The deserialized data3d ad Data3dObjects.
     """
     if from_buffer:
-        return _from_data3d_buffer(input_path)
+        return _from_data3d_buffer(input_path, lazy_payload=lazy_payload)
     else:
         return _from_data3d_json(input_path)
 
@@ -3,18 +3,23 @@ import sys
 import logging
 from datetime import datetime
 from collections import OrderedDict
-import shutil
+import time
 
 import math
-from mathutils import Matrix
+from mathutils import Matrix, Vector
 
+import numpy as np
 import bpy
 import bmesh
+from bpy.app.handlers import persistent
 from bpy_extras.io_utils import unpack_list
 
 from . import ModuleInfo
 from io_scene_data3d.material_utils import get_al_material, get_default_al_material
-from io_scene_data3d.data3d_utils import D3D, serialize_data3d
+from io_scene_data3d.cache_utils import NAME_SUFFIX
+from io_scene_data3d.data3d_utils import D3D, Data3dBufferWriter, Data3dJsonWriter
+from io_scene_data3d.perf_utils import PerfMetrics, profile
+from io_scene_data3d.texture_utils import export_textures
 
 
 # Global Variables
@@ -26,6 +31,104 @@ log = logging.getLogger('archilogic')
 
 TextureDirectory = 'textures'
 
+
+class ExportMeshCache(object):
+    """ The encoded meshes of the exported objects, kept between incremental exports: the compressed payload
+        block (data3d.buffer) or the parsed meshes (data3d.json). The meshes are in local space, objects that only
+        moved keep their entries. Entries are dropped by the depsgraph handler when the geometry of an object or its
+        mesh data changes, and replaced if the mesh data, the materials or the modifiers differ.
+        Attributes:
+            entries ('dict') - The object names -> (key, 'PayloadBlock' or data3d meshes).
+    """
+
+    def __init__(self):
+        self.entries = {}
+
+    @staticmethod
+    def get_key(obj, as_lists):
+        """ The state the parsed meshes of the object depend on, besides the geometry itself.
+            Args:
+                obj ('bpy.types.Object') - The exported object.
+                as_lists ('bool') - The meshes are parsed for json (lists) or buffer (float32 arrays).
+            Returns:
+                key ('tuple') - The cache key.
+        """
+        return (as_lists,
+                obj.data.name,
+                tuple(slot.material.name if slot.material else '' for slot in obj.material_slots),
+                tuple((mod.name, mod.type, mod.show_viewport) for mod in obj.modifiers))
+
+    def get(self, obj, as_lists):
+        """ Get the cached meshes of the object.
+            Returns:
+                _ ('PayloadBlock', 'OrderedDict') - The payload block (buffer) or the data3d mesh keys -> data3d
+                                                   meshes (json), None if not cached or outdated.
+        """
+        entry = self.entries.get(obj.name)
+        if entry is None or entry[0] != self.get_key(obj, as_lists):
+            return None
+        return entry[1]
+
+    def put(self, obj, as_lists, value):
+        self.entries[obj.name] = (self.get_key(obj, as_lists), value)
+
+    def invalidate(self, object_name=None, mesh_name=None):
+        """ Drop the entries of the object, or of all objects using the mesh data. """
+        if object_name is not None:
+            self.entries.pop(object_name, None)
+        if mesh_name is not None:
+            for name in [name for name, entry in self.entries.items() if entry[0][1] == mesh_name]:
+                del self.entries[name]
+
+    def prune(self, object_names):
+        """ Drop the entries of the objects that were not exported (deleted, renamed or deselected). """
+        for name in [name for name in self.entries if name not in object_names]:
+            del self.entries[name]
+
+    def clear(self):
+        self.entries.clear()
+
+
+# Shared by the incremental exports of the session
+mesh_cache = ExportMeshCache()
+
+
+@persistent
+def on_depsgraph_update(scene, depsgraph=None):
+    """ Invalidate the cached meshes of the objects and mesh data blocks with updated geometry. """
+    if not mesh_cache.entries:
+        return
+    depsgraph = depsgraph or bpy.context.evaluated_depsgraph_get()
+    for update in depsgraph.updates:
+        if not update.is_updated_geometry:
+            continue
+        if isinstance(update.id, bpy.types.Object):
+            mesh_cache.invalidate(object_name=update.id.name)
+        elif isinstance(update.id, bpy.types.Mesh):
+            mesh_cache.invalidate(mesh_name=update.id.name)
+
+
+@persistent
+def on_data_reload(*args):
+    """ Loading a file or undo replaces the data blocks, the cache is cleared. """
+    mesh_cache.clear()
+
+
+def register_handlers():
+    bpy.app.handlers.depsgraph_update_post.append(on_depsgraph_update)
+    for handlers in (bpy.app.handlers.load_post, bpy.app.handlers.undo_post, bpy.app.handlers.redo_post):
+        handlers.append(on_data_reload)
+
+
+def unregister_handlers():
+    for handlers, handler in ((bpy.app.handlers.depsgraph_update_post, on_depsgraph_update),
+                              (bpy.app.handlers.load_post, on_data_reload),
+                              (bpy.app.handlers.undo_post, on_data_reload),
+                              (bpy.app.handlers.redo_post, on_data_reload)):
+        if handler in handlers:
+            handlers.remove(handler)
+    mesh_cache.clear()
+
 ### Data3d Export Methods ###
 
 
@@ -46,22 +149,22 @@ def parse_materials(export_objects, export_metadata, export_images, export_dir=N
     raw_images = []
 
     def export_image_textures(bl_images, dest_dir):
-        """ Copy the image texture to destination directory.
+        """ Export the image textures to the destination directory, unchanged files are skipped.
             Args:
                 bl_images ('list(bpy.types.Image)') - The associated image data blocks.
                 dest_dir ('str') - The texture export directory.
         """
         log.debug("Export images %s", " * ".join([img.name for img in bl_images]))
 
+        filepaths = []
         for image in bl_images:
             filepath = image.filepath_from_user()
             if os.path.exists(filepath):
-                tex_dir = os.path.join(dest_dir, TextureDirectory)
-                if not os.path.exists(tex_dir):
-                    os.makedirs(tex_dir)
-                shutil.copy(filepath, os.path.join(tex_dir))
+                filepaths.append(filepath)
             else:
                 log.warn("File does not exist: %s", filepath)
+        stats = export_textures(filepaths, os.path.join(dest_dir, TextureDirectory))
+        log.info('Textures: %d copied, %d linked, %d unchanged', stats['copied'], stats['linked'], stats['skipped'])
 
     for obj in export_objects:
         obj_materials = [slot.material for slot in obj.material_slots if slot.material is not None]
@@ -80,105 +183,277 @@ def parse_materials(export_objects, export_metadata, export_images, export_dir=N
     return al_materials
 
 
-def parse_flattened_geometry(context, export_objects):
-    """ Triangulate the specified mesh, calculate normals & tessfaces, apply export matrix
+def is_collection_instance(obj):
+    """ Check if the object is an empty that instances a collection (the instanced products of the import).
         Args:
-            context ('bpy.types.context') - Current window manager and data context.
-            export_objects ('bpy_prop_collection') - The exported objects.
+            obj ('bpy.types.Object') - The object.
         Returns:
-            json_meshes ('dict') - The data3d meshes dictionary.
+            _ ('bool') - True if the object instances a collection.
     """
-    obj_mesh_pairs = [get_obj_mesh_pair(obj, context) for obj in export_objects]
-    json_meshes = {}
-    default_material = None
-    # FIXME rename (json) & fix unclarity
-
-    for obj, bl_mesh in obj_mesh_pairs:
-        log.info('Parsing blender mesh to json: %s', bl_mesh.name)
-        mesh_materials = [m for m in bl_mesh.materials if m]
-
-        if len(mesh_materials) == 0:
-            # No Material Mesh
-            json_mesh = parse_mesh(bl_mesh)
-            json_mesh[D3D.m_material] = D3D.mat_default
-            json_mesh[D3D.m_id] = obj[D3D.m_id] if D3D.m_id in obj else 'missing'
-            if default_material is None:
-                default_material = get_default_al_material()
-            json_meshes[bl_mesh.name] = json_mesh
+    return obj.type == 'EMPTY' and obj.instance_type == 'COLLECTION' and obj.instance_collection is not None
+
+
+def get_instanced_objects(export_objects):
+    """ Get the mesh objects of the collections instanced by the export objects, each object once.
+        Args:
+            export_objects ('list(bpy.types.Object)') - The exported objects.
+        Returns:
+            instanced_objects ('list(bpy.types.Object)') - The mesh objects of the instanced collections.
+    """
+    instanced_objects = OrderedDict()
+    for obj in export_objects:
+        if is_collection_instance(obj):
+            for member in obj.instance_collection.all_objects:
+                if member.type == 'MESH':
+                    instanced_objects[member] = True
+    return list(instanced_objects)
+
+
+def get_export_hierarchy(export_objects):
+    """ Get the parent-child relations of the export objects. Objects whose parents are not exported are attached
+        to their closest exported ancestor, or become root objects.
+        Args:
+            export_objects ('list(bpy.types.Object)') - The exported objects.
+        Returns:
+            roots ('list(bpy.types.Object)') - The top level objects.
+            children ('dict') - The exported objects -> their exported children, in export order.
+            parents ('dict') - The exported objects -> their closest exported ancestor, None for the top level.
+    """
+    export_set = set(export_objects)
+    roots = []
+    children = OrderedDict((obj, []) for obj in export_objects)
+    parents = {}
+    for obj in export_objects:
+        parent = obj.parent
+        while parent is not None and parent not in export_set:
+            parent = parent.parent
+        parents[obj] = parent
+        if parent is None:
+            roots.append(obj)
         else:
-            for i, bl_mat in enumerate(mesh_materials):
-                faces = [face for face in bl_mesh.polygons if face.material_index == i]
-                if len(faces) > 0:
-                    mat_name = bl_mat.name
-                    json_mesh = parse_mesh(bl_mesh, material_index=i)
-                    json_mesh[D3D.m_material] = mat_name
-                    json_mesh[D3D.m_id] = obj[D3D.m_id] if D3D.m_id in obj else 'missing'
+            children[parent].append(obj)
+    return roots, children, parents
 
-                    json_mesh_name = bl_mesh.name + "-" + mat_name
-                    json_meshes[json_mesh_name] = json_mesh
 
-    return json_meshes, default_material
+def get_node_transform(obj, parent, parent_scale):
+    """ Get the data3d transform of the object relative to its exported parent. Data3d nodes have no scale, the
+        scale is applied by the meshes of the node and passed on to the children.
+        Args:
+            obj ('bpy.types.Object') - The exported object.
+            parent ('bpy.types.Object') - The closest exported ancestor, None for the top level.
+            parent_scale ('Vector') - The scale of the parent that is not part of its data3d transform.
+        Returns:
+            position, rotation, scale ('list', 'list', 'Vector') - The position, the rotation (rad, XYZ euler) and
+                                                                   the scale of the node.
+    """
+    local = obj.matrix_world if parent is None else parent.matrix_world.inverted_safe() @ obj.matrix_world
+    local = Matrix.Diagonal(parent_scale).to_4x4() @ local
+    location, rotation, scale = local.decompose()
+    return list(location), list(rotation.to_euler('XYZ')), scale
 
 
-def parse_geometry(context, export_objects, al_materials):
-    """ Triangulate the specified mesh, calculate normals & tessfaces, apply export matrix
+def parse_obj_meshes(obj, bl_mesh, as_lists, metrics):
+    """ Parse the evaluated mesh of the object into one data3d mesh per used material.
+        Args:
+            obj ('bpy.types.Object') - The exported object.
+            bl_mesh ('bpy.types.Mesh') - The evaluated mesh of the object in local space.
+            as_lists ('bool') - Parse the float arrays into lists (json), otherwise keep float32 arrays (buffer).
+            metrics ('PerfMetrics') - The metrics to record the mesh timings into.
+        Returns:
+            al_meshes ('OrderedDict') - The data3d mesh keys -> data3d meshes (float arrays not encoded).
+    """
+    log.info('Parsing blender mesh: %s', bl_mesh.name)
+    al_meshes = OrderedDict()
+    mesh_materials = [m for m in bl_mesh.materials if m]
+    t_mesh = time.perf_counter()
+
+    if len(mesh_materials) == 0:
+        # No Material Mesh
+        al_mesh = parse_mesh(bl_mesh, as_lists=as_lists)
+        al_mesh[D3D.m_material] = D3D.mat_default
+        al_meshes[bl_mesh.name] = al_mesh
+        add_mesh_metrics(metrics, bl_mesh.name, al_mesh, t_mesh, obj.name)
+        return al_meshes
+
+    # All submeshes in one pass over the triangles
+    material_meshes = parse_mesh_by_material(bl_mesh, as_lists=as_lists)
+    for i, bl_mat in enumerate(mesh_materials):
+        if i in material_meshes:
+            al_mesh = material_meshes[i]
+            al_mesh[D3D.m_material] = bl_mat.name
+            al_mesh_name = bl_mesh.name + "-" + bl_mat.name
+            al_meshes[al_mesh_name] = al_mesh
+            add_mesh_metrics(metrics, al_mesh_name, al_mesh, t_mesh, obj.name)
+            t_mesh = time.perf_counter()
+    return al_meshes
+
+
+def parse_hierarchy(context, export_objects, al_materials, writer, as_lists, metrics=None, cache=None):
+    """ Parse the export objects into data3d nodes with their children, position and rotation. The meshes stay
+        in local space, the meshes of objects sharing mesh data without modifiers are parsed once.
         Args:
             context ('bpy.types.context') - Current window manager and data context.
-            export_objects ('bpy_prop_collection') - The exported objects.
+            export_objects ('list(bpy.types.Object)') - The exported objects.
             al_materials ('dict') - The data3d materials dictionary.
-        Returns:
-            data3d_objects ('dict') - The data3d objects dictionary.
+            writer ('Data3dBufferWriter', 'Data3dJsonWriter') - The writer the top level nodes are streamed to.
+            as_lists ('bool') - Parse the float arrays into lists (json), otherwise keep float32 arrays (buffer).
+        Kwargs:
+            metrics ('PerfMetrics') - The metrics to record the per object and mesh timings into.
+            cache ('ExportMeshCache') - Reuse the meshes parsed by earlier exports, only changed objects are parsed.
     """
-    # Fixme PARENT - child objects
-    obj_mesh_pairs = [get_obj_mesh_pair(obj, context) for obj in export_objects]
+    metrics = metrics or PerfMetrics()
+    roots, children, parents = get_export_hierarchy(export_objects)
+    # The depsgraph is evaluated once for all objects
+    depsgraph = context.evaluated_depsgraph_get()
+    # Mesh data block & materials -> the encoded data3d meshes, for the objects without modifiers
+    shared_meshes = {}
+    default_material = None
 
-    json_objects = []
+    def get_encoded_meshes(obj):
+        # Materials can be linked to the object, objects sharing the mesh data can differ in their materials.
+        # Objects with modifiers are only shared with themselves (the objects of instanced collections).
+        key = (obj.data, tuple(slot.material for slot in obj.material_slots)) if not obj.modifiers else obj
+        if key in shared_meshes:
+            metrics.count('shared_meshes', len(shared_meshes[key]))
+            return shared_meshes[key]
+
+        cached = cache.get(obj, as_lists) if cache is not None else None
+        if cached is not None:
+            metrics.count('cached_meshes', len(cached.meshes if not as_lists else cached))
+            al_meshes = cached
+        else:
+            with metrics.phase('evaluate'):
+                obj, bl_mesh = get_obj_mesh_pair(obj, depsgraph)
+            try:
+                with metrics.phase('parse_geometry'):
+                    al_meshes = parse_obj_meshes(obj, bl_mesh, as_lists, metrics)
+            finally:
+                # Only one evaluated mesh exists at a time
+                obj.to_mesh_clear()
+
+        # Hand the meshes to the writer, their arrays are not kept (unless cached)
+        with metrics.phase('serialization'):
+            if cache is not None and not as_lists:
+                # The payload of the object is one gzip member, later exports copy it as is
+                block = cached or writer.encode_block(al_meshes)
+                cache.put(obj, as_lists, block)
+                encoded = writer.add_block(block)
+            else:
+                if cache is not None and cached is None:
+                    cache.put(obj, as_lists, al_meshes)
+                encoded = OrderedDict((name, writer.encode_mesh(al_mesh)) for name, al_mesh in al_meshes.items())
+        shared_meshes[key] = encoded
+        return encoded
+
+    def add_meshes(json_meshes, json_materials, obj, scale, matrix=None):
+        """ Add the meshes of the object to the node.
+            Args:
+                json_meshes ('OrderedDict') - The data3d meshes of the node.
+                json_materials ('OrderedDict') - The data3d materials of the node.
+                obj ('bpy.types.Object') - The mesh object.
+                scale ('Vector') - The scale of the node, applied by the meshes.
+            Kwargs:
+                matrix ('Matrix') - The transform of the object in the node (instanced collections).
+        """
+        nonlocal default_material
+        position = rotation = None
+        if matrix is not None:
+            location, quaternion, scale = (Matrix.Diagonal(scale).to_4x4() @ matrix).decompose()
+            position, rotation = list(location), list(quaternion.to_euler('XYZ'))
+
+        for name, encoded in get_encoded_meshes(obj).items():
+            # The meshes are shared, the per node values go to a copy
+            json_mesh = OrderedDict(encoded)
+            json_mesh[D3D.m_scale] = list(scale)
+            if position is not None:
+                json_mesh[D3D.m_position] = position
+                json_mesh[D3D.m_rotation] = rotation
+                json_mesh['rotDeg'] = [math.degrees(angle) for angle in rotation]
+            if D3D.m_id in obj:
+                json_mesh[D3D.m_id] = obj[D3D.m_id]
+            # The objects of an instanced collection can share mesh data
+            key, i = name, 1
+            while key in json_meshes:
+                key, i = '%s.%03d' % (name, i), i + 1
+            json_meshes[key] = json_mesh
+
+            mat_name = json_mesh[D3D.m_material]
+            if mat_name == D3D.mat_default:
+                if default_material is None:
+                    default_material = get_default_al_material()
+                json_materials[mat_name] = default_material
+            elif mat_name in al_materials:
+                json_materials[mat_name] = al_materials[mat_name]
+
+    def parse_node(obj, parent_scale):
+        t_node = time.perf_counter()
+        position, rotation, scale = get_node_transform(obj, parents[obj], parent_scale)
 
-    for obj, bl_mesh in obj_mesh_pairs:
         json_object = OrderedDict()
-        # Fixme: export object position & rotation (right now, pos & rot are applied to the mesh when parsed
-        # json_object[D3D.o_position] = list(obj.location[0:3])
-        # json_object[D3D.o_rotation] = list(obj.rotation_euler[0:3])
+        json_object[D3D.node_id] = obj.name
+        json_object[D3D.o_position] = position
+        json_object[D3D.o_rotation] = rotation
 
         json_meshes = OrderedDict()
-        mesh_materials = [m for m in bl_mesh.materials if m]
-
-        if len(mesh_materials) == 0:
-            # Parse mesh with no material.
-            json_meshes[bl_mesh.name] = parse_mesh(bl_mesh)
-            json_object[D3D.o_meshes] = json_meshes
-
+        json_materials = OrderedDict()
+        if is_collection_instance(obj):
+            # One node per instance, the meshes of the collection are encoded once and shared by the instances.
+            # The product id lets the import instance the product again.
+            collection = obj.instance_collection
+            offset = Matrix.Translation(-collection.instance_offset)
+            for member in collection.all_objects:
+                if member.type == 'MESH':
+                    add_meshes(json_meshes, json_materials, member, scale, matrix=offset @ member.matrix_world)
+            json_object[D3D.o_meta] = OrderedDict([('productResourceId', NAME_SUFFIX.sub('', collection.name))])
         else:
-            # Parse mesh with one or more materials.
-            json_materials = {}
-            for i, bl_mat in enumerate(mesh_materials):
-                faces = [face for face in bl_mesh.polygons if face.material_index == i]
-                if len(faces) > 0:
-                    mat_name = bl_mat.name
-                    json_mesh = parse_mesh(bl_mesh, material_index=i)
-                    json_mesh[D3D.m_material] = mat_name
+            add_meshes(json_meshes, json_materials, obj, scale)
 
-                    json_mesh_name = bl_mesh.name + "-" + mat_name
-                    json_meshes[json_mesh_name] = json_mesh
+        json_object[D3D.o_meshes] = json_meshes
+        json_object[D3D.o_materials] = json_materials
+        json_object[D3D.o_mesh_keys] = list(json_meshes.keys())
+        json_object[D3D.o_material_keys] = list(json_materials.keys())
+        metrics.add_node(obj.name, time.perf_counter() - t_node, mesh_count=len(json_meshes))
 
-                    if mat_name in al_materials:
-                        json_materials[mat_name] = al_materials[mat_name]
+        if children[obj]:
+            json_object[D3D.o_children] = [parse_node(child, scale) for child in children[obj]]
+        return json_object
 
-            json_object[D3D.o_meshes] = json_meshes
-            json_object[D3D.o_materials] = json_materials
-            json_object[D3D.o_mesh_keys] = [key for key in json_meshes.keys()]
-            json_object[D3D.o_material_keys] = [key for key in json_materials.keys()]
+    for obj in roots:
+        json_object = parse_node(obj, Vector((1.0, 1.0, 1.0)))
+        with metrics.phase('serialization'):
+            writer.add_child(json_object)
 
-        json_objects.append(json_object)
+    if cache is not None:
+        cache.prune({obj.name for obj in export_objects + get_instanced_objects(export_objects)})
 
-    return json_objects
 
+def add_mesh_metrics(metrics, name, al_mesh, t0, node_id):
+    """ Record the timing and size of a parsed data3d mesh.
+        Args:
+            metrics ('PerfMetrics') - The export metrics.
+            name ('str') - The data3d mesh key.
+            al_mesh ('dict') - The parsed data3d mesh.
+            t0 ('float') - The perf_counter value at the start of the mesh parsing.
+            node_id ('str') - The name of the exported object.
+    """
+    vertex_count = len(al_mesh[D3D.v_coords]) // 3
+    metrics.add_mesh(name, time.perf_counter() - t0,
+                     triangles=vertex_count // 3,
+                     vertices=vertex_count,
+                     node_id=node_id,
+                     material=al_mesh.get(D3D.m_material))
 
-def get_obj_mesh_pair(obj, context):
+
+def get_obj_mesh_pair(obj, depsgraph):
+    """ Get the evaluated, triangulated mesh of the object in local space. Release it with obj.to_mesh_clear().
+        Args:
+            obj ('bpy.types.Object') - The exported object.
+            depsgraph ('bpy.types.Depsgraph') - The evaluated dependency graph.
+        Returns:
+            _ ('tuple') - The object and its evaluated mesh.
+    """
     log.debug('Transforming object into mesh: %s', obj.name)
-    depsgraph = context.evaluated_depsgraph_get()
     mesh = obj.to_mesh(preserve_all_data_layers=True, depsgraph=depsgraph)
-    mesh.transform(Matrix.Rotation(-math.pi / 2, 4, 'X') @ obj.matrix_world)
 
     mesh.calc_loop_triangles()
     mesh.calc_normals_split()
@@ -186,7 +461,75 @@ def get_obj_mesh_pair(obj, context):
     return (obj, mesh)
 
 
-def parse_mesh(bl_mesh, material_index=None):
+def get_mesh_arrays(bl_mesh):
+    """ Read the triangulated mesh into flat buffers, the attributes are gathered per triangle corner in bulk.
+        Args:
+            bl_mesh ('bpy.types.Mesh') - The mesh data block with loop triangles and split normals.
+        Returns:
+            arrays ('dict') - The (n, 3) positions, normals, the (n, 2) uvs, uvs2 (None if missing) per triangle
+                              corner and the material index per triangle.
+    """
+    # UV Textures by name
+    # FIXME if channel names do not apply, get 1 channel as uv and 2nd channel as lightmap Uv
+    texture_uvs = bl_mesh.uv_layers.get('UVMap')
+    lightmap_uvs = bl_mesh.uv_layers.get('UVLightmap')
+
+    tri_count = len(bl_mesh.loop_triangles)
+    tri_verts = np.empty(tri_count * 3, dtype=np.int32)
+    tri_loops = np.empty(tri_count * 3, dtype=np.int32)
+    tri_materials = np.empty(tri_count, dtype=np.int32)
+    bl_mesh.loop_triangles.foreach_get('vertices', tri_verts)
+    bl_mesh.loop_triangles.foreach_get('loops', tri_loops)
+    bl_mesh.loop_triangles.foreach_get('material_index', tri_materials)
+
+    co = np.empty(len(bl_mesh.vertices) * 3, dtype=np.float32)
+    bl_mesh.vertices.foreach_get('co', co)
+    # Split normals (calc_normals_split) are stored per loop
+    loop_normals = np.empty(len(bl_mesh.loops) * 3, dtype=np.float32)
+    bl_mesh.loops.foreach_get('normal', loop_normals)
+
+    def get_uvs(uv_layer):
+        if uv_layer is None:
+            return None
+        layer_uvs = np.empty(len(bl_mesh.loops) * 2, dtype=np.float32)
+        uv_layer.data.foreach_get('uv', layer_uvs)
+        return layer_uvs.reshape(-1, 2)[tri_loops]
+
+    return {
+        'positions': co.reshape(-1, 3)[tri_verts],
+        'normals': loop_normals.reshape(-1, 3)[tri_loops],
+        'uvs': get_uvs(texture_uvs),
+        'uvs2': get_uvs(lightmap_uvs),
+        'material_indices': tri_materials
+    }
+
+
+def parse_mesh_by_material(bl_mesh, as_lists=True):
+    """ Parse the mesh into one data3d mesh per material index in a single pass. The triangles are partitioned
+        with a stable sort on the material index, so each submesh keeps the triangle order of the mesh.
+        Args:
+            bl_mesh ('bpy.types.Mesh') - The mesh data block to parse.
+        Kwargs:
+            as_lists ('bool') - Return the float arrays as lists (json), otherwise as float32 arrays (buffer).
+        Returns:
+            al_meshes ('OrderedDict') - The material indices -> data3d mesh dictionaries, only used indices.
+    """
+    arrays = get_mesh_arrays(bl_mesh)
+    material_indices = arrays['material_indices']
+    order = np.argsort(material_indices, kind='stable')
+    sorted_indices = material_indices[order]
+    bounds = np.concatenate(([0], np.flatnonzero(np.diff(sorted_indices)) + 1, [len(order)]))
+
+    al_meshes = OrderedDict()
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        if start == end:
+            continue
+        material_index = int(sorted_indices[start])
+        al_meshes[material_index] = _to_al_mesh(bl_mesh, arrays, order[start:end], material_index, as_lists)
+    return al_meshes
+
+
+def parse_mesh(bl_mesh, material_index=None, as_lists=True):
         """
             Parses a blender mesh into data3d arrays
             Example:
@@ -203,48 +546,43 @@ def parse_mesh(bl_mesh, material_index=None):
             Args:
                 bl_mesh ('bpy.types.Mesh') - The mesh data block to parse.
                 material_index - The subset of triangles to parse wich have the corresponding material index.
+                as_lists ('bool') - Return the float arrays as lists (json), otherwise as float32 arrays (buffer).
             Returns:
                 al_mesh ('dict') - The data3d mesh dictionary.
         """
+        arrays = get_mesh_arrays(bl_mesh)
+        if material_index is None:
+            triangles = np.arange(len(arrays['material_indices']))
+        else:
+            triangles = np.flatnonzero(arrays['material_indices'] == material_index)
+        return _to_al_mesh(bl_mesh, arrays, triangles, material_index, as_lists)
 
-        # UV Textures by name
-        # FIXME if channel names do not apply, get 1 channel as uv and 2nd channel as lightmap Uv
-        texture_uvs = bl_mesh.uv_layers.get('UVMap')
-        lightmap_uvs = bl_mesh.uv_layers.get('UVLightmap')
-
-        vertices = []
-        normals = []
-        uvs = []
-        uvs2 = []
-
-        invalid_uv = False
-
-        for tri in bl_mesh.loop_triangles:
-            if material_index is None or material_index == tri.material_index:
-                for vert_index in tri.vertices:
-                    co = bl_mesh.vertices[vert_index].co
-                    vertices += [co.x, co.y, co.z]
-                    
-                for nos in tri.split_normals:
-                    normals  += nos
-                
-                if texture_uvs is not None or lightmap_uvs is not None:
-                    for loop_index in tri.loops:
-                        if texture_uvs is not None:
-                            uv = texture_uvs.data[loop_index].uv
-                            uvs += [uv.x, uv.y]
-                        if lightmap_uvs is not None:
-                            uv = lightmap_uvs.data[loop_index].uv
-                            uvs2 += [uv.x, uv.y]
-                            if uv.x > 1.0 or uv.y > 1.0 or uv.x < 0.0 or uv.y < 0.0:
-                                invalid_uv = True
-                    
-        if invalid_uv:
+
+def _to_al_mesh(bl_mesh, arrays, triangles, material_index, as_lists=True):
+        """ Create the data3d mesh of the triangle subset.
+            Args:
+                bl_mesh ('bpy.types.Mesh') - The parsed mesh data block.
+                arrays ('dict') - The mesh arrays, see get_mesh_arrays.
+                triangles ('ndarray') - The indices of the triangles of the submesh.
+                material_index ('int') - The material index of the submesh, None for the whole mesh.
+                as_lists ('bool') - Return the float arrays as lists, otherwise as flat float32 arrays.
+            Returns:
+                al_mesh ('dict') - The data3d mesh dictionary.
+        """
+        corners = (triangles[:, None] * 3 + np.arange(3)).reshape(-1)
+        uvs = arrays['uvs'][corners] if arrays['uvs'] is not None else None
+        uvs2 = arrays['uvs2'][corners] if arrays['uvs2'] is not None else None
+
+        if uvs2 is not None and np.any((uvs2 < 0.0) | (uvs2 > 1.0)):
             log.info('Invalid values in UVLightmap, index: %d', material_index)
 
+        def flat(values):
+            values = values.reshape(-1)
+            return values.tolist() if as_lists else values
+
         al_mesh = OrderedDict()
-        al_mesh[D3D.v_coords] = vertices
-        al_mesh[D3D.v_normals] = normals
+        al_mesh[D3D.v_coords] = flat(arrays['positions'][corners])
+        al_mesh[D3D.v_normals] = flat(arrays['normals'][corners])
 
         # temp
         al_mesh[D3D.m_position] = [0.0, ]*3  #list(obj.location[0:3])
@@ -252,11 +590,11 @@ def parse_mesh(bl_mesh, material_index=None):
         al_mesh['rotDeg'] = [0.0, ]*3
         al_mesh['scale'] = [1.0, ]*3
 
-        if texture_uvs:
-            al_mesh[D3D.uv_coords] = uvs
+        if uvs is not None:
+            al_mesh[D3D.uv_coords] = flat(uvs)
 
-        if lightmap_uvs:
-            al_mesh[D3D.uv2_coords] = uvs2
+        if uvs2 is not None:
+            al_mesh[D3D.uv2_coords] = flat(uvs2)
 
         # preserve ids 
         if D3D.m_id in bl_mesh: 
@@ -265,18 +603,21 @@ def parse_mesh(bl_mesh, material_index=None):
         return al_mesh
 
 
-def _write(context, export_path, global_matrix, export_selection_only, export_images, export_format, export_al_metadata):
+def _write(context, export_path, global_matrix, export_selection_only, export_images, export_format, export_al_metadata, metrics,
+           export_workers=0, incremental=False):
     """ Export the scene as an Archilogic Data3d File
         Args:
             context ('bpy.types.context') - Current window manager and data context.
             export_path ('str') - The filepath to the data3d file.
-            global_matrix ('Matrix') - The target world matrix.
+            global_matrix ('Matrix') - The target world matrix, applied by the data3d root.
             export_selection_only ('bool') - Export selected objects only.
             export_images ('bool') - Export associated texture files.
             export_format ('int') - Export interleaved (buffer, 0) or non-interleaved (json, 1).
             export_al_metadata ('bool') - Export Archilogic Metadata, if it exists.
+            metrics ('PerfMetrics') - The metrics to record the export phases, objects and meshes into.
+            export_workers ('int') - Compress the buffer payload on this many threads, 0 on the main thread.
+            incremental ('bool') - Parse only the objects changed since the last incremental export.
     """
-    # Fixme: use global matrix from param export_global_matrix
     try:
         output_path = export_path
         to_buffer = True if export_format == 'INTERLEAVED' else False
@@ -285,32 +626,32 @@ def _write(context, export_path, global_matrix, export_selection_only, export_im
             os.makedirs(os.path.dirname(output_path))
         log.info('Exporting Scene: %s', output_path)
 
-        if export_selection_only:
-            export_objects = [obj for obj in context.selected_objects if obj.type == 'MESH']
-        else:
-            export_objects = [obj for obj in context.selectable_objects if obj.type == 'MESH']
-
-        export_data = OrderedDict()
+        # Mesh objects and the instances of collections (the instanced products of the import)
+        candidates = context.selected_objects if export_selection_only else context.selectable_objects
+        export_objects = [obj for obj in candidates if obj.type == 'MESH' or is_collection_instance(obj)]
 
-        data3d = export_data[D3D.r_container] = OrderedDict()
-        data3d[D3D.o_position] = [0, ] * 3
-        data3d[D3D.o_rotation] = [0, ] * 3
-        data3d['rotDeg'] = [0, ] * 3
+        # The axis conversion is the transform of the root, the nodes keep their blender transforms
+        root_rotation = global_matrix.to_euler('XYZ')
+        data3d = OrderedDict()
+        data3d[D3D.o_position] = list(global_matrix.to_translation())
+        data3d[D3D.o_rotation] = list(root_rotation)
+        data3d['rotDeg'] = [math.degrees(angle) for angle in root_rotation]
 
-        materials = parse_materials(export_objects, export_al_metadata, export_images, export_dir=os.path.dirname(output_path))
+        with metrics.phase('material_export'):
+            materials = parse_materials(export_objects + get_instanced_objects(export_objects), export_al_metadata,
+                                        export_images, export_dir=os.path.dirname(output_path))
 
+        # The objects are evaluated, parsed and streamed to the writer one at a time
         if to_buffer:
-            data3d[D3D.o_meshes], default_material = parse_flattened_geometry(context, export_objects)
-            if default_material:
-                materials[D3D.mat_default] = default_material
-            data3d[D3D.o_materials] = materials
+            # The main thread extracts the meshes, the payload chunks are compressed in parallel
+            writer = Data3dBufferWriter(output_path, data3d, compress_file=True, compress_workers=export_workers)
         else:
-            #Fixme: add functionality to parse parent-child hierarchy for data3d.json
-            #data3d[D3D.o_meshes] = {}
-            #data3d[D3D.o_materials]
-            data3d[D3D.o_children] = parse_geometry(context, export_objects, materials)
-
-        serialize_data3d(export_data, output_path, to_buffer=to_buffer)
+            writer = Data3dJsonWriter(output_path, data3d)
+        with writer:
+            parse_hierarchy(context, export_objects, materials, writer, as_lists=not to_buffer, metrics=metrics,
+                            cache=mesh_cache if incremental else None)
+            with metrics.phase('serialization'):
+                writer.close()
 
     except:
         raise Exception('Export Scene failed. ', sys.exc_info())
@@ -327,16 +668,35 @@ def save(context,
             export_images ('bool') - Export associated texture files.
             export_mode ('int') - Export interleaved (buffer, 0) or non-interleaved (json, 1).
             export_al_metadata ('bool') - Export Archilogic Metadata, if it exists.
-            global_matrix ('Matrix') - The target world matrix.
+            global_matrix ('Matrix') - The target world matrix, applied by the data3d root.
+            metrics ('PerfMetrics') - Record the export metrics into this instance, read them with to_dict().
+            metrics_report ('bool') - Write the metrics as json report next to the output file.
+            trace_memory ('bool') - Record the peak memory with tracemalloc (slows down the export).
+            profile_mode ('str') - Profile the export and write the profiles next to the output file.
+                          Enum {'NONE', 'CPROFILE', 'SAMPLING'}
+            export_workers ('int') - The number of threads compressing the data3d.buffer payload.
+            incremental ('bool') - Keep the parsed meshes and parse only the objects changed since the last export.
     """
     if args['config_logger']:
         logging.basicConfig(level='DEBUG', format='%(asctime)s %(levelname)-10s %(message)s', stream=sys.stdout)
 
-    _write(context, args['filepath'],
-           global_matrix=args['global_matrix'],
-           export_selection_only=args['use_selection'],
-           export_images=args['export_images'],
-           export_format=args['export_format'],
-           export_al_metadata=args['export_al_metadata'])
+    metrics = args.get('metrics') or PerfMetrics(trace_memory=args.get('trace_memory', False))
+    metrics.start()
+
+    with profile(args.get('profile_mode', 'NONE'), args['filepath']):
+        _write(context, args['filepath'],
+               global_matrix=args['global_matrix'],
+               export_selection_only=args['use_selection'],
+               export_images=args['export_images'],
+               export_format=args['export_format'],
+               export_al_metadata=args['export_al_metadata'],
+               metrics=metrics,
+               export_workers=args.get('export_workers', 0),
+               incremental=args.get('incremental', False))
+
+    metrics.stop()
+    metrics.log_summary('Export Data3d successful.')
+    if args.get('metrics_report'):
+        metrics.write_report(args['filepath'])
 
     return {'FINISHED'}
@@ -0,0 +1,40 @@
+import json
+import struct
+import hashlib
+
+__all__ = ['HASH_PROPERTY', 'canonical_encode', 'content_hash']
+
+# The custom property of the materials and meshes that stores their content hash.
+HASH_PROPERTY = 'data3d_hash'
+DIGEST_SIZE = 16
+
+
+def canonical_encode(value):
+    """ Encode the json value canonically: sorted keys, no whitespace, utf-8.
+        Args:
+            value ('object') - The json serializable value.
+        Returns:
+            _ ('bytes') - The canonical encoding.
+    """
+    return json.dumps(value, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def content_hash(*values):
+    """ Hash the values with BLAKE2. The hash is stable across processes and sessions (unlike hash()).
+        Args:
+            values ('bytes', 'ndarray', 'array', 'object') - Raw bytes, buffers with tobytes() or json values.
+        Returns:
+            _ ('str') - The hex digest.
+    """
+    h = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    for value in values:
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            data = bytes(value)
+        elif hasattr(value, 'tobytes'):
+            data = value.tobytes()
+        else:
+            data = canonical_encode(value)
+        # The length prefix keeps adjacent values from shifting into each other
+        h.update(struct.pack('<Q', len(data)))
+        h.update(data)
+    return h.hexdigest()
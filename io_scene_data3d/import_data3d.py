@@ -2,9 +2,10 @@ import os
 import sys
 import mathutils
 import logging
-import array
 import time
+import threading
 
+import numpy as np
 import bpy
 from bpy_extras.io_utils import unpack_list
 import bmesh
@@ -12,6 +13,10 @@ import bmesh
 from . import material_utils
 from io_scene_data3d.data3d_utils import D3D, deserialize_data3d
 from io_scene_data3d.material_utils import Material
+from io_scene_data3d.perf_utils import PerfMetrics, Profiler, profile
+from io_scene_data3d.mesh_utils import bounding_box_triangles, decimate_triangles
+from io_scene_data3d import cache_utils
+from io_scene_data3d.hash_utils import HASH_PROPERTY, content_hash
 
 
 # Global Variables
@@ -21,18 +26,31 @@ O = bpy.ops
 
 log = logging.getLogger('archilogic')
 
-
-def import_data3d_materials(data3d_objects, filepath, import_metadata, place_holder_images):
-    """ Import the material references and create blender and cycles materials and add the hashed keys
-        and add a material-hash-map to the data3d_objects dictionary.
+# Custom properties of the bounding box proxies, they locate the mesh in the source file
+PROXY_SOURCE = 'data3d_proxy_source'
+PROXY_NODE_ID = 'data3d_proxy_node_id'
+PROXY_NODE_INDEX = 'data3d_proxy_node_index'
+PROXY_MESH_KEY = 'data3d_proxy_mesh_key'
+PROXY_KEYS = (PROXY_SOURCE, PROXY_NODE_ID, PROXY_NODE_INDEX, PROXY_MESH_KEY)
+# Custom property of the meshes, the hash of their vertex positions and counts when they were created. Meshes edited
+# since then no longer match and are not reused.
+GEOMETRY_PROPERTY = 'data3d_geometry_hash'
+# Custom property of the materials, the newline separated source keys (file path#node path/material key) of the material
+SOURCE_PROPERTY = 'data3d_source'
+# The quads of a box from its corners, the corner index bits are the (x, y, z) max flags
+BOX_FACES = ((0, 1, 3, 2), (4, 6, 7, 5), (0, 4, 5, 1), (2, 3, 7, 6), (0, 2, 6, 4), (1, 5, 7, 3))
+
+
+def hash_data3d_materials(data3d_objects, filepath, import_metadata):
+    """ Hash the material references and add a material-hash-map to the data3d_objects dictionary.
         Args:
-            data3d_objects ('dict') - The data3d_objects and materials to import.
+            data3d_objects ('dict') - The data3d_objects and materials to hash.
             filepath ('str') - The file path to the source file.
             import_metadata ('str') - Import Archilogic json-material as blender-material metadata.
                                       Enum {'NONE', 'BASIC', 'ADVANCED' }
-            place_holder_images ('bool') - Import place-holder images if source is not available.
         Returns:
-            bl_materials ('dict') - Dictionary of hashed material keys and corresponding blender-material references.
+            al_hashed_materials ('dict') - The content hashes -> the reduced al_materials.
+            al_material_sources ('dict') - The content hashes -> the source keys of the material.
     """
 
     def get_al_material_hash(al_material):
@@ -40,7 +58,7 @@ def import_data3d_materials(data3d_objects, filepath, import_metadata, place_hol
             Args:
                 al_material ('dict') - The source al_material dict.
             Returns:
-                al_mat_hash ('int') - The hashed dictionary.
+                al_mat_hash ('str') - The content hash of the relevant keys, stable across sessions.
                 hash_nodes ('dict') - The al_material dictionary reduced to the relevant keys.
         """
         compare_keys = [D3D.col_diff,
@@ -76,36 +94,166 @@ def import_data3d_materials(data3d_objects, filepath, import_metadata, place_hol
             if key in al_material:
                 value = al_material[key]
                 hash_nodes[key] = tuple(value) if isinstance(value, list) else str(value) if isinstance(value, dict) else value
-        al_mat_hash = hash(frozenset(hash_nodes.items()))
+        al_mat_hash = content_hash(import_metadata, {key: al_material[key] for key in hash_nodes})
         return al_mat_hash, hash_nodes
 
-    material_utils.setup()
     al_hashed_materials = {}
+    al_material_sources = {}
+    # The source keys locate the material in the file, they are stable across imports of the same file
+    source_path = os.path.normpath(os.path.abspath(filepath))
 
     for data3d_object in data3d_objects:
+        node_path = data3d_object.get_node_path()
         al_raw_materials = data3d_object.materials
         material_hash_map = {}
         for key in al_raw_materials:
             al_mat_hash, al_mat = get_al_material_hash(al_raw_materials[key])
             # Add hash to the data3d_object json
-            material_hash_map[key] = str(al_mat_hash)
+            material_hash_map[key] = al_mat_hash
             # Check if the material already exists
             if al_mat_hash not in al_hashed_materials:
                 al_hashed_materials[al_mat_hash] = al_mat
+            source_key = '%s#%s/%s' % (source_path, node_path, key)
+            al_material_sources.setdefault(al_mat_hash, []).append(source_key)
 
         data3d_object.mat_hash_map = material_hash_map
+    return al_hashed_materials, al_material_sources
 
-    # Create the Blender Materials
+
+def import_data3d_materials(data3d_objects, filepath, import_metadata, place_holder_images, update_materials=False,
+                            material_updates=None, metrics=None):
+    """ Import the material references and create blender and cycles materials and add the hashed keys
+        and add a material-hash-map to the data3d_objects dictionary. Materials with the same content hash
+        that exist already (earlier imports) are reused.
+        Args:
+            data3d_objects ('dict') - The data3d_objects and materials to import.
+            filepath ('str') - The file path to the source file.
+            import_metadata ('str') - Import Archilogic json-material as blender-material metadata.
+                                      Enum {'NONE', 'BASIC', 'ADVANCED' }
+            place_holder_images ('bool') - Import place-holder images if source is not available.
+        Kwargs:
+            update_materials ('bool') - Replace the materials imported earlier from the same source, if it changed.
+            material_updates ('list') - Collects the (outdated material, new material) pairs to replace later,
+                                        if None they are replaced right away.
+            metrics ('PerfMetrics') - The metrics to record the material timings into.
+        Returns:
+            bl_materials ('dict') - Dictionary of hashed material keys and corresponding blender-material references.
+    """
     bl_materials = {}
-    working_dir = os.path.dirname(filepath)
-    for key in al_hashed_materials:
-        mat = Material(str(key), al_hashed_materials[key], import_metadata, working_dir, place_holder_images)
-        bl_materials[str(key)] = mat
+    for _ in iter_import_data3d_materials(data3d_objects, filepath, import_metadata, place_holder_images, bl_materials,
+                                          update_materials=update_materials, material_updates=material_updates,
+                                          metrics=metrics):
+        pass
     return bl_materials
 
 
-def import_scene(data3d_objects, **kwargs):
-    """ Import the data3d file as a blender scene
+def iter_import_data3d_materials(data3d_objects, filepath, import_metadata, place_holder_images, bl_materials,
+                                 update_materials=False, material_updates=None, metrics=None):
+    """ Import the materials step by step, see import_data3d_materials. The images are preloaded in one step,
+        then each material is a step.
+        Args:
+            data3d_objects ('dict') - The data3d_objects and materials to import.
+            filepath ('str') - The file path to the source file.
+            import_metadata ('str') - Import Archilogic json-material as blender-material metadata.
+                                      Enum {'NONE', 'BASIC', 'ADVANCED' }
+            place_holder_images ('bool') - Import place-holder images if source is not available.
+            bl_materials ('dict') - Filled with the hashed material keys and the corresponding Materials.
+        Kwargs:
+            update_materials ('bool') - Replace the materials imported earlier from the same source, if it changed.
+            material_updates ('list') - Collects the (outdated material, new material) pairs to replace later,
+                                        if None they are replaced right away.
+            metrics ('PerfMetrics') - The metrics to record the material timings into.
+        Yields:
+            done, total ('int', 'int') - The number of finished and total steps.
+    """
+    metrics = metrics or PerfMetrics()
+    material_utils.setup()
+    al_hashed_materials, al_material_sources = hash_data3d_materials(data3d_objects, filepath, import_metadata)
+
+    # The materials of earlier imports by content hash and by source key
+    existing_materials = {}
+    source_materials = {}
+    for bl_material in D.materials:
+        if HASH_PROPERTY in bl_material:
+            existing_materials.setdefault(bl_material[HASH_PROPERTY], bl_material)
+            for source_key in bl_material.get(SOURCE_PROPERTY, '').splitlines():
+                source_materials[source_key] = bl_material
+
+    # Create the Blender Materials
+    replace_now = material_updates is None
+    if replace_now:
+        material_updates = []
+    working_dir = os.path.dirname(filepath)
+    total = len(al_hashed_materials) + 1
+    new_materials = [al_hashed_materials[key] for key in al_hashed_materials if key not in existing_materials]
+    with metrics.phase('preload_images'):
+        images = material_utils.preload_images(new_materials, working_dir, place_holder_image=place_holder_images)
+    yield 1, total
+
+    for i, key in enumerate(al_hashed_materials):
+        t_material = time.perf_counter()
+        if key in existing_materials:
+            mat = Material(key, al_hashed_materials[key], import_metadata, working_dir, place_holder_images,
+                           bl_material=existing_materials[key])
+        else:
+            mat = Material(key, al_hashed_materials[key], import_metadata, working_dir, place_holder_images, images=images)
+            if update_materials:
+                outdated = get_outdated_materials(mat.bl_material, al_material_sources[key], source_materials,
+                                                  al_hashed_materials)
+                material_updates.extend((old_material, mat.bl_material) for old_material in outdated)
+
+        sources = mat.bl_material.get(SOURCE_PROPERTY, '').splitlines()
+        sources.extend(source_key for source_key in al_material_sources[key] if source_key not in sources)
+        mat.bl_material[SOURCE_PROPERTY] = '\n'.join(sources)
+        bl_materials[key] = mat
+        metrics.add_material(mat.bl_material.name, time.perf_counter() - t_material, reused=key in existing_materials)
+        yield i + 2, total
+
+    if replace_now:
+        replace_materials(material_updates)
+    log.debug('Reused %d of %d materials', len(al_hashed_materials) - len(new_materials), len(al_hashed_materials))
+
+
+def get_outdated_materials(bl_material, source_keys, source_materials, al_hashed_materials):
+    """ Get the outdated materials of the same source as the new material.
+        Args:
+            bl_material ('bpy.types.Material') - The new material.
+            source_keys ('list(str)') - The source keys of the new material.
+            source_materials ('dict') - The source keys -> materials of earlier imports, the outdated are removed.
+            al_hashed_materials ('dict') - The content hashes of this import, materials with these hashes are kept.
+        Returns:
+            outdated ('list(bpy.types.Material)') - The materials to replace with the new material.
+    """
+    outdated = []
+    for source_key in source_keys:
+        old_material = source_materials.get(source_key)
+        if old_material is not None and old_material not in outdated and old_material != bl_material \
+                and old_material.get(HASH_PROPERTY) not in al_hashed_materials:
+            outdated.append(old_material)
+
+    for old_material in outdated:
+        for source_key in [key for key, material in source_materials.items() if material == old_material]:
+            del source_materials[source_key]
+    return outdated
+
+
+def replace_materials(material_updates):
+    """ Replace the outdated materials, their users are remapped. Called once the import succeeded, so a failed
+        import leaves the earlier materials untouched.
+        Args:
+            material_updates ('list(tuple)') - The (outdated material, new material) pairs.
+    """
+    for old_material, bl_material in material_updates:
+        name = old_material.name
+        old_material.user_remap(bl_material)
+        D.materials.remove(old_material)
+        # The updated material takes over the name
+        bl_material.name = name
+        log.debug('Updated material %s', name)
+
+
+def iter_import_scene(data3d_objects, **kwargs):
+    """ Import the data3d file as a blender scene, step by step.
         Args:
             data3d_objects ('Data3dObject') - The deserialized data3d objects.
         Kwargs:
@@ -118,6 +266,25 @@ def import_scene(data3d_objects, **kwargs):
             smooth_split_normals ('bool') - Auto-smooth custom split vertex normals.
             import_place_holder_images ('bool') - Import place-holder images if source is not available.
             global_matrix ('Matrix') - The global orientation matrix to apply.
+            metrics ('PerfMetrics') - The metrics to record the import phases, nodes and meshes into.
+            lod_mode ('str') - Simplify the meshes while decoding. Enum {'FULL', 'RATIO', 'BUDGET'}
+            lod_ratio ('float') - The fraction of triangles to keep (RATIO).
+            lod_triangle_budget ('int') - The maximum number of triangles (BUDGET).
+            lod_scope ('str') - Apply the triangle budget to the whole scene or to each product. Enum {'SCENE', 'PRODUCT'}
+            lod_product_ratios ('dict') - The productResourceId -> ratio, overrides the ratio of these products.
+            import_proxies ('bool') - Import a bounding box proxy per mesh instead of the geometry.
+            instance_products ('bool') - Build each product (productResourceId) once into a collection and place
+                          collection instances.
+            update_materials ('bool') - Replace the materials of earlier imports of the same source that changed.
+            use_product_cache ('bool') - Append the products from the product cache, write new products to it.
+                          Products are instanced.
+            product_cache_dir ('str') - The product cache directory, defaults to the temporary directory.
+            product_cache_size ('int') - The product cache size in bytes, least recently used products are evicted.
+            proxy_objects ('dict') - The (data3d object, mesh key) -> proxy object. Only the geometry of these meshes
+                          is loaded into the existing proxies, no objects are created.
+        Yields:
+            done, total ('float', 'int') - The number of finished and total steps (materials, meshes, nodes,
+                          hierarchy), the material steps count as a fraction of one step.
     """
 
     filepath = kwargs['filepath']
@@ -127,47 +294,200 @@ def import_scene(data3d_objects, **kwargs):
     smooth_split_normals = kwargs['smooth_split_normals']
     place_holder_images = kwargs['import_place_holder_images']
     import_al_metadata = kwargs['import_al_metadata']
+    metrics = kwargs.get('metrics') or PerfMetrics()
+    lod_mode = kwargs.get('lod_mode', 'FULL')
+    lod_ratio = kwargs.get('lod_ratio', 1.0)
+    lod_triangle_budget = kwargs.get('lod_triangle_budget', 0)
+    lod_scope = kwargs.get('lod_scope', 'SCENE')
+    lod_product_ratios = kwargs.get('lod_product_ratios') or {}
+    import_proxies = kwargs.get('import_proxies', False)
+    proxy_objects = kwargs.get('proxy_objects')
+    use_product_cache = kwargs.get('use_product_cache', False)
+    product_cache_dir = kwargs.get('product_cache_dir')
+    product_cache_size = kwargs.get('product_cache_size', cache_utils.DEFAULT_CACHE_SIZE)
+    instance_products = kwargs.get('instance_products', False) or use_product_cache
+    update_materials = kwargs.get('update_materials', False)
+    # The product keys -> collections of the products that are built or appended from the product cache
+    product_collections = {}
+    # The product keys -> product hashes of the products that are missing in the product cache
+    product_hashes = {}
+    # The data3d objects -> content hashes of their mesh structure (without the payload offsets)
+    mesh_structure_hashes = {}
+    # The content hashes -> meshes of this and earlier imports
+    mesh_index = {}
+    # The meshes created by this import or checked against their geometry hash
+    verified_meshes = set()
+
+    def get_lod_ratios(data3d_objects):
+        """ Get the fraction of triangles to keep for each data3d object. The triangle counts are read from the
+            structure, so the ratios are known before any payload is decoded.
+            Args:
+                data3d_objects ('list(Data3dObject)') - The deserialized data3d objects.
+            Returns:
+                lod_ratios ('dict') - The data3d objects -> ratio, objects that are not simplified are missing.
+        """
+        def get_product_key(d3d_obj):
+            # Nodes below a product belong to the product
+            node = d3d_obj
+            while node is not None:
+                if node.get_product_id():
+                    return node.get_product_id()
+                node = node.parent
+            return d3d_obj
+
+        product_keys = {d3d_obj: get_product_key(d3d_obj) for d3d_obj in data3d_objects}
+        ratios = {}
+        if lod_mode == 'RATIO':
+            ratios = {key: lod_ratio for key in product_keys.values()}
+        elif lod_mode == 'BUDGET' and lod_triangle_budget > 0:
+            triangle_counts = {}
+            for d3d_obj, key in product_keys.items():
+                triangle_counts[key] = triangle_counts.get(key, 0) + d3d_obj.get_triangle_count()
+            if lod_scope == 'PRODUCT':
+                ratios = {key: lod_triangle_budget / count for key, count in triangle_counts.items() if count}
+            else:
+                scene_count = sum(triangle_counts.values())
+                ratios = {key: lod_triangle_budget / scene_count for key in triangle_counts} if scene_count else {}
+        for key, ratio in lod_product_ratios.items():
+            ratios[key] = ratio
+
+        lod_ratios = {}
+        for d3d_obj, key in product_keys.items():
+            ratio = ratios.get(key, 1.0)
+            if ratio < 1.0:
+                lod_ratios[d3d_obj] = max(ratio, 0.0)
+        return lod_ratios
+
+    def decimate_part(part, ratio):
+        """ Simplify the mesh part to the fraction of its triangles, the loop attributes follow the kept loops.
+            Args:
+                part ('dict') - The loop ordered mesh part.
+                ratio ('float') - The fraction of triangles to keep.
+            Returns:
+                part ('dict') - The simplified mesh part.
+        """
+        triangle_count = len(part['positions']) // 3
+        loop_indices, positions = decimate_triangles(part['positions'], triangle_count * ratio)
+        if loop_indices is None:
+            return part
+
+        if len(loop_indices) == 0:
+            # No triangle is left within the budget, the bounding box stands in for the mesh
+            part['positions'], part['normals'] = bounding_box_triangles(part['positions'])
+            for key in ('uvs', 'uvs2'):
+                if part[key] is not None:
+                    part[key] = np.zeros((len(part['positions']), 2), dtype=np.float32)
+            metrics.count('lod_bounding_boxes', 1)
+        else:
+            part['positions'] = positions
+            for key in ('normals', 'uvs', 'uvs2'):
+                if part[key] is not None:
+                    part[key] = part[key][loop_indices]
+        metrics.count('triangles_decimated', triangle_count - len(part['positions']) // 3)
+        return part
+
+    def get_mesh_part(data):
+        """ Convert the json mesh data to a triangle soup in loop order and apply the mesh transform.
+            Args:
+                data ('dict') - The json mesh data: vertices, normals, coordinates, faces and material references.
+            Returns:
+                part ('dict') - The flat (loop ordered) positions, normals, uvs and uvs2 arrays.
+        """
+        # Flat float arrays (3 floats per location & normal, 2 floats per uv)
+        verts_loc = np.asarray(data['verts_loc_raw'], dtype=np.float32).reshape(-1, 3)
+        verts_nor = np.asarray(data['verts_nor'], dtype=np.float32).reshape(-1, 3)
+
+        # All faces are trigons, for triangle soup the loops are in vertex order. Only split meshes (double sided)
+        # select their faces.
+        loops_vert_idx = np.array(data['face_indices'], dtype=np.int32).reshape(-1) if 'face_indices' in data else slice(None)
+
+        part = {
+            'name': data['name'],
+            'positions': verts_loc[loops_vert_idx],
+            'normals': verts_nor[loops_vert_idx],
+            'uvs': None,
+            'uvs2': None
+        }
+        if 'verts_uvs' in data and len(data['verts_uvs']):
+            part['uvs'] = np.asarray(data['verts_uvs'], dtype=np.float32).reshape(-1, 2)[loops_vert_idx]
+        if 'verts_uvs2' in data and len(data['verts_uvs2']):
+            part['uvs2'] = np.asarray(data['verts_uvs2'], dtype=np.float32).reshape(-1, 2)[loops_vert_idx]
+        if D3D.m_id in data:
+            part[D3D.m_id] = data[D3D.m_id]
 
-    perf_times = {}
-
+        # apply scale, position, rotation if necessary
+        rotation = data['rotation']
+        position = data['position']
+        scale = data['scale']
+        if scale != [1,]*3 or rotation != [0,]*3 or position != [0, ]*3:
+            # create matrix for scale, rotation, position
+            mat_sca = mathutils.Matrix([(scale[0],0,0,0), (0,scale[1],0,0), (0,0,scale[2],0), (0,0,0,1)])
+            mat_rot = mathutils.Euler(rotation).to_matrix().to_4x4()
+            mat_pos = mathutils.Matrix.Translation(position)
+            mat = np.array(mat_pos @ mat_rot @ mat_sca, dtype=np.float32)
+            # Normals are transformed with the inverse transpose to stay perpendicular for non-uniform scale
+            nor_mat = np.linalg.inv(mat[:3, :3]).T
+            part['positions'] = part['positions'] @ mat[:3, :3].T + mat[:3, 3]
+            normals = part['normals'] @ nor_mat.T
+            lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+            part['normals'] = normals / np.where(lengths > 0.0, lengths, 1.0)
+
+        return part
+
+    def merge_mesh_parts(parts):
+        """ Concatenate the mesh parts into one part, the material of each part is kept as material index.
+            Args:
+                parts ('list(dict)') - The mesh parts with their materials.
+            Returns:
+                merged ('dict') - The merged mesh part.
+        """
+        if len(parts) == 1:
+            return parts[0]
+
+        materials = []
+        material_indices = []
+        for part in parts:
+            if part['material'] not in materials:
+                materials.append(part['material'])
+            material_indices.append(np.full(len(part['positions']) // 3, materials.index(part['material']), dtype=np.int32))
+
+        def concat(key, width):
+            # Parts without the layer are filled with zeros, like join does for missing uv layers
+            if all(part[key] is None for part in parts):
+                return None
+            return np.concatenate([part[key] if part[key] is not None else np.zeros((len(part['positions']), width), dtype=np.float32)
+                                   for part in parts])
+
+        merged = {
+            'name': parts[0]['name'],
+            'positions': np.concatenate([part['positions'] for part in parts]),
+            'normals': np.concatenate([part['normals'] for part in parts]),
+            'uvs': concat('uvs', 2),
+            'uvs2': concat('uvs2', 2),
+            'materials': materials,
+            'material_indices': np.concatenate(material_indices),
+            'bake_meta': parts[0]['bake_meta']
+        }
+        if D3D.m_id in parts[0]:
+            merged[D3D.m_id] = parts[0][D3D.m_id]
+        return merged
 
     def create_mesh(data):
         """
         Takes all the data gathered and generates a mesh, deals with custom normals and applies materials.
         Args:
-            data ('dict') - The json mesh data: vertices, normals, coordinates, faces and material references.
+            data ('dict') - The mesh part: loop ordered positions, normals, uvs and the materials.
         Returns:
-            me ('bpy.types.')
+            me ('bpy.types.Mesh') - The created mesh.
         """
-        # FIXME Renaming for readability and clarity
-        verts_loc = data['verts_loc_raw']
-        verts_nor = data['verts_nor']
-        verts_uvs = data['verts_uvs'] if 'verts_uvs' in data else []
-        verts_uvs2 = data['verts_uvs2'] if 'verts_uvs2' in data else []
-
-        rotation = data['rotation']
-        position = data['position']
-        scale = data['scale']
-
-        face_indices = data['face_indices']
+        positions = data['positions']
+        total_loops = len(positions)
+        total_faces = total_loops // 3
 
-        total_loops = len(face_indices)*3
-
-        loops_vert_idx = []
-        faces_loop_start = []
-        faces_loop_total = [] # we can assume that, since all faces are trigons
-        l_idx = 0 #loop index = ?? count for assigning loop start index to face
-
-        # FIXME Document properly in the wiki and maybe also for external publishing
-        # FIXME simplify fixed values
-        for v_idx in face_indices:
-            nbr_vidx = 3 # len(v_idx) Vertices count per face (Always 3 (all faces are trigons))
-
-            loops_vert_idx.extend(v_idx) # Append all vert idx to loops vert idx
-            faces_loop_start.append(l_idx)
-
-            faces_loop_total.append(nbr_vidx) # (list of [3, 3, 3 ... ] vertex idc count per face)
-            l_idx += nbr_vidx # Add the count to the total count to get the loop_start for the next face
+        # All faces are trigons of a triangle soup: loop i uses vertex i, every face starts at a multiple of 3.
+        loops_vert_idx = np.arange(total_loops, dtype=np.int32)
+        faces_loop_start = np.arange(0, total_loops, 3, dtype=np.int32)
+        faces_loop_total = np.full(total_faces, 3, dtype=np.int32)
 
         # Create a new mesh
         me = bpy.data.meshes.new(data['name'])
@@ -175,138 +495,423 @@ def import_scene(data3d_objects, **kwargs):
         if D3D.m_id in data:
             me[D3D.m_id] = data[D3D.m_id]
         # Add new empty vertices and polygons to the mesh
-        me.vertices.add(len(verts_loc)/3)
+        me.vertices.add(total_loops)
         me.loops.add(total_loops)
-        me.polygons.add(len(face_indices))
+        me.polygons.add(total_faces)
 
-        me.vertices.foreach_set('co', verts_loc)
+        me.vertices.foreach_set('co', positions.reshape(-1))
         me.loops.foreach_set('vertex_index', loops_vert_idx)
         me.polygons.foreach_set('loop_start', faces_loop_start)
         me.polygons.foreach_set('loop_total', faces_loop_total)
 
+        for material in data['materials']:
+            me.materials.append(material)
+        if data.get('material_indices') is not None:
+            me.polygons.foreach_set('material_index', data['material_indices'])
+
         # Empty split vertex normals
         # Research: uvs not correct if split normals are set below blen_layer
         # Note: we store 'temp' normals in loops, since validate() may alter final mesh,
         #       we can only set custom loop_nors *after* calling it.
         me.create_normals_split()
 
-        if verts_uvs:
-            me.uv_layers.new(name='UVMap')
-            blen_uvs = me.uv_layers['UVMap']
-
-        if verts_uvs2:
-            me.uv_layers.new(name='UVLightmap')
-            blen_uvs2 = me.uv_layers['UVLightmap']
+        # The attributes are in loop order, set them in one call per attribute
+        me.loops.foreach_set('normal', data['normals'].reshape(-1))
 
-        # Loop trough tuples of corresponding face / polygon
-        for i, (face_vert_indices, blen_poly) in enumerate(zip(face_indices, me.polygons)):
+        if data['uvs'] is not None:
+            blen_uvs = me.uv_layers.new(name='UVMap')
+            blen_uvs.data.foreach_set('uv', data['uvs'].reshape(-1))
 
-            for face_idx, loop_idx in zip(face_vert_indices, blen_poly.loop_indices):
-                # FIXME Understand ... ellipsis (verts_nor[0 if (face_noidx is ...) else face_noidx])
-                me.loops[loop_idx].normal[:] = verts_nor[face_idx]
-
-                if verts_uvs:
-                    blen_uvs.data[loop_idx].uv = verts_uvs[face_idx]
-                if verts_uvs2:
-                    blen_uvs2.data[loop_idx].uv = verts_uvs2[face_idx]
+        if data['uvs2'] is not None:
+            blen_uvs2 = me.uv_layers.new(name='UVLightmap')
+            blen_uvs2.data.foreach_set('uv', data['uvs2'].reshape(-1))
 
         me.validate(clean_customdata=False)
 
-        # apply scale, position, rotation if necessary
-        if scale != [1,]*3 or rotation != [0,]*3 or position != [0, ]*3:
-            # create matrix for scale, rotation, position
-            mat_sca = mathutils.Matrix([(scale[0],0,0,0), (0,scale[1],0,0), (0,0,scale[2],0), (0,0,0,1)])
-            mat_rot = mathutils.Euler(rotation).to_matrix().to_4x4()
-            mat_pos = mathutils.Matrix.Translation(position)
-            mat = mat_pos @ mat_rot @ mat_sca
-            # apply matrix to mesh
-            me.transform(mat)
-
         me.update()
 
-        # Custom loop normals
-        cl_nors = array.array('f', [0.0] * (len(me.loops) * 3))
-        me.loops.foreach_get('normal', cl_nors)
-
         # Use smooth detects sharp edges from smooth ones
         # imported normals vary by small angles because of rounding errors.
         if smooth_split_normals:
+            # Custom loop normals: the decoded normals are still in loop order unless validate() removed geometry,
+            # only then the 'temp' normals are read back from the remaining loops.
+            if len(me.loops) == total_loops:
+                cl_nors = data['normals']
+            else:
+                cl_nors = np.empty((len(me.loops), 3), dtype=np.float32)
+                me.loops.foreach_get('normal', cl_nors.reshape(-1))
+
             # Set use_smooth -> actually this automatically calculates the median between two custom normals
-            me.polygons.foreach_set('use_smooth', [True] * len(me.polygons))
+            me.polygons.foreach_set('use_smooth', np.ones(len(me.polygons), dtype=bool))
 
-            nor_split_set = tuple(zip(*(iter(cl_nors),) * 3))
-            me.normals_split_custom_set(nor_split_set) # float array of 3 items in [-1, 1]
+            me.normals_split_custom_set(cl_nors) # (n, 3) float array in [-1, 1]
             me.use_auto_smooth = True
         
         me.update()
 
         return me
 
-    def create_objects(d3d_obj):
-        mesh_keys = list(d3d_obj.mesh_references.keys())
-        bl_meshes = []
+    def get_mesh_hash(part):
+        """ Hash the geometry, materials and the settings of the mesh part.
+            Args:
+                part ('dict') - The mesh part.
+            Returns:
+                _ ('str') - The content hash.
+        """
+        layers = [key for key in ('positions', 'normals', 'uvs', 'uvs2', 'material_indices') if part.get(key) is not None]
+        header = {'layers': layers,
+                  'materials': [material.get(HASH_PROPERTY, material.name) for material in part['materials']],
+                  D3D.m_id: part.get(D3D.m_id),
+                  'smooth_split_normals': smooth_split_normals}
+        return content_hash(header, *[part[key] for key in layers])
+
+    def get_geometry_hash(me):
+        """ Hash the vertex positions and the loop and polygon counts of the mesh.
+            Args:
+                me ('bpy.types.Mesh') - The mesh.
+            Returns:
+                _ ('str') - The content hash.
+        """
+        co = np.empty(len(me.vertices) * 3, dtype=np.float32)
+        me.vertices.foreach_get('co', co)
+        return content_hash(len(me.loops), len(me.polygons), co)
 
+    def is_unchanged(me):
+        """ Check if the mesh of an earlier import still has the geometry it was created with, the content hash of
+            edited meshes is outdated. The check is done once per mesh and import.
+            Args:
+                me ('bpy.types.Mesh') - The mesh.
+            Returns:
+                _ ('bool') - True if the mesh can be reused.
+        """
+        if me in verified_meshes:
+            return True
+        if GEOMETRY_PROPERTY not in me or me[GEOMETRY_PROPERTY] != get_geometry_hash(me):
+            # The content hash no longer describes the mesh
+            del me[HASH_PROPERTY]
+            metrics.count('meshes_outdated', 1)
+            return False
+        verified_meshes.add(me)
+        return True
+
+    def get_mesh(part):
+        """ Get the mesh of the part, an identical mesh of this or an earlier import is reused if it was not edited.
+            Args:
+                part ('dict') - The mesh part.
+            Returns:
+                me ('bpy.types.Mesh') - The mesh.
+        """
+        mesh_hash = get_mesh_hash(part)
+        me = mesh_index.get(mesh_hash)
+        if me is None or not is_unchanged(me):
+            me = create_mesh(part)
+            me[HASH_PROPERTY] = mesh_hash
+            me[GEOMETRY_PROPERTY] = get_geometry_hash(me)
+            mesh_index[mesh_hash] = me
+            verified_meshes.add(me)
+        else:
+            metrics.count('meshes_reused', 1)
+        return me
+
+    def get_mesh_material(d3d_obj, al_mesh):
+        """ Get the blender material and the bake metadata of the data3d mesh.
+            Args:
+                d3d_obj ('Data3dObject') - The data3d object of the mesh.
+                al_mesh ('dict') - The json mesh data.
+            Returns:
+                bl_material ('bpy.types.Material') - The material, None if no material is applied.
+                bake_meta ('dict') - The bake metadata of the material, None if not imported.
+        """
+        if not import_materials:
+            return None, None
+
+        # Apply the material to the mesh.
+        if D3D.m_material in al_mesh:
+            original_key = al_mesh[D3D.m_material]
+            mat_hash_map = d3d_obj.mat_hash_map
+            if original_key:
+                hashed_key = mat_hash_map[original_key] if original_key in mat_hash_map else ''
+                if hashed_key and hashed_key in bl_materials:
+                    mat = bl_materials[hashed_key]
+                    # FIXME import bake_meta even if materials are not imported
+                    bake_meta = mat.get_bake_nodes() if import_al_metadata == 'ADVANCED' else None
+                    return mat.bl_material, bake_meta
+                else:
+                    raise Exception('Material not found: ' + hashed_key)
+            return None, None
+        else:
+            if D3D.mat_default in D.materials:
+                return D.materials[D3D.mat_default], None
+            else:
+                return D.materials.new(D3D.mat_default), None
+
+    def create_object(name, part, collection=None):
+        """ Create the mesh of the part, add it to a new object and link the object to the scene.
+            Args:
+                name ('str') - The object name.
+                part ('dict') - The mesh part.
+            Kwargs:
+                collection ('bpy.types.Collection') - The collection to link the object to, defaults to the active one.
+            Returns:
+                ob ('bpy.types.Object') - The created object.
+        """
+        bl_mesh = get_mesh(part)
+        ob = D.objects.new(name, bl_mesh)
+        if D3D.m_id in bl_mesh:
+            ob[D3D.m_id] = bl_mesh[D3D.m_id]
+        if part['bake_meta'] is not None:
+            ob['bake_meta'] = part['bake_meta']
+        (collection or C.collection).objects.link(ob)
+        return ob
+
+    def get_product_key(d3d_obj):
+        """ Get the key of the product that can be instanced. Nodes with children are not instanced,
+            the same product with other materials or other meshes (mesh set, mesh transforms) is a different product.
+            Args:
+                d3d_obj ('Data3dObject') - The data3d object.
+            Returns:
+                _ ('tuple') - The product key, None if the node is not instanced.
+        """
         product_id = d3d_obj.get_product_id()
+        if not instance_products or not product_id or d3d_obj.children or import_proxies or proxy_objects is not None:
+            return None
+        if d3d_obj not in mesh_structure_hashes:
+            mesh_structure_hashes[d3d_obj] = content_hash(d3d_obj.get_mesh_structure())
+        return product_id, mesh_structure_hashes[d3d_obj], tuple(sorted(d3d_obj.mat_hash_map.items()))
 
-        for key in mesh_keys:
+    def get_cached_product(d3d_obj, product_key):
+        """ Append the product from the product cache.
+            Args:
+                d3d_obj ('Data3dObject') - The data3d object of the product.
+                product_key ('tuple') - The product key.
+            Returns:
+                collection ('bpy.types.Collection') - The cached product collection, None if it is not cached.
+                product_hash ('str') - The content hash of the product.
+        """
+        settings = {'import_materials': import_materials,
+                    'import_al_metadata': import_al_metadata,
+                    'smooth_split_normals': smooth_split_normals,
+                    'lod_ratio': lod_ratios.get(d3d_obj, 1.0)}
+        product_hash = cache_utils.get_product_hash(d3d_obj, settings)
+        collection = cache_utils.load_product(product_key[0], product_hash, cache_dir=product_cache_dir)
+        metrics.count('product_cache_hits' if collection else 'product_cache_misses', 1)
+        return collection, product_hash
+
+    def iter_load_cached_products(data3d_objects, cached_objects):
+        """ Append the products of the product cache before the materials are imported. The appended products
+            bring their materials, the materials of the products that hit the cache are not imported.
+            Args:
+                data3d_objects ('list(Data3dObject)') - The deserialized data3d objects.
+                cached_objects ('set(Data3dObject)') - Filled with the data3d objects placed from the product cache.
+            Yields:
+                After each product.
+        """
+        products = [d3d_obj for d3d_obj in data3d_objects if d3d_obj.get_product_id() and not d3d_obj.children]
+        # The product key contains the material hashes
+        hash_data3d_materials(products, filepath, import_al_metadata)
+        for d3d_obj in products:
+            product_key = get_product_key(d3d_obj)
+            if product_key in product_hashes:
+                continue
+            if product_key not in product_collections:
+                collection, product_hash = get_cached_product(d3d_obj, product_key)
+                yield
+                if collection is None:
+                    product_hashes[product_key] = product_hash
+                    continue
+                product_collections[product_key] = collection
+            cached_objects.add(d3d_obj)
+
+    def create_instance(name, collection):
+        """ Create an empty that instances the product collection and link it to the scene.
+            Args:
+                name ('str') - The object name.
+                collection ('bpy.types.Collection') - The product collection.
+            Returns:
+                ob ('bpy.types.Object') - The instance object.
+        """
+        ob = D.objects.new(name, None)
+        ob.instance_type = 'COLLECTION'
+        ob.instance_collection = collection
+        C.collection.objects.link(ob)
+        metrics.count('product_instances', 1)
+        return ob
+
+    def load_proxy(proxy, part):
+        """ Replace the box of the proxy with the mesh of the part, the proxy keeps its transform and parent.
+            Args:
+                proxy ('bpy.types.Object') - The bounding box proxy.
+                part ('dict') - The mesh part.
+        """
+        box = proxy.data
+        proxy.data = get_mesh(part)
+        if box.users == 0:
+            D.meshes.remove(box)
+        if D3D.m_id in proxy.data:
+            proxy[D3D.m_id] = proxy.data[D3D.m_id]
+        if part['bake_meta'] is not None:
+            proxy['bake_meta'] = part['bake_meta']
+        for key in PROXY_KEYS:
+            if key in proxy:
+                del proxy[key]
+        proxy.display_type = 'TEXTURED'
+
+    def iter_create_proxies(d3d_obj, node_index):
+        """ Create a bounding box proxy per mesh. Only the positions are decoded, the proxies store
+            where to find the mesh in the source file.
+            Args:
+                d3d_obj ('Data3dObject') - The data3d object.
+                node_index ('int') - The index of the data3d object in the deserialized file.
+            Yields:
+                _ ('int') - The number of meshes finished by the step, each mesh is a step.
+        """
+        product_id = d3d_obj.get_product_id()
+        for key, al_mesh in d3d_obj.mesh_references.items():
+            bounds = d3d_obj.get_mesh_bounds(key)
+            if bounds is None:
+                yield 1
+                continue
+            corners = [mathutils.Vector([bounds[(i >> (2 - axis)) & 1][axis] for axis in range(3)]) for i in range(8)]
+
+            scale = al_mesh.get(D3D.m_scale, [1, 1, 1])
+            mat = mathutils.Matrix.Translation(al_mesh.get(D3D.m_position, [0, 0, 0])) @ \
+                mathutils.Euler(al_mesh.get(D3D.m_rotation, [0, 0, 0])).to_matrix().to_4x4() @ \
+                mathutils.Matrix([(scale[0], 0, 0, 0), (0, scale[1], 0, 0), (0, 0, scale[2], 0), (0, 0, 0, 1)])
+            # The box of the transformed corners, axis aligned in node space
+            points = [mat @ corner for corner in corners]
+            bb_min = [min(p[axis] for p in points) for axis in range(3)]
+            bb_max = [max(p[axis] for p in points) for axis in range(3)]
+            verts = [[(bb_min, bb_max)[(i >> (2 - axis)) & 1][axis] for axis in range(3)] for i in range(8)]
+
+            me = D.meshes.new(key)
+            me.from_pydata(verts, [], BOX_FACES)
+            ob = D.objects.new(product_id if product_id else key, me)
+            ob[PROXY_SOURCE] = filepath
+            ob[PROXY_NODE_ID] = d3d_obj.node_id
+            ob[PROXY_NODE_INDEX] = node_index
+            ob[PROXY_MESH_KEY] = key
+            ob.display_type = 'WIRE'
+            C.collection.objects.link(ob)
+            d3d_obj.set_bl_object(ob)
+            metrics.count('proxies', 1)
+            yield 1
+
+    def add_mesh_metrics(part, d3d_obj, seconds):
+        """ Record the timing of the mesh: the decoding, the simplification and material lookup of the part and
+            the time to create its mesh and object.
+            Args:
+                part ('dict') - The mesh part.
+                d3d_obj ('Data3dObject') - The data3d object of the mesh.
+                seconds ('float') - The time spent on creating the mesh.
+        """
+        metrics.add_mesh(part['name'],
+                         part['seconds'] + seconds,
+                         triangles=len(part['positions']) // 3,
+                         vertices=len(part['positions']),
+                         node_id=d3d_obj.node_id,
+                         material=part['material_key'])
+
+    def get_mesh_keys(d3d_obj):
+        """ Get the keys of the meshes to import, only the proxied meshes if proxies are loaded.
+            Args:
+                d3d_obj ('Data3dObject') - The data3d object.
+            Returns:
+                mesh_keys ('list(str)') - The mesh keys.
+        """
+        mesh_keys = list(d3d_obj.mesh_references.keys())
+        if proxy_objects is not None:
+            mesh_keys = [key for key in mesh_keys if (d3d_obj, key) in proxy_objects]
+        return mesh_keys
+
+    def iter_create_objects(d3d_obj, node_index):
+        """ Create the objects of the data3d object step by step. Every decoded mesh and every created object is
+            a step, so a node with many meshes (all meshes of flat files are on the root) is sliced as well.
+            Args:
+                d3d_obj ('Data3dObject') - The data3d object.
+                node_index ('int') - The index of the data3d object in the deserialized file.
+            Yields:
+                _ ('int') - The number of meshes finished by the step.
+        """
+        mesh_keys = get_mesh_keys(d3d_obj)
+
+        product_id = d3d_obj.get_product_id()
+        product_key = get_product_key(d3d_obj)
+        product_collection = product_collections.get(product_key) if product_key else None
+        product_hash = product_hashes.get(product_key) if product_key else None
+
+        # Group the meshes by bake fingerprint, meshes with bake metadata are merged into one object per group.
+        fp_map = {}
+        # Proxies only decode the positions, the meshes are loaded on demand. Products that are built already
+        # are not decoded again.
+        for key in ([] if import_proxies or product_collection else mesh_keys):
             # mesh data for one mesh (can be two meshes if there is double sided data)
             al_meshes = d3d_obj.get_mesh_data(key)
 
             for al_mesh in al_meshes:
-                # Create mesh and add it to an object.
-                bl_mesh = create_mesh(al_mesh)
-                name = product_id if product_id else al_mesh['name']
-                ob = D.objects.new(name, bl_mesh)
-                if D3D.m_id in bl_mesh:
-                    ob[D3D.m_id] = bl_mesh[D3D.m_id]
-
-                if import_materials:
-                    # Apply the material to the mesh.
-                    if D3D.m_material in al_mesh:
-                        original_key = al_mesh[D3D.m_material]
-                        mat_hash_map = d3d_obj.mat_hash_map
-                        if original_key:
-                            hashed_key = mat_hash_map[original_key] if original_key in mat_hash_map else ''
-                            if hashed_key and hashed_key in bl_materials:
-                                mat = bl_materials[hashed_key]
-                                # FIXME import bake_meta even if materials are not imported
-                                if import_al_metadata == 'ADVANCED':
-                                    ob['bake_meta'] = mat.get_bake_nodes()
-                                ob.data.materials.append(mat.bl_material)
-                            else:
-                                raise Exception('Material not found: ' + hashed_key)
-                    else:
-                        if D3D.mat_default in D.materials:
-                            ob.data.materials.append(D.materials[D3D.mat_default])
-                        else:
-                            ob.data.materials.append(D.materials.new(D3D.mat_default))
-                # Link the object to the scene and clean it for further use.
-                C.collection.objects.link(ob)
-                bl_meshes.append(ob)
+                t_mesh = time.perf_counter()
+                part = get_mesh_part(al_mesh)
+                if d3d_obj in lod_ratios:
+                    part = decimate_part(part, lod_ratios[d3d_obj])
+                bl_material, bake_meta = get_mesh_material(d3d_obj, al_mesh)
+                part['materials'] = [bl_material] if bl_material else []
+                part['material'] = bl_material
+                part['bake_meta'] = bake_meta
+                part['material_key'] = al_mesh.get(D3D.m_material)
+                part['seconds'] = time.perf_counter() - t_mesh
+
+                if proxy_objects is not None:
+                    # Proxies are per mesh, the geometry is loaded without merging the bake groups
+                    t_mesh = time.perf_counter()
+                    load_proxy(proxy_objects[(d3d_obj, key)], part)
+                    add_mesh_metrics(part, d3d_obj, time.perf_counter() - t_mesh)
+                    continue
+
+                if bake_meta:
+                    a, b, c = bake_meta[D3D.add_lightmap], bake_meta[D3D.use_in_calc], bake_meta[D3D.hide_after_calc]
+                    fp = bake_meta['type'] + '_' + str(a) + str(b) + str(c)
+                else:
+                    fp = 'none'
+                if fp not in fp_map:
+                    fp_map[fp] = []
+                fp_map[fp].append(part)
 
             del al_meshes
-        
-        # WORKAROUND: we are joining all objects instead of joining generated mesh (bmesh module would support this)
-        if len(bl_meshes) > 0:
-            fp_map = {}
-            for me in bl_meshes:
-                if 'bake_meta' in me:
-                    a, b, c = me['bake_meta'][D3D.add_lightmap], me['bake_meta'][D3D.use_in_calc], me['bake_meta'][D3D.hide_after_calc]
-                    fp = me['bake_meta']['type'] + '_' + str(a) + str(b) + str(c)
-                    if fp not in fp_map:
-                        fp_map[fp] = []
-                    fp_map[fp].append(me)
-                else:
-                    if 'none' not in fp_map:
-                        fp_map['none'] = []
-                    fp_map['none'].append(me)
+            yield 1
+
+        if import_proxies:
+            yield from iter_create_proxies(d3d_obj, node_index)
 
-            for fp in fp_map.keys():
-                if 'bake_meta' in fp_map[fp][0]:
-                    fp_object = join_objects(fp_map[fp])
-                    fp_object.name = fp + '_' + d3d_obj.node_id
-                    apply_transform(fp_object, apply_location=True)
-                    d3d_obj.set_bl_object(fp_object)
+        elif product_collection:
+            d3d_obj.set_bl_object(create_instance(product_id, product_collection))
+
+        elif len(fp_map) > 0:
+            # A product is built once into its own collection, it is not linked to the scene
+            if product_key:
+                collection = D.collections.new(product_id)
+                product_collections[product_key] = collection
+            else:
+                collection = C.collection
+
+            bl_objects = []
+            for fp, parts in fp_map.items():
+                if fp == 'none':
+                    for part in parts:
+                        name = product_id if product_id else part['name']
+                        t_mesh = time.perf_counter()
+                        with metrics.phase('create_meshes'):
+                            bl_objects.append(create_object(name, part, collection))
+                        add_mesh_metrics(part, d3d_obj, time.perf_counter() - t_mesh)
+                        yield 0
+                else:
+                    t_mesh = time.perf_counter()
+                    with metrics.phase('create_meshes'):
+                        fp_object = create_object(fp + '_' + d3d_obj.node_id, merge_mesh_parts(parts), collection)
+                    # The merged mesh is created at once, its time is shared by the parts by their triangles
+                    seconds = time.perf_counter() - t_mesh
+                    loop_count = max(sum(len(part['positions']) for part in parts), 1)
+                    for part in parts:
+                        add_mesh_metrics(part, d3d_obj, seconds * len(part['positions']) / loop_count)
+                    bl_objects.append(fp_object)
 
                     o_type = fp_object['bake_meta']['type']
                     if o_type == 'EMISSION':
@@ -314,11 +919,18 @@ def import_scene(data3d_objects, **kwargs):
                         fp_object.cycles_visibility.shadow = False
                         fp_object.cycles_visibility.camera = False
                         fp_object.cycles_visibility.glossy = False
-                else:
-                    apply_transform(fp_map[fp])
-                    [d3d_obj.set_bl_object(obj) for obj in fp_map[fp]]
+                    yield 0
 
-        else:
+            if product_key:
+                if product_hash:
+                    cache_utils.save_product(collection, product_id, product_hash,
+                                             cache_dir=product_cache_dir, max_size=product_cache_size)
+                d3d_obj.set_bl_object(create_instance(product_id, collection))
+            else:
+                for bl_object in bl_objects:
+                    d3d_obj.set_bl_object(bl_object)
+
+        if not d3d_obj.bl_objects and proxy_objects is None:
             ob = D.objects.new('EMPTY_' + d3d_obj.node_id, None)
             C.collection.objects.link(ob)
             d3d_obj.set_bl_object(ob)
@@ -330,170 +942,287 @@ def import_scene(data3d_objects, **kwargs):
                 bl_object.location = d3d_obj.position
                 bl_object.rotation_euler = d3d_obj.rotation
             except TypeError:
-                return None
+                break
 
-
-    def join_objects(group):
-        """ Joins all objects of the group
+    def get_world_matrices(data3d_objects):
+        """ Compute the world matrix of every data3d object in one topological pass.
             Args:
-                group ('bpy_prop_collection') - Objects to be joined.
+                data3d_objects ('list(Data3dObject)') - The deserialized data3d objects.
             Returns:
-                joined_object ('bpy_types.Object') - The joined object.
-        """
-
-        # If there are objects in the object group, join them
-        if len(group) > 0:
-            select(group, discard_selection=True)
-
-            # Join them into the first object return the resulting object
-            C.view_layer.objects.active = group[0]
-            O.object.mode_set(mode='OBJECT')
-            joined = group[0]
-
-            if O.object:
-                O.object.join()
-            return joined
-
-        else:
-            log.debug('No objects to join.')
-            return None
-
-    def select(objects, discard_selection=True):
-        """ Select all objects in this group.
-            Args:
-                objects ('bpy_types.Object', 'bpy_prop_collection') - Object(s) to be selected
-            Kwargs:
-                discard_selection ('bool') - Discard original selection (Default=True)
+                world_matrices ('dict') - The data3d objects and their world matrices (global matrix applied).
         """
-        group = []
-        if hasattr(objects, '__iter__'):
-            group = objects
-        else:
-            group.append(objects)
-
-        if discard_selection:
-            O.object.select_all(action='DESELECT')
+        world_matrices = {}
+        for data3d_object in data3d_objects:
+            # Walk up to the first object with a known world matrix, then resolve the chain downwards
+            chain = []
+            node = data3d_object
+            while node is not None and node not in world_matrices:
+                chain.append(node)
+                node = node.parent
+            matrix = world_matrices[node] if node is not None else global_matrix
+            for node in reversed(chain):
+                try:
+                    local = mathutils.Matrix.Translation(node.position) @ mathutils.Euler(node.rotation).to_matrix().to_4x4()
+                except TypeError:
+                    # scene structure nodes without position
+                    local = mathutils.Matrix()
+                matrix = matrix @ local
+                world_matrices[node] = matrix
+        return world_matrices
 
-        for obj in group:
-            obj.select_set(True)
-            C.view_layer.objects.active = obj
+    try:
+        # A step per material, per mesh and per node, the steps stay short for files with all meshes on one node
+        total = sum(len(get_mesh_keys(d3d_obj)) for d3d_obj in data3d_objects) + len(data3d_objects) + 2
+        done = 0
+        lod_ratios = get_lod_ratios(data3d_objects) if lod_mode != 'FULL' or lod_product_ratios else {}
+        mesh_index.update({me[HASH_PROPERTY]: me for me in D.meshes if HASH_PROPERTY in me})
+
+        # Products of the product cache come with their materials
+        cached_objects = set()
+        if use_product_cache and not import_proxies and proxy_objects is None:
+            for _ in metrics.iter_phase('product_cache', iter_load_cached_products(data3d_objects, cached_objects)):
+                yield done, total
+
+        # Import mesh-materials, proxies have no materials (they are imported when the geometry is loaded)
+        bl_materials = {}
+        material_updates = []
+        if import_materials and not import_proxies:
+            material_objects = [d3d_obj for d3d_obj in data3d_objects if d3d_obj not in cached_objects]
+            material_steps = iter_import_data3d_materials(material_objects, filepath, import_al_metadata,
+                                                          place_holder_images, bl_materials,
+                                                          update_materials=update_materials,
+                                                          material_updates=material_updates, metrics=metrics)
+            for material_done, material_total in metrics.iter_phase('material_import', material_steps):
+                yield done + material_done / material_total, total
+        done += 1
+        yield done, total
+
+        for i, data3d_object in enumerate(data3d_objects):
+            # Import meshes as bl_objects
+            node_seconds = metrics.phases.get('create_objects', 0.0)
+            for mesh_done in metrics.iter_phase('create_objects', iter_create_objects(data3d_object, i)):
+                done += mesh_done
+                yield done, total
+            node_seconds = metrics.phases['create_objects'] - node_seconds
+            metrics.add_node(data3d_object.node_id, node_seconds, mesh_count=len(get_mesh_keys(data3d_object)))
+            done += 1
+            yield done, total
+
+        if proxy_objects is None and import_hierarchy:
+            with metrics.phase('make_parent'):
+                # Make parent - children relationships, the children keep their relative position and rotation
+                for data3d_object in data3d_objects:
+                    parent = data3d_object.parent
+                    if parent:
+                        parent_object = parent.bl_objects[0]
+                        for bl_object in data3d_object.bl_objects:
+                            bl_object.parent = parent_object
 
-    def apply_transform(objects, apply_location=False):
-        """ Prepare object for baking/export, apply transform
-            Args:
-                objects ('bpy_types.Object', 'bpy_prop_collection') - Object(s) to be normalised.
-            Kwargs:
-                apply_location ('boolean') - Apply location of the object.
-        """
-        group = []
+                    else:
+                        # Apply the global matrix to the root objects
+                        for bl_object in data3d_object.bl_objects:
+                            bl_object.matrix_world = global_matrix @ bl_object.matrix_basis
 
-        if hasattr(objects, '__iter__'):
-            for obj in objects:
-                if obj is None and obj.type != 'MESH':
-                    group.append(obj)
-        else:
-            group.append(objects)
+            for data3d_object in data3d_objects:
+                for bl_object in data3d_object.bl_objects:
+                    if bl_object.type == 'EMPTY' and bl_object.instance_type != 'COLLECTION' and not data3d_object.children:
+                        D.objects.remove(bl_object, do_unlink=True)
+
+        elif proxy_objects is None:
+            with metrics.phase('cleanup'):
+                # Flatten the hierarchy: the objects are never parented, they get their world matrix directly
+                world_matrices = get_world_matrices(data3d_objects)
+                for data3d_object in data3d_objects:
+                    world_matrix = world_matrices[data3d_object]
+                    for bl_object in data3d_object.bl_objects:
+                        if bl_object.type == 'EMPTY' and bl_object.instance_type != 'COLLECTION':
+                            D.objects.remove(bl_object, do_unlink=True)
+                        else:
+                            bl_object.matrix_world = world_matrix
 
-        select(group, discard_selection=True)
-        O.object.transform_apply(location=apply_location, rotation=True, scale=True)
+        # The outdated materials are only replaced once everything else is imported, a failed import keeps them
+        replace_materials(material_updates)
+        yield total, total
 
-    def create_all_objects(data3d_objects):
-        for data3d_object in data3d_objects:
-            # Import meshes as bl_objects
-            create_objects(data3d_object)
+    except GeneratorExit:
+        raise
+    except:
+        raise Exception('Import Scene failed. ', sys.exc_info())
 
 
-    try:
-        t0 = time.perf_counter()
+def import_scene(data3d_objects, **kwargs):
+    """ Import the data3d file as a blender scene
+        Args:
+            data3d_objects ('Data3dObject') - The deserialized data3d objects.
+        Kwargs:
+            See iter_import_scene.
+        Returns:
+            perf_times ('dict') - The seconds spent per import phase.
+    """
+    metrics = kwargs.get('metrics') or PerfMetrics()
+    kwargs['metrics'] = metrics
+    for _ in iter_import_scene(data3d_objects, **kwargs):
+        pass
+    return dict(metrics.phases)
 
-        # Import mesh-materials
-        bl_materials = {}
-        if import_materials:
-            bl_materials = import_data3d_materials(data3d_objects, filepath, import_al_metadata, place_holder_images)
-            perf_times['material_import'] = time.perf_counter() - t0
-        
-        t1 = time.perf_counter()
-        create_all_objects(data3d_objects)
-        
-        t2 = time.perf_counter()
-        perf_times['create_objects'] = t2 - t1
 
-        # Make parent - children relationships
-        bl_root_objects = []
-        for data3d_object in data3d_objects:
-            parent = data3d_object.parent
-            if parent:
-                parent_object = parent.bl_objects[0]
-                for bl_object in data3d_object.bl_objects:
-                    bl_object.parent = parent_object
+# The datablock types created by the import, removed again if the import fails or is cancelled
+DATABLOCK_TYPES = ('objects', 'meshes', 'materials', 'images', 'collections')
 
-            else:
-                bl_root_objects.extend(data3d_object.bl_objects)
 
-        t3 = time.perf_counter()
-        perf_times['make_parent'] = t3 - t2
+def get_datablock_snapshot():
+    """ Get the datablocks that exist before the import.
+        Returns:
+            _ ('dict') - The datablock type -> set of datablocks.
+    """
+    return {attr: set(getattr(D, attr)) for attr in DATABLOCK_TYPES}
 
-        # Apply the global matrix
-        apply_transform(bl_root_objects, apply_location=True)
-        for root_obj in bl_root_objects:
-            root_obj.matrix_world = global_matrix @ root_obj.matrix_world
 
-        if import_hierarchy:
-            for data3d_object in data3d_objects:
-                for bl_object in data3d_object.bl_objects:
-                    if bl_object.type == 'EMPTY' and not data3d_object.children:
-                        C.collection.objects.unlink(bl_object)
-                        D.objects.remove(bl_object)
+def remove_new_datablocks(snapshot):
+    """ Remove all datablocks that were created since the snapshot.
+        Args:
+            snapshot ('dict') - The snapshot taken before the import.
+    """
+    for attr in DATABLOCK_TYPES:
+        collection = getattr(D, attr)
+        new_datablocks = [datablock for datablock in collection if datablock not in snapshot[attr]]
+        for datablock in new_datablocks:
+            collection.remove(datablock)
+        log.debug('Removed %d %s', len(new_datablocks), attr)
 
-        else:
-            bl_objects = []
-            for d3d_obj in data3d_objects:
-                bl_objects.extend(d3d_obj.bl_objects)
 
-            # Clear the parent-child relationships, keep transform
-            # FIXME operation is really slow. find option to do this via datablock (parent_clear /transform_apply)
-            for bl_object in bl_objects:
-                select(bl_object, discard_selection=False)
-                O.object.parent_clear(type='CLEAR_KEEP_TRANSFORM')
+def create_metrics(metrics, data3d_objects):
+    """ Collect the decoding counters and log the import metrics.
+        Args:
+            metrics ('PerfMetrics') - The recorded import metrics.
+            data3d_objects ('list(Data3dObject)') - The imported data3d objects.
+        Returns:
+            report ('dict') - The metrics report.
+    """
+    metrics.count('nodes', len(data3d_objects))
+    metrics.count('bytes_decoded', sum(d3d_obj.bytes_decoded for d3d_obj in data3d_objects))
+    metrics.log_summary('Import Data3d successful.')
+    return metrics.to_dict()
 
-            apply_transform(bl_objects, apply_location=True)
 
-            for bl_object in bl_objects:
-                if bl_object.type == 'EMPTY':
-                    C.collection.objects.unlink(bl_object)
-                    D.objects.remove(bl_object)
+########
+# Main #
+########
 
-            t4 = time.perf_counter()
-            perf_times['cleanup'] = t4 - t3
 
-        return perf_times
+def prepare_args(args):
+    """ Configure the logger and complete the load arguments with their defaults.
+        Args:
+            args ('dict') - The load keyword arguments.
+        Returns:
+            args ('dict') - The completed keyword arguments.
+    """
+    if args.get('config_logger'):
+        logging.basicConfig(level='DEBUG', format='%(asctime)s %(levelname)-10s %(message)s', stream=sys.stdout)
 
-    except:
-        raise Exception('Import Scene failed. ', sys.exc_info())
+    log.info('Data3d import started, %s', args)
+    if args.get('metrics') is None:
+        args['metrics'] = PerfMetrics(trace_memory=args.get('trace_memory', False))
 
+    if 'global_matrix' not in args.keys() or args['global_matrix'] is None:
+        args['global_matrix'] = mathutils.Matrix()
+    return args
 
-def create_metrics(times):
-    log.info('\n\n{}'
-             '\n\nImport Data3d successful.'
-             '\n\n{}: Total'
-             '\n\n{}: Data Import'
-             '\n\n{}: Material import'
-             '\n\n{}: Create objects'
-             '\n\n{}: Make parent - children relationships'
-             '\n\n{}: Flatten hierarchy'
-             '\n\n{}\n\n'.format(60*'#',
-                                 '%.2f' % times['total'],
-                                 '%.2f' % times['deserialization'],
-                                 '%.2f' % times['material_import'] if 'material_import' in times else 'None',
-                                 '%.2f' % times['create_objects'],
-                                 '%.2f' % times['make_parent'],
-                                 '%.2f' % times['cleanup'] if 'cleanup' in times else 'None',
-                                 60*'#'))
 
+def finish_import(args, data3d_objects):
+    """ Update the view layer and report the import metrics.
+        Args:
+            args ('dict') - The load keyword arguments.
+            data3d_objects ('list(Data3dObject)') - The imported data3d objects.
+    """
+    metrics = args['metrics']
+    C.view_layer.update()
+    metrics.stop()
+    create_metrics(metrics, data3d_objects)
+    if args.get('metrics_report'):
+        metrics.write_report(args['filepath'])
+
+
+class ImportJob(object):
+    """ Time sliced import for the modal import operator. The file is deserialized on a worker thread,
+        the Blender datablocks are created on the main thread in time bounded steps.
+        Attributes:
+            args ('dict') - The load keyword arguments.
+            progress ('float') - The import progress in [0, 1].
+    """
 
-########
-# Main #
-########
+    def __init__(self, **args):
+        self.args = prepare_args(args)
+        self.progress = 0.0
+
+        self._snapshot = get_datablock_snapshot()
+        self._data3d_objects = None
+        self._error = None
+        self._steps = None
+        self._cancelled = False
+
+        self.args['metrics'].start()
+        input_file = self.args['filepath']
+        # The deserialization on the worker thread and the steps on the main thread are profiled, not the
+        # main thread in between the steps
+        self._profiler = Profiler(self.args.get('profile_mode', 'NONE'), input_file)
+        self._thread = threading.Thread(target=self._deserialize, args=(input_file, ), name='data3d-deserialize', daemon=True)
+        self._thread.start()
+
+    def _deserialize(self, input_file):
+        # Runs on the worker thread, no bpy access
+        with self._profiler.record():
+            self._deserialize_file(input_file)
+
+    def _deserialize_file(self, input_file):
+        try:
+            from_buffer = True if input_file.endswith('.data3d.buffer') else False
+            log.info('File format is buffer: %s', from_buffer)
+            with self.args['metrics'].phase('deserialization'):
+                self._data3d_objects = deserialize_data3d(input_file, from_buffer=from_buffer,
+                                                          lazy_payload=self.args.get('import_proxies', False))
+            self.args['metrics'].count('bytes_read', os.path.getsize(input_file))
+        except Exception as error:
+            self._error = error
+
+    def step(self, time_budget=0.05):
+        """ Continue the import for about the time budget.
+            Kwargs:
+                time_budget ('float') - The seconds to spend in this step.
+            Returns:
+                _ ('bool') - True if the import is finished.
+        """
+        if self._cancelled:
+            return True
+        if self._thread.is_alive():
+            return False
+        if self._error:
+            raise Exception('Data3d deserialization failed. ', self._error)
+
+        with self._profiler.record():
+            if self._steps is None:
+                self._steps = iter_import_scene(self._data3d_objects, **self.args)
+
+            t_end = time.perf_counter() + time_budget
+            for done, total in self._steps:
+                self.progress = done / total
+                if time.perf_counter() >= t_end:
+                    return False
+
+            finish_import(self.args, self._data3d_objects)
+        self._profiler.close()
+        return True
+
+    def cancel(self):
+        """ Stop the import and remove the datablocks created so far.
+        """
+        self._cancelled = True
+        self._profiler.close()
+        if self._steps is not None:
+            self._steps.close()
+        self.args['metrics'].stop()
+        remove_new_datablocks(self._snapshot)
+        log.info('Data3d import cancelled.')
 
 
 def load(**args):
@@ -507,38 +1236,110 @@ def load(**args):
             smooth_split_normals ('bool') - Auto-smooth custom split vertex normals.
             import_place_holder_images ('bool') - Import place-holder images if source is not available.
             global_matrix ('Matrix') - The global orientation matrix to apply.
+            lod_mode ('str') - Simplify the meshes while decoding. Enum {'FULL', 'RATIO', 'BUDGET'}
+            lod_ratio ('float') - The fraction of triangles to keep (RATIO).
+            lod_triangle_budget ('int') - The maximum number of triangles (BUDGET).
+            lod_scope ('str') - Apply the triangle budget to the whole scene or to each product. Enum {'SCENE', 'PRODUCT'}
+            lod_product_ratios ('dict') - The productResourceId -> ratio, overrides the ratio of these products.
+            import_proxies ('bool') - Import a bounding box proxy per mesh, load the geometry later with load_proxies.
+            instance_products ('bool') - Import each product once and place collection instances.
+            update_materials ('bool') - Update the materials of earlier imports of this file in place.
+            use_product_cache ('bool') - Reuse the products built in earlier sessions (implies instance_products).
+            product_cache_dir ('str') - The product cache directory, defaults to the temporary directory.
+            product_cache_size ('int') - The product cache size in bytes.
+            metrics ('PerfMetrics') - Record the import metrics into this instance, read them with to_dict().
+            metrics_report ('bool') - Write the metrics as json report next to the source file.
+            trace_memory ('bool') - Record the peak memory with tracemalloc (slows down the import).
+            profile_mode ('str') - Profile the import and write the profiles next to the source file.
+                          Enum {'NONE', 'CPROFILE', 'SAMPLING'}
     """
-    if args['config_logger']:
-        logging.basicConfig(level='DEBUG', format='%(asctime)s %(levelname)-10s %(message)s', stream=sys.stdout)
+    args = prepare_args(args)
+    metrics = args['metrics']
+    metrics.start()
 
-    log.info('Data3d import started, %s', args)
-    t0 = time.perf_counter()
+    snapshot = get_datablock_snapshot()
+    try:
+        # Import the file - Json dictionary
+        input_file = args['filepath']
+        from_buffer = True if input_file.endswith('.data3d.buffer') else False
+        log.info('File format is buffer: %s', from_buffer)
+        with profile(args.get('profile_mode', 'NONE'), input_file):
+            with metrics.phase('deserialization'):
+                # Proxies only need the structure and the position ranges of the payload
+                data3d_objects = deserialize_data3d(input_file, from_buffer=from_buffer,
+                                                    lazy_payload=args.get('import_proxies', False))
+            metrics.count('bytes_read', os.path.getsize(input_file))
 
-    if 'global_matrix' not in args.keys() or args['global_matrix'] is None:
-        args['global_matrix'] = mathutils.Matrix()
+            import_scene(data3d_objects, **args)
 
-    # FIXME try-except
-    # try:
-    # Import the file - Json dictionary
-    input_file = args['filepath']
-    from_buffer = True if input_file.endswith('.data3d.buffer') else False
-    log.info('File format is buffer: %s', from_buffer)
-    data3d_objects = deserialize_data3d(input_file, from_buffer=from_buffer)
+            finish_import(args, data3d_objects)
 
-    t1 = time.perf_counter()
+    except:
+        # Clean scene from created data-blocks
+        metrics.stop()
+        remove_new_datablocks(snapshot)
+        raise
+
+    return {'FINISHED'}
 
-    perf_times = import_scene(data3d_objects, **args)
 
-    C.view_layer.update()
+def get_proxy_objects(objects):
+    """ Filter the bounding box proxies.
+        Args:
+            objects ('iterable(bpy.types.Object)') - The objects to filter.
+        Returns:
+            _ ('list(bpy.types.Object)') - The proxies.
+    """
+    return [ob for ob in objects if PROXY_SOURCE in ob and ob.type == 'MESH']
 
-    t2 = time.perf_counter()
-    perf_times['deserialization'] = t1-t0
-    perf_times['total'] = t2-t0
-    create_metrics(perf_times)
 
-    return {'FINISHED'}
+def load_proxies(proxies, **args):
+    """ Replace the bounding box proxies with their geometry. Only the payload ranges of the proxied meshes are read.
+        Args:
+            proxies ('list(bpy.types.Object)') - The bounding box proxies.
+        Kwargs:
+            See load, the filepath is taken from the proxies.
+    """
+    sources = {}
+    for proxy in get_proxy_objects(proxies):
+        sources.setdefault(proxy[PROXY_SOURCE], []).append(proxy)
+
+    for input_file, source_proxies in sources.items():
+        if not os.path.isfile(input_file):
+            log.error('Proxy source not found: %s', input_file)
+            continue
+
+        file_args = prepare_args(dict(args, filepath=input_file, metrics=None))
+        metrics = file_args['metrics']
+        metrics.start()
+        snapshot = get_datablock_snapshot()
+        try:
+            from_buffer = True if input_file.endswith('.data3d.buffer') else False
+            with metrics.phase('deserialization'):
+                data3d_objects = deserialize_data3d(input_file, from_buffer=from_buffer, lazy_payload=True)
+            node_ids = {d3d_obj.node_id: d3d_obj for d3d_obj in data3d_objects}
+
+            proxy_objects = {}
+            for proxy in source_proxies:
+                # The node index resolves nodes with generated ids, the nodeId guards against a changed file
+                index = proxy[PROXY_NODE_INDEX]
+                d3d_obj = data3d_objects[index] if index < len(data3d_objects) else None
+                if d3d_obj is None or d3d_obj.node_id != proxy[PROXY_NODE_ID]:
+                    d3d_obj = node_ids.get(proxy[PROXY_NODE_ID], d3d_obj)
+                if d3d_obj is None or proxy[PROXY_MESH_KEY] not in d3d_obj.mesh_references:
+                    log.error('Proxy mesh not found: %s %s', proxy[PROXY_NODE_ID], proxy[PROXY_MESH_KEY])
+                    continue
+                proxy_objects[(d3d_obj, proxy[PROXY_MESH_KEY])] = proxy
+
+            # Only the proxied data3d objects are imported, in file order
+            proxied = {d3d_obj for d3d_obj, _ in proxy_objects}
+            import_scene([d3d_obj for d3d_obj in data3d_objects if d3d_obj in proxied],
+                         **dict(file_args, import_proxies=False, import_hierarchy=False, proxy_objects=proxy_objects))
+            finish_import(file_args, data3d_objects)
+
+        except:
+            metrics.stop()
+            remove_new_datablocks(snapshot)
+            raise
 
-    # except:
-    #     FIXME clean scene from created data-blocks
-    #     print('Data3d import failed: ', sys.exc_info())
-    #     return {'CANCELLED'}
+    return {'FINISHED'}
@@ -1,10 +1,13 @@
 import os
 import logging
+import hashlib
 
 import bpy
 from bpy_extras.image_utils import load_image
 
 from io_scene_data3d.data3d_utils import D3D
+from io_scene_data3d.texture_utils import get_texture_index, probe_images
+from io_scene_data3d.hash_utils import HASH_PROPERTY
 
 # Global Variables
 C = bpy.context
@@ -22,7 +25,7 @@ class Material:
             bl_material
     """
 
-    def __init__(self, key, al_material, import_metadata, working_dir, place_holder_images):
+    def __init__(self, key, al_material, import_metadata, working_dir, place_holder_images, images=None, bl_material=None):
         """ Return a Material object. Import data3d materials and translate them to Blender Internal & Cycles materials
         Args:
             key ('str') - The hashed material key. Used for naming the material.
@@ -31,16 +34,24 @@ class Material:
                                       Enum {'NONE', 'BASIC', 'ADVANCED' }
             working_dir ('str') - The source directory of the data3d file, used for recursive image search.
             place_holder_images ('bool') - Import place-holder images if source is not available.
+        Kwargs:
+            images ('dict') - The preloaded image datablocks by image key, see preload_images.
+            bl_material ('bpy.types.Material') - An existing material with the same content hash, reused as is.
         """
         self.al_material = al_material
         self.al_material_hash = key
         self.import_metadata = import_metadata
-        self.bl_material = D.materials.new(key)
         #Fixme: This is a workaround for #9620
         self.add_lead_slash()
 
+        if bl_material is not None:
+            self.bl_material = bl_material
+            return
+
         # Create Cycles Material
-        create_cycles_material(self.al_material, self.bl_material, working_dir, place_holder_images, import_metadata)
+        self.bl_material = create_cycles_material(key, self.al_material, working_dir, place_holder_images, import_metadata, images=images)
+        # The content hash identifies the material in later imports
+        self.bl_material[HASH_PROPERTY] = key
 
     def get_bake_nodes(self):
         add_lightmap = self.al_material[D3D.add_lightmap] if D3D.add_lightmap in self.al_material else True
@@ -113,130 +124,206 @@ d3d_to_node = {
     D3D.opacity: 'opacity',
 }
 
-def create_cycles_material(al_mat, bl_mat, working_dir, place_holder_images, import_metadata):
-    """ Create the cycles material
+# Prebuilt cycles materials, one per archetype (node group, texture maps). Imported materials copy a template and
+# only patch the input values and images. Maps the archetype key to the template material name.
+_material_templates = {}
+TEMPLATE_PREFIX = '.data3d-template'
+
+
+def get_material_archetype(al_mat, ref_maps, images):
+    """ Get the archetype of the material, materials of the same archetype share the node setup.
         Args:
             al_mat ('dict') - The data3d Material source.
-            bl_mat ('bpy.types.Material') - The Blender Material datablock.
-            working_dir ('str') - The source directory of the data3d file, used for recursive image search.
-            place_holder_images ('bool') - Import place-holder images if source is not available.
-            import_metadata ('str') - Import Archilogic json-material as blender-material metadata.
-                                      Enum {'NONE', 'BASIC', 'ADVANCED' }
+            ref_maps ('dict') - The reference maps of the material.
+            images ('dict') - The loaded image datablocks of the reference maps.
+        Returns:
+            _ ('tuple') - The archetype key: node group name, reference map keys, map keys with an image.
+    """
+    # Distinguish between tree different Material types.
+    # Adaptations to the nodes: node_library.blend file.
+    # Basic Material (diffuse & glossy Shader) supports standard maps, fallback on neutral inputs.
+    # Emission Material (emission & transparent shader) supports diffuse and alpha maps, diffuse color as emit color.
+    # Transparent Material (transparent Shader) supports alpha maps and opacity additional to the basic material.
+    opacity = al_mat[D3D.opacity] if D3D.opacity in al_mat else 1.0
+    emission = al_mat[D3D.coef_emit] if D3D.coef_emit in al_mat else 0.0
+    if emission > 0.0:
+        group_name = 'archilogic-emission'
+    elif D3D.map_alpha in al_mat or opacity < 1.0:
+        group_name = 'archilogic-transparency'
+    else:
+        # Add the corresponding Material node group ('archilogic-basic')
+        group_name = 'archilogic-basic'
+
+    return group_name, tuple(ref_maps.keys()), tuple(key for key in ref_maps if images.get(key))
+
+
+def get_material_template(archetype):
+    """ Get the template material of the archetype, build it if it does not exist (yet).
+        Args:
+            archetype ('tuple') - The archetype key.
+        Returns:
+            template ('bpy.types.Material') - The template material.
+    """
+    name = _material_templates.get(archetype)
+    if name and name in D.materials:
+        return D.materials[name]
+
+    template = build_material_template(TEMPLATE_PREFIX, *archetype)
+    _material_templates[archetype] = template.name
+    return template
+
+
+def build_material_template(name, group_name, ref_map_keys, image_map_keys):
+    """ Build a cycles material with the node setup of the archetype, images and input values are not set.
+        The nodes are named so they can be patched on the copies: 'group', 'output', 'uv_map', 'uv_scale',
+        'uv2_map' and the map key for the image texture nodes.
+        Args:
+            name ('str') - The material name.
+            group_name ('str') - The archilogic material node group.
+            ref_map_keys ('tuple(str)') - The reference map keys of the material.
+            image_map_keys ('tuple(str)') - The map keys with an image.
+        Returns:
+            bl_mat ('bpy.types.Material') - The template material.
     """
+    bl_mat = D.materials.new(name)
 
     # Override default material settings
     bl_mat.specular_intensity = 1
 
-    # Import Archilogic Material Datablock (FIXME check PropertyGroup)
-    if import_metadata == 'BASIC' or import_metadata == 'ADVANCED':
-        bl_mat[D3D.bl_meta] = al_mat
-
     # Setup Cycles Material and remove all nodes.
-    C.scene.render.engine = 'CYCLES'
     bl_mat.use_nodes = True
     node_tree = bl_mat.node_tree
     for node in node_tree.nodes:
         node_tree.nodes.remove(node)
 
-    # Material group node (The datablock is not yet assigned)
+    # Material group node
     node_group = node_tree.nodes.new('ShaderNodeGroup')
+    node_group.name = 'group'
     node_group.location = (0, 0)
+    node_group.node_tree = D.node_groups[group_name]
 
-    # Distinguish between tree different Material types.
-    # Adaptations to the nodes: node_library.blend file.
-    # Basic Material (diffuse & glossy Shader) supports standard maps, fallback on neutral inputs.
-    # Emission Material (emission & transparent shader) supports diffuse and alpha maps, diffuse color as emit color.
-    # Transparent Material (transparent Shader) supports alpha maps and opacity additional to the basic material.
-
-    opacity = al_mat[D3D.opacity] if D3D.opacity in al_mat else 1.0
-    emission = al_mat[D3D.coef_emit] if D3D.coef_emit in al_mat else 0.0
-    if emission > 0.0:
-        node_group.node_tree = D.node_groups['archilogic-emission']
-
-    elif D3D.map_alpha in al_mat or opacity < 1.0:
-        node_group.node_tree = D.node_groups['archilogic-transparency']
-
-    else:
-        # Add the corresponding Material node group ('archilogic-basic')
-        node_group.node_tree = D.node_groups['archilogic-basic']
-    
-    # bsdf_type used for material conversions for rendering
-    if D3D.bsdf_type in al_mat:
-        node_group.label = al_mat[D3D.bsdf_type]
-    
     # Material Output Node
     output_node = node_tree.nodes.new('ShaderNodeOutputMaterial')
+    output_node.name = 'output'
     output_node.location = (200, 0)
     # Link the group shader to the output_node
     node_tree.links.new(node_group.outputs['Shader'], output_node.inputs['Surface'])
 
-    # Textures
-    # Get the texture reference maps
-    ref_maps = get_reference_maps(al_mat)
-
     # UV Map and UV Scale node
-    uv_map_node = None
     uv2_map_node = None
     uv_scale_node = None
 
-    if ref_maps:
-        has_lightmap = D3D.map_light in ref_maps
+    if ref_map_keys:
+        has_lightmap = D3D.map_light in ref_map_keys
 
-        if has_lightmap is False or (has_lightmap and len(ref_maps) > 1):
+        if has_lightmap is False or (has_lightmap and len(ref_map_keys) > 1):
             uv_map_node = node_tree.nodes.new('ShaderNodeUVMap')
+            uv_map_node.name = 'uv_map'
             uv_map_node.uv_map = 'UVMap'
             uv_map_node.location = (-800, 0)
             uv_scale_node = node_tree.nodes.new('ShaderNodeMapping')
+            uv_scale_node.name = 'uv_scale'
             uv_scale_node.vector_type = 'TEXTURE'
-            if bpy.app.version >= (2, 81, 0):
-                uv_scale_node.inputs["Scale"].default_value = al_mat[D3D.uv_scale] + (1, ) if D3D.uv_scale in al_mat else (1, )*3
-            else:
-                uv_scale_node.scale = al_mat[D3D.uv_scale] + (1, ) if D3D.uv_scale in al_mat else (1, )*3
             uv_scale_node.location = (-600, 0)
             node_tree.links.new(uv_map_node.outputs['UV'], uv_scale_node.inputs['Vector'])
 
         if has_lightmap:
             uv2_map_node = node_tree.nodes.new('ShaderNodeUVMap')
+            uv2_map_node.name = 'uv2_map'
             uv2_map_node.uv_map = 'UVLightmap'
 
     # Create texture map nodes
     count = 0
+    for map_key in image_map_keys:
+        if d3d_to_node[map_key] in node_group.inputs:
+            count += 1
+            map_node = node_tree.nodes.new('ShaderNodeTexImage')
+            map_node.name = map_key
+            map_node.label = map_key
+            # Connect the nodes
+            if uv_scale_node:
+                node_tree.links.new(uv_scale_node.outputs['Vector'], map_node.inputs['Vector'])
+            node_tree.links.new(map_node.outputs['Color'], node_group.inputs[d3d_to_node[map_key]])
+            # Position the nodes
+            x = int(count / 2) * -300 if count % 2 else int(count / 2) * 300
+            map_node.location = (-200, x)
+
+        elif map_key == D3D.map_light:
+            map_node = node_tree.nodes.new('ShaderNodeTexImage')
+            map_node.name = map_key
+            map_node.label = map_key
+            emission_node = node_tree.nodes.new('ShaderNodeEmission')
+            add_shader_node = node_tree.nodes.new('ShaderNodeAddShader')
+
+            node_tree.links.new(uv2_map_node.outputs['UV'], map_node.inputs['Vector'])
+            node_tree.links.new(map_node.outputs['Color'], emission_node.inputs['Color'])
+            node_tree.links.new(map_node.outputs['Color'], emission_node.inputs['Strength'])
+            node_tree.links.new(node_group.outputs['Shader'], add_shader_node.inputs[0])
+            node_tree.links.new(emission_node.outputs['Emission'], add_shader_node.inputs[1])
+            node_tree.links.new(add_shader_node.outputs['Shader'], output_node.inputs['Surface'])
+
+            # Position the nodes
+            uv2_map_node.location = (-800, 600)
+            map_node.location = (-200, 600)
+            emission_node.location = (-0, 600)
+            add_shader_node.location = (200, 0)
+            output_node.location = (400, 0)
+
+    return bl_mat
+
+
+def create_cycles_material(key, al_mat, working_dir, place_holder_images, import_metadata, images=None):
+    """ Create the cycles material from the template of its archetype.
+        Args:
+            key ('str') - The hashed material key. Used for naming the material.
+            al_mat ('dict') - The data3d Material source.
+            working_dir ('str') - The source directory of the data3d file, used for recursive image search.
+            place_holder_images ('bool') - Import place-holder images if source is not available.
+            import_metadata ('str') - Import Archilogic json-material as blender-material metadata.
+                                      Enum {'NONE', 'BASIC', 'ADVANCED' }
+        Kwargs:
+            images ('dict') - The preloaded image datablocks by image key, images not in the dict are loaded.
+        Returns:
+            bl_mat ('bpy.types.Material') - The Blender Material datablock.
+    """
+    # Textures
+    # Get the texture reference maps and their images
+    ref_maps = get_reference_maps(al_mat)
+    preloaded = images or {}
+    images = {}
     for map_key in ref_maps:
-        image = get_image_datablock(ref_maps[map_key], working_dir, recursive=True, place_holder_image=place_holder_images)
-        if image:
-            if d3d_to_node[map_key] in node_group.inputs:
-                count += 1
-                map_node = node_tree.nodes.new('ShaderNodeTexImage')
-                map_node.image = image
-                map_node.label = map_key
-                # Connect the nodes
-                if uv_scale_node:
-                    node_tree.links.new(uv_scale_node.outputs['Vector'], map_node.inputs['Vector'])
-                node_tree.links.new(map_node.outputs['Color'], node_group.inputs[d3d_to_node[map_key]])
-                # Position the nodes
-                x = int(count / 2) * -300 if count % 2 else int(count / 2) * 300
-                map_node.location = (-200, x)
-
-            elif map_key is D3D.map_light:
-                map_node = node_tree.nodes.new('ShaderNodeTexImage')
-                map_node.image = image
-                map_node.label = map_key
-                emission_node = node_tree.nodes.new('ShaderNodeEmission')
-                add_shader_node = node_tree.nodes.new('ShaderNodeAddShader')
-
-                node_tree.links.new(uv2_map_node.outputs['UV'], map_node.inputs['Vector'])
-                node_tree.links.new(map_node.outputs['Color'], emission_node.inputs['Color'])
-                node_tree.links.new(map_node.outputs['Color'], emission_node.inputs['Strength'])
-                node_tree.links.new(node_group.outputs['Shader'], add_shader_node.inputs[0])
-                node_tree.links.new(emission_node.outputs['Emission'], add_shader_node.inputs[1])
-                node_tree.links.new(add_shader_node.outputs['Shader'], output_node.inputs['Surface'])
-
-                # Position the nodes
-                uv2_map_node.location = (-800, 600)
-                map_node.location = (-200, 600)
-                emission_node.location = (-0, 600)
-                add_shader_node.location = (200, 0)
-                output_node.location = (400, 0)
+        image_key = get_image_key(ref_maps[map_key])
+        if image_key in preloaded:
+            images[map_key] = preloaded[image_key]
+        else:
+            images[map_key] = get_image_datablock(ref_maps[map_key], working_dir, recursive=True, place_holder_image=place_holder_images)
+
+    bl_mat = get_material_template(get_material_archetype(al_mat, ref_maps, images)).copy()
+    bl_mat.name = key
+
+    # Import Archilogic Material Datablock (FIXME check PropertyGroup)
+    if import_metadata == 'BASIC' or import_metadata == 'ADVANCED':
+        bl_mat[D3D.bl_meta] = al_mat
+
+    nodes = bl_mat.node_tree.nodes
+    node_group = nodes['group']
+
+    # bsdf_type used for material conversions for rendering
+    if D3D.bsdf_type in al_mat:
+        node_group.label = al_mat[D3D.bsdf_type]
+
+    uv_scale_node = nodes.get('uv_scale')
+    if uv_scale_node:
+        scale = al_mat[D3D.uv_scale] + (1, ) if D3D.uv_scale in al_mat else (1, )*3
+        if bpy.app.version >= (2, 81, 0):
+            uv_scale_node.inputs["Scale"].default_value = scale
+        else:
+            uv_scale_node.scale = scale
+
+    for map_key, image in images.items():
+        map_node = nodes.get(map_key)
+        if image and map_node:
+            map_node.image = image
 
     def data3d_rgb_to_blender_rgb(color):
         def srgb_to_linearrgb(c):
@@ -269,6 +356,8 @@ def create_cycles_material(al_mat, bl_mat, working_dir, place_holder_images, imp
     if D3D.opacity in al_mat and d3d_to_node[D3D.opacity] in node_group.inputs:
         node_group.inputs[d3d_to_node[D3D.opacity]].default_value = al_mat[D3D.opacity]
 
+    return bl_mat
+
 
 def get_reference_maps(al_mat):
     """ Get all the texture maps and find the source image with the best quality.
@@ -294,20 +383,79 @@ def get_reference_maps(al_mat):
             ref_maps[map_key] = ref_map
     return ref_maps
 
+def get_image_key(image_relpath):
+    """ Get the key of the image path, with or without leading slash.
+        Args:
+            image_relpath ('str') - The relative path to the image.
+        Returns:
+            _ ('str') - The image key.
+    """
+    return image_relpath.strip('/')
+
+
+def preload_images(al_materials, image_directory, place_holder_image=True):
+    """ Resolve and verify the images of all materials up front and create the image datablocks in one batch.
+        The distinct images are probed concurrently (format, dimensions, truncated or corrupt files) and all issues
+        are reported at once. Blender loads the pixels lazily, on first use.
+        Args:
+            al_materials ('iterable(dict)') - The data3d Material sources.
+            image_directory ('str') - The parent directory.
+        Kwargs:
+            place_holder_image ('bool') - if True a new place holder image will be created for missing images.
+        Returns:
+            images ('dict') - The image keys -> image datablocks (None if the image could not be loaded).
+    """
+    image_directory = os.path.normpath(image_directory)
+    image_keys = set()
+    for al_mat in al_materials:
+        for ref_map in get_reference_maps(al_mat).values():
+            image_keys.add(get_image_key(ref_map))
+    if not image_keys:
+        return {}
+
+    # The images are looked up at their relative path, the index of the directory is only used for the misses
+    texture_index = get_texture_index(image_directory, new_import=True)
+    image_paths = {image_key: texture_index.resolve(image_key) for image_key in sorted(image_keys)}
+
+    probes = probe_images(set(path for path in image_paths.values() if path))
+
+    missing = sorted(key for key, path in image_paths.items() if not path)
+    invalid = sorted('%s (%s)' % (path, info['error']) for path, info in probes.items() if info['error'])
+    if missing:
+        log.warning('%d images not found in directory %s: %s', len(missing), image_directory, ', '.join(missing))
+    if invalid:
+        log.warning('%d images are invalid: %s', len(invalid), ', '.join(invalid))
+
+    images = {}
+    for image_key, image_path in image_paths.items():
+        if image_path:
+            img = load_image(image_path, place_holder=place_holder_image, check_existing=True)
+        else:
+            img = load_image(image_key, dirname=image_directory, place_holder=place_holder_image, check_existing=True)
+        if img:
+            img.use_fake_user = True
+        images[image_key] = img
+    return images
+
+
 def get_image_datablock(image_relpath, image_directory, recursive=False, place_holder_image=True):
     """ Load the image to blender, check if image has been loaded before.
         Args:
             image_relpath ('str') - The relative path to the image.
             image_directory ('str') - The parent directory.
         Kwargs:
-            recursive ('bool') - Use recursive image search.
+            recursive ('bool') - Search the image below the directory (indexed), if it is not found at the relative path.
             place_holder_image ('bool') - if True a new place holder image will be created.
         Returns:
             img ('bpy.types.Image') - The loaded image datablock.
     """
     # FIXME: make use image search optional
     image_directory = os.path.normpath(image_directory)
-    img = load_image(image_relpath.strip('/'), dirname=image_directory, place_holder=place_holder_image, recursive=recursive, check_existing=True)
+    image_path = get_texture_index(image_directory).resolve(image_relpath) if recursive else None
+    if image_path:
+        img = load_image(image_path, place_holder=place_holder_image, check_existing=True)
+    else:
+        img = load_image(image_relpath.strip('/'), dirname=image_directory, place_holder=place_holder_image, recursive=False, check_existing=True)
     if img is None:
         log.warning('Warning: Image could not be loaded: %s in directory %s ', image_relpath, image_directory)
         return None
@@ -315,17 +463,67 @@ def get_image_datablock(image_relpath, image_directory, recursive=False, place_h
     return img
 
 
-def import_material_node_groups():
-    """ Load the archilogic cycles material node groups from the node-library.blend file.
+NODE_LIBRARY_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'resources/node-library.blend')
+# The node groups loaded from the library are tagged with the library version
+NODE_LIBRARY_VERSION_KEY = 'data3d_library_version'
+MATERIAL_NODE_GROUPS = ('archilogic-basic', 'archilogic-emission', 'archilogic-transparency')
+
+# Session registry of the node library: its version and the names of the node groups it contains.
+_node_library = {'version': None, 'node_groups': MATERIAL_NODE_GROUPS}
+
+
+def get_node_library_version():
+    """ Get the version of the node-library.blend file, the content hash is computed once per session.
+        Returns:
+            _ ('str') - The library version.
+    """
+    if _node_library['version'] is None:
+        with open(NODE_LIBRARY_PATH, 'rb') as file:
+            _node_library['version'] = hashlib.sha1(file.read()).hexdigest()
+    return _node_library['version']
+
+
+def has_material_node_groups():
+    """ Check if all library node groups exist in the blend data and are up to date.
+        Returns:
+            _ ('bool') - True if the library does not need to be loaded.
     """
-    filepath = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'resources/node-library.blend')
+    version = get_node_library_version()
+    for name in _node_library['node_groups']:
+        node_group = D.node_groups.get(name)
+        if node_group is None or node_group.get(NODE_LIBRARY_VERSION_KEY) != version:
+            return False
+    return True
 
-    with bpy.data.libraries.load(filepath) as (data_from, data_to):
-        data_to.node_groups = data_from.node_groups
 
-    for node_group in data_to.node_groups:
-        log.debug('Importing material node group: %s', node_group.name)
+def import_material_node_groups():
+    """ Load the archilogic cycles material node groups from the node-library.blend file.
+        The library is only loaded if a node group is missing or outdated, outdated node groups are replaced
+        (their users are remapped) instead of being duplicated.
+        Returns:
+            _ ('bool') - True if the node groups were (re)loaded.
+    """
+    if has_material_node_groups():
+        log.debug('Material node groups are up to date.')
+        return False
+
+    version = get_node_library_version()
+    with bpy.data.libraries.load(NODE_LIBRARY_PATH) as (data_from, data_to):
+        names = list(data_from.node_groups)
+        data_to.node_groups = names
+
+    _node_library['node_groups'] = tuple(names)
+    for name, node_group in zip(names, data_to.node_groups):
+        log.debug('Importing material node group: %s', name)
+        # Name clashes with the existing (outdated) node group result in 'name.001', replace the old one.
+        existing = D.node_groups.get(name)
+        if existing is not None and existing != node_group:
+            existing.user_remap(node_group)
+            D.node_groups.remove(existing)
+            node_group.name = name
+        node_group[NODE_LIBRARY_VERSION_KEY] = version
         node_group.use_fake_user = True
+    return True
 
 
 def get_al_material(bl_mat, tex_subdir, from_metadata=False):
@@ -392,4 +590,7 @@ def setup():
     """
     # Import the Cycles material node groups from reference file
     log.info('Setting up material_utils.')
-    import_material_node_groups()
+    if import_material_node_groups():
+        # The node groups were reloaded, the templates have to be rebuilt
+        _material_templates.clear()
+    C.scene.render.engine = 'CYCLES'
@@ -0,0 +1,163 @@
+import logging
+
+import numpy as np
+
+__all__ = ['decimate_triangles', 'bounding_box_triangles']
+
+# Meshes with fewer triangles are never decimated, small details would collapse entirely.
+MIN_LOD_TRIANGLES = 12
+# The grid resolution range for the vertex clustering (cells along the longest bounding box axis).
+MIN_GRID_RESOLUTION = 1
+MAX_GRID_RESOLUTION = 4096
+# The probe resolution of the estimate and the relative precision of the resolution search.
+ESTIMATE_RESOLUTION = 64
+SEARCH_PRECISION = 0.05
+# The quads of a box from its corners (the corner index bits are the (x, y, z) max flags) and their normals.
+BOX_QUADS = ((0, 1, 3, 2), (4, 6, 7, 5), (0, 4, 5, 1), (2, 3, 7, 6), (0, 2, 6, 4), (1, 5, 7, 3))
+BOX_NORMALS = ((-1, 0, 0), (1, 0, 0), (0, -1, 0), (0, 1, 0), (0, 0, -1), (0, 0, 1))
+
+log = logging.getLogger('archilogic')
+
+
+def _weld(positions):
+    """ Weld the triangle soup to its distinct vertex positions.
+        Args:
+            positions ('ndarray') - The (n, 3) loop ordered positions.
+        Returns:
+            vertices ('ndarray') - The (m, 3) distinct positions.
+            loop_vertices ('ndarray') - The (n, ) vertex index of each loop.
+    """
+    positions = np.ascontiguousarray(positions, dtype=np.float32)
+    # One 12 byte key per position, a 1d unique is much cheaper than unique(axis=0)
+    keys = positions.view(np.dtype((np.void, positions.dtype.itemsize * 3))).reshape(-1)
+    _, first, loop_vertices = np.unique(keys, return_index=True, return_inverse=True)
+    return positions[first], loop_vertices.reshape(-1)
+
+
+def _cluster_ids(vertices, bb_min, extent, resolution):
+    """ Assign the vertices to the cells of a uniform grid over the bounding box.
+        Args:
+            vertices ('ndarray') - The (m, 3) vertex positions.
+            bb_min ('ndarray') - The minimum of the bounding box.
+            extent ('float') - The longest bounding box axis.
+            resolution ('int') - The number of cells along the longest bounding box axis.
+        Returns:
+            cluster_ids ('ndarray') - The (m, ) cluster id of each vertex.
+    """
+    cell_size = extent / resolution if extent > 0.0 else 1.0
+    cells = np.floor((vertices - bb_min) / cell_size).astype(np.int64)
+    np.clip(cells, 0, resolution - 1, out=cells)
+    # One int64 key per cell (resolution <= MAX_GRID_RESOLUTION, the key fits)
+    keys = cells[:, 0] + cells[:, 1] * resolution + cells[:, 2] * resolution * resolution
+    _, cluster_ids = np.unique(keys, return_inverse=True)
+    return cluster_ids.reshape(-1)
+
+
+def _surviving_triangles(cluster_ids):
+    """ Get the triangles that are neither degenerate nor duplicates after clustering.
+        Args:
+            cluster_ids ('ndarray') - The (n, ) cluster id of each loop of the triangle soup.
+        Returns:
+            _ ('ndarray') - The sorted indices of the surviving triangles.
+    """
+    tris = cluster_ids.reshape(-1, 3)
+    valid = (tris[:, 0] != tris[:, 1]) & (tris[:, 1] != tris[:, 2]) & (tris[:, 0] != tris[:, 2])
+    valid_idx = np.flatnonzero(valid)
+    if len(valid_idx) == 0:
+        return valid_idx
+    # Faces collapsing onto the same cells are kept once
+    corners = np.ascontiguousarray(np.sort(tris[valid_idx], axis=1), dtype=np.int64)
+    keys = corners.view(np.dtype((np.void, 24))).reshape(-1)
+    _, first = np.unique(keys, return_index=True)
+    return np.sort(valid_idx[first])
+
+
+def bounding_box_triangles(positions):
+    """ Get the triangles of the bounding box of a triangle soup, it stands in for a mesh that loses all its
+        triangles when it is decimated. The box has MIN_LOD_TRIANGLES triangles.
+        Args:
+            positions ('ndarray') - The (n, 3) loop ordered positions of the triangle soup.
+        Returns:
+            box_positions ('ndarray') - The (36, 3) loop ordered positions of the box.
+            box_normals ('ndarray') - The (36, 3) loop normals of the box.
+    """
+    bounds = np.stack([positions.min(axis=0), positions.max(axis=0)])
+    corners = np.array([[bounds[(i >> (2 - axis)) & 1, axis] for axis in range(3)] for i in range(8)], dtype=np.float32)
+    loops = [quad[i] for quad in BOX_QUADS for i in (0, 1, 2, 0, 2, 3)]
+    box_normals = np.repeat(np.array(BOX_NORMALS, dtype=np.float32), 6, axis=0)
+    return corners[loops], box_normals
+
+
+def decimate_triangles(positions, target_triangles):
+    """ Simplify a triangle soup by vertex clustering. The vertices are welded into the cells of a uniform grid,
+        the grid is refined (binary search) to the finest resolution that stays within the triangle budget.
+        The search starts around the resolution estimated from the budget and stops at a relative precision.
+        Args:
+            positions ('ndarray') - The (n, 3) loop ordered positions of the triangle soup.
+            target_triangles ('int') - The triangle budget.
+        Returns:
+            loop_indices ('ndarray') - The indices of the loops to keep (for normals and uvs), None if not decimated.
+                                       Empty if no triangle is left within the budget, see bounding_box_triangles.
+            new_positions ('ndarray') - The clustered positions of the kept loops, None if not decimated.
+    """
+    triangle_count = len(positions) // 3
+    target_triangles = max(int(target_triangles), MIN_LOD_TRIANGLES)
+    if triangle_count <= target_triangles:
+        return None, None
+
+    vertices, loop_vertices = _weld(positions)
+    bb_min = vertices.min(axis=0)
+    extent = float((vertices.max(axis=0) - bb_min).max())
+
+    cache = {}
+
+    def evaluate(resolution):
+        if resolution not in cache:
+            vertex_clusters = _cluster_ids(vertices, bb_min, extent, resolution)
+            cache[resolution] = (vertex_clusters, _surviving_triangles(vertex_clusters[loop_vertices]))
+        return cache[resolution]
+
+    # Surfaces keep about resolution^2 triangles, estimate the resolution from a probe
+    probe = min(ESTIMATE_RESOLUTION, MAX_GRID_RESOLUTION)
+    probe_count = max(len(evaluate(probe)[1]), 1)
+    estimate = int(probe * (target_triangles / probe_count) ** 0.5)
+    low = max(MIN_GRID_RESOLUTION, estimate // 2)
+    high = min(MAX_GRID_RESOLUTION, max(estimate * 2, low))
+    if len(evaluate(low)[1]) > target_triangles:
+        # The estimate is off, search the full range below
+        low, high = MIN_GRID_RESOLUTION, low - 1
+    elif len(evaluate(high)[1]) <= target_triangles:
+        # The estimate is off, search the full range above
+        low, high = high, MAX_GRID_RESOLUTION
+
+    best = None
+    while low <= high:
+        resolution = (low + high) // 2
+        kept = evaluate(resolution)[1]
+        if len(kept) <= target_triangles:
+            best = resolution
+            low = resolution + 1
+            # Close enough, a finer grid would not change the result noticeably
+            if high - low + 1 < resolution * SEARCH_PRECISION:
+                break
+        else:
+            high = resolution - 1
+    if best is None and len(evaluate(MIN_GRID_RESOLUTION)[1]) <= target_triangles:
+        best = MIN_GRID_RESOLUTION
+
+    if best is None or len(cache[best][1]) == 0:
+        # The mesh is never returned over budget
+        log.debug('Decimated %d -> 0 triangles', triangle_count)
+        return np.empty(0, dtype=np.int64), np.empty((0, 3), dtype=np.float32)
+
+    vertex_clusters, kept = cache[best]
+    # Cluster representative: the mean position of its vertices
+    cluster_count = vertex_clusters.max() + 1
+    counts = np.bincount(vertex_clusters, minlength=cluster_count).astype(np.float32)
+    centroids = np.stack([np.bincount(vertex_clusters, weights=vertices[:, axis], minlength=cluster_count)
+                          for axis in range(3)], axis=1) / counts[:, None]
+
+    loop_indices = (kept[:, None] * 3 + np.arange(3)).reshape(-1)
+    new_positions = centroids[vertex_clusters[loop_vertices[loop_indices]]].astype(np.float32)
+    log.debug('Decimated %d -> %d triangles', triangle_count, len(kept))
+    return loop_indices, new_positions
@@ -0,0 +1,461 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import tracemalloc
+import cProfile
+import pstats
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
+
+__all__ = ['PerfMetrics', 'Profiler', 'profile']
+
+REPORT_SUFFIX = 'metrics.json'
+PSTATS_SUFFIX = 'pstats'
+COLLAPSED_SUFFIX = 'collapsed.txt'
+SUMMARY_SUFFIX = 'profile.txt'
+
+# Frames of the add-on are labeled in the profiles, so the hot data3d functions stand out in the flamegraph.
+DATA3D_PACKAGE_DIR = os.path.dirname(os.path.realpath(__file__))
+DATA3D_LABEL = '[data3d] '
+
+log = logging.getLogger('archilogic')
+
+
+class PerfMetrics(object):
+    """
+        Attributes:
+            phases ('OrderedDict') - The accumulated seconds per pipeline phase.
+            nodes ('list(dict)') - The timings per data3d node.
+            meshes ('list(dict)') - The timings, triangle and vertex counts per mesh.
+            materials ('list(dict)') - The timings per material.
+            counters ('OrderedDict') - The accumulated totals (triangles, vertices, bytes decoded, ...).
+            trace_memory ('bool') - Record the peak memory with tracemalloc.
+            peak_memory ('int') - The traced peak memory in bytes, None if memory is not traced.
+    """
+
+    def __init__(self, trace_memory=False):
+        self.phases = OrderedDict()
+        self.nodes = []
+        self.meshes = []
+        self.materials = []
+        self.counters = OrderedDict()
+        self.trace_memory = trace_memory
+        self.peak_memory = None
+
+        self._t0 = None
+        self._total = 0.0
+        self._owns_trace = False
+
+    def start(self):
+        """ Start the total timer and the memory trace.
+        """
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._owns_trace = True
+        self._t0 = time.perf_counter()
+
+    def stop(self):
+        """ Stop the total timer and the memory trace.
+        """
+        if self._t0 is not None:
+            self._total += time.perf_counter() - self._t0
+            self._t0 = None
+        if self.trace_memory and tracemalloc.is_tracing():
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            if self._owns_trace:
+                tracemalloc.stop()
+                self._owns_trace = False
+
+    @contextmanager
+    def phase(self, name):
+        """ Time the enclosed block and accumulate it under the phase name.
+            Args:
+                name ('str') - The phase name.
+        """
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - t0
+
+    def iter_phase(self, name, steps):
+        """ Time the steps of the iterator and accumulate them under the phase name. The time in between
+            the steps (the other time slices of a modal job) is left out.
+            Args:
+                name ('str') - The phase name.
+                steps ('iterator') - The steps.
+            Yields:
+                _ ('object') - The values of the steps.
+        """
+        steps = iter(steps)
+        while True:
+            with self.phase(name):
+                try:
+                    value = next(steps)
+                except StopIteration:
+                    return
+            yield value
+
+    def count(self, key, value):
+        """ Add the value to the named counter.
+            Args:
+                key ('str') - The counter name.
+                value ('int') - The value to add.
+        """
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def add_node(self, node_id, seconds, mesh_count=0):
+        """ Record the timing of a data3d node.
+            Args:
+                node_id ('str') - The nodeId of the data3d object.
+                seconds ('float') - The time spent on the node.
+            Kwargs:
+                mesh_count ('int') - The number of meshes of the node.
+        """
+        self.nodes.append({'nodeId': node_id, 'seconds': seconds, 'meshes': mesh_count})
+
+    def add_mesh(self, name, seconds, triangles, vertices, node_id=None, material=None):
+        """ Record the timing and size of a mesh and update the triangle and vertex counters.
+            Args:
+                name ('str') - The mesh name.
+                seconds ('float') - The time spent on the mesh.
+                triangles ('int') - The triangle count.
+                vertices ('int') - The vertex count.
+            Kwargs:
+                node_id ('str') - The nodeId of the owning data3d object.
+                material ('str') - The material key of the mesh.
+        """
+        self.meshes.append({'name': name,
+                            'nodeId': node_id,
+                            'material': material,
+                            'seconds': seconds,
+                            'triangles': triangles,
+                            'vertices': vertices})
+        self.count('triangles', triangles)
+        self.count('vertices', vertices)
+
+    def add_material(self, name, seconds, reused=False):
+        """ Record the timing of a material.
+            Args:
+                name ('str') - The material name.
+                seconds ('float') - The time spent on the material.
+            Kwargs:
+                reused ('bool') - An existing material was reused.
+        """
+        self.materials.append({'name': name, 'seconds': seconds, 'reused': reused})
+
+    @property
+    def total(self):
+        if self._t0 is not None:
+            return self._total + time.perf_counter() - self._t0
+        return self._total
+
+    def to_dict(self, top=None):
+        """ Return the recorded metrics as a json serializable dictionary.
+            Kwargs:
+                top ('int') - Only keep the slowest n nodes, meshes and materials.
+            Returns:
+                report ('dict') - The metrics report.
+        """
+        nodes = sorted(self.nodes, key=lambda n: n['seconds'], reverse=True)
+        meshes = sorted(self.meshes, key=lambda m: m['seconds'], reverse=True)
+        materials = sorted(self.materials, key=lambda m: m['seconds'], reverse=True)
+        if top:
+            nodes = nodes[:top]
+            meshes = meshes[:top]
+            materials = materials[:top]
+
+        report = OrderedDict()
+        report['total'] = self.total
+        report['phases'] = OrderedDict(self.phases)
+        report['counters'] = OrderedDict(self.counters)
+        report['peakMemory'] = self.peak_memory
+        report['nodes'] = nodes
+        report['meshes'] = meshes
+        report['materials'] = materials
+        return report
+
+    def write_report(self, source_path):
+        """ Write the metrics report as json next to the source file.
+            Args:
+                source_path ('str') - The imported or exported data3d file.
+            Returns:
+                report_path ('str') - The path to the report, None if it could not be written.
+        """
+        report_path = get_report_path(source_path)
+        try:
+            with open(report_path, 'w', encoding='utf-8') as file:
+                json.dump(self.to_dict(), file, indent=2)
+        except OSError:
+            log.warning('Metrics report could not be written: %s', report_path)
+            return None
+        log.info('Metrics report: %s', report_path)
+        return report_path
+
+    def log_summary(self, title):
+        """ Log the phase totals, the slowest meshes and materials.
+            Args:
+                title ('str') - The headline of the summary.
+        """
+        lines = ['', 60*'#', '', title, '', '%.2f: Total' % self.total]
+        lines.extend('%.2f: %s' % (seconds, name) for name, seconds in self.phases.items())
+        lines.extend('%s: %s' % (value, key) for key, value in self.counters.items())
+        if self.peak_memory is not None:
+            lines.append('%.1f MB: Peak memory' % (self.peak_memory / 2**20))
+        for mesh in sorted(self.meshes, key=lambda m: m['seconds'], reverse=True)[:10]:
+            lines.append('%.3f: Mesh %s (%d triangles)' % (mesh['seconds'], mesh['name'], mesh['triangles']))
+        for material in sorted(self.materials, key=lambda m: m['seconds'], reverse=True)[:10]:
+            lines.append('%.3f: Material %s' % (material['seconds'], material['name']))
+        lines.extend(['', 60*'#', ''])
+        log.info('\n'.join(lines))
+
+
+def get_report_path(source_path):
+    """ Return the path of the metrics report for the data3d file.
+        Args:
+            source_path ('str') - The imported or exported data3d file.
+        Returns:
+            _ ('str') - The report path.
+    """
+    return '.'.join([os.path.normpath(source_path), REPORT_SUFFIX])
+
+
+class SamplingProfiler(object):
+    """
+        Attributes:
+            interval ('float') - The sampling interval in seconds.
+            stacks ('Counter') - The sample count per collapsed stack, the stacks start with the thread name.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+
+        self._thread_ids = set()
+        self._stop_event = threading.Event()
+        self._sampler = None
+
+    def add_thread(self, thread_id):
+        """ Sample the thread until it is removed.
+            Args:
+                thread_id ('int') - The thread identifier.
+        """
+        self._thread_ids = self._thread_ids | {thread_id}
+
+    def remove_thread(self, thread_id):
+        """ Stop sampling the thread.
+            Args:
+                thread_id ('int') - The thread identifier.
+        """
+        self._thread_ids = self._thread_ids - {thread_id}
+
+    def start(self):
+        """ Start the sampler thread, it samples the added threads.
+        """
+        self._stop_event.clear()
+        self._sampler = threading.Thread(target=self._run, name='data3d-sampler', daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        """ Stop sampling and wait for the sampler thread.
+        """
+        self._stop_event.set()
+        if self._sampler:
+            self._sampler.join()
+            self._sampler = None
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            # The set is replaced, never changed in place, so it can be read without a lock
+            thread_ids = self._thread_ids
+            if not thread_ids:
+                continue
+            frames = sys._current_frames()
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id in thread_ids:
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame.f_code.co_filename, frame.f_code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def write_collapsed(self, path):
+        """ Write the samples in the collapsed stack format of flamegraph.pl / speedscope.
+            Args:
+                path ('str') - The output path.
+        """
+        with open(path, 'w', encoding='utf-8') as file:
+            for stack, count in self.stacks.most_common():
+                file.write('%s %d\n' % (stack, count))
+
+
+def _frame_label(filename, function_name):
+    """ Return a readable frame label, add-on frames are prefixed with the data3d label.
+        Args:
+            filename ('str') - The source file of the frame.
+            function_name ('str') - The function name of the frame.
+        Returns:
+            _ ('str') - The frame label.
+    """
+    module = os.path.splitext(os.path.basename(filename))[0]
+    if os.path.realpath(filename).startswith(DATA3D_PACKAGE_DIR):
+        return DATA3D_LABEL + module + '.' + function_name
+    return module + '.' + function_name
+
+
+def _write_pstats_summary(stats, path, limit=40):
+    """ Write the hottest functions of the cProfile stats, data3d functions are labeled.
+        Args:
+            stats ('pstats.Stats') - The collected profile stats.
+            path ('str') - The output path.
+        Kwargs:
+            limit ('int') - The number of functions to list.
+    """
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write('%12s %12s %10s  %s\n' % ('cumtime', 'tottime', 'calls', 'function'))
+        for (filename, line, function_name), (_, calls, tottime, cumtime, _) in rows[:limit]:
+            label = _frame_label(filename, function_name)
+            file.write('%12.4f %12.4f %10d  %s:%d\n' % (cumtime, tottime, calls, label, line))
+
+
+def _write_pstats_collapsed(stats, path):
+    """ Write the cProfile call graph as caller;callee stacks, weighted in microseconds. cProfile keeps no call
+        paths, the self time of a function is written per caller edge. The output is linear in the call graph,
+        use SAMPLING for full stacks.
+        Args:
+            stats ('pstats.Stats') - The collected profile stats.
+            path ('str') - The output path.
+    """
+    stacks = Counter()
+    for func, (_, _, tottime, _, callers) in stats.stats.items():
+        label = _frame_label(func[0], func[2])
+        if not callers:
+            stacks[label] += int(tottime * 1e6)
+        for caller, edge in callers.items():
+            # The edge tottime is the self time of the function when called from this caller
+            weight = int(edge[2] * 1e6)
+            if weight:
+                stacks[_frame_label(caller[0], caller[2]) + ';' + label] += weight
+
+    with open(path, 'w', encoding='utf-8') as file:
+        for stack, weight in stacks.most_common():
+            file.write('%s %d\n' % (stack, weight))
+
+
+class Profiler(object):
+    """ Profile the blocks of a job on the threads that run them. Only the recorded blocks are profiled,
+        so a job that runs in time slices on the main thread and partly on worker threads is covered without
+        the unrelated code that runs between the slices.
+        CPROFILE writes <output_path>.pstats, a <output_path>.profile.txt summary of the hottest functions and
+        caller;callee stacks of the call graph.
+        SAMPLING writes sampled collapsed stacks.
+        The collapsed stacks (<output_path>.collapsed.txt) can be rendered by flamegraph.pl or speedscope.
+        Attributes:
+            mode ('str') - The profiler. Enum {'NONE', 'CPROFILE', 'SAMPLING'}
+            output_path ('str') - The data3d file the profiles are written next to.
+    """
+
+    def __init__(self, mode, output_path):
+        self.mode = mode
+        self.output_path = output_path
+
+        self._lock = threading.Lock()
+        # The thread ids -> cProfile profiles, cProfile only hooks the thread that enables it
+        self._profiles = {}
+        self._recording = set()
+        self._sampler = None
+        self._closed = False
+        if mode == 'SAMPLING':
+            self._sampler = SamplingProfiler()
+            self._sampler.start()
+
+    @contextmanager
+    def record(self):
+        """ Profile the enclosed block on the calling thread.
+        """
+        thread_id = threading.get_ident()
+        with self._lock:
+            recording = not self._closed and self.mode in ('CPROFILE', 'SAMPLING')
+            if recording:
+                self._recording.add(thread_id)
+                if self.mode == 'CPROFILE':
+                    profiler = self._profiles.setdefault(thread_id, cProfile.Profile())
+        if not recording:
+            yield
+            return
+
+        try:
+            if self.mode == 'CPROFILE':
+                try:
+                    profiler.enable()
+                except ValueError:
+                    # Newer Pythons allow one active cProfile per interpreter, the block is not profiled then
+                    log.debug('cProfile is active on another thread')
+                    profiler = None
+                try:
+                    yield
+                finally:
+                    if profiler is not None:
+                        profiler.disable()
+            else:
+                self._sampler.add_thread(thread_id)
+                try:
+                    yield
+                finally:
+                    self._sampler.remove_thread(thread_id)
+        finally:
+            with self._lock:
+                self._recording.discard(thread_id)
+
+    def close(self):
+        """ Stop profiling and write the profiles. Threads that are still recording are left out.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            profiles = [profiler for thread_id, profiler in self._profiles.items() if thread_id not in self._recording]
+
+        if self.mode == 'CPROFILE' and profiles:
+            pstats_path = '.'.join([self.output_path, PSTATS_SUFFIX])
+            try:
+                stats = pstats.Stats(*profiles)
+                stats.dump_stats(pstats_path)
+                _write_pstats_summary(stats, '.'.join([self.output_path, SUMMARY_SUFFIX]))
+                _write_pstats_collapsed(stats, '.'.join([self.output_path, COLLAPSED_SUFFIX]))
+                log.info('Profile written: %s', pstats_path)
+            except OSError:
+                log.warning('Profile could not be written: %s', pstats_path)
+
+        elif self.mode == 'SAMPLING':
+            self._sampler.stop()
+            collapsed_path = '.'.join([self.output_path, COLLAPSED_SUFFIX])
+            try:
+                self._sampler.write_collapsed(collapsed_path)
+                log.info('Profile written: %s', collapsed_path)
+            except OSError:
+                log.warning('Profile could not be written: %s', collapsed_path)
+
+
+@contextmanager
+def profile(mode, output_path):
+    """ Profile the enclosed block on the calling thread and write the results next to the output path,
+        see Profiler.
+        Args:
+            mode ('str') - The profiler. Enum {'NONE', 'CPROFILE', 'SAMPLING'}
+            output_path ('str') - The data3d file the profiles are written next to.
+    """
+    profiler = Profiler(mode, output_path)
+    try:
+        with profiler.record():
+            yield
+    finally:
+        profiler.close()
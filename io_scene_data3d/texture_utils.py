@@ -0,0 +1,403 @@
+import os
+import json
+import zlib
+import struct
+import hashlib
+import shutil
+import logging
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+__all__ = ['TextureIndex', 'get_texture_index', 'probe_image', 'probe_images', 'export_textures']
+
+INDEX_FILE_PREFIX = 'data3d-texture-index-'
+INDEX_VERSION = 1
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_END = b'IEND\xaeB`\x82'
+JPEG_SOI = b'\xff\xd8'
+JPEG_EOI = b'\xff\xd9'
+# Start of frame markers, they carry the image dimensions (excluding DHT, JPG and DAC)
+JPEG_SOF_MARKERS = set(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+# The block size for hashing the texture files.
+HASH_BLOCK_SIZE = 2**20
+
+log = logging.getLogger('archilogic')
+
+# Session registry of the texture indices, the key is the normalized working directory.
+_texture_indices = {}
+
+
+class TextureIndex(object):
+    """ The index is loaded (or scanned) on the first lookup that misses the relative path.
+        Attributes:
+            root ('str') - The indexed directory.
+            paths ('dict') - The lower case relative paths -> relative paths of all files below root.
+            basenames ('dict') - The lower case file names -> relative paths (first found).
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.paths = {}
+        self.basenames = {}
+
+        self._loaded = False
+        self._can_rescan = True
+
+    def scan(self):
+        """ Walk the directory tree once and index all files by relative path and file name.
+        """
+        relpaths = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                relpaths.append(os.path.relpath(os.path.join(dirpath, filename), self.root).replace(os.sep, '/'))
+        self._build(relpaths)
+        self._loaded = True
+        self._can_rescan = False
+        log.debug('Indexed %s files in %s', len(self.paths), self.root)
+
+    def _build(self, relpaths):
+        self.paths = {}
+        self.basenames = {}
+        # Deterministic lookup of duplicate file names: the shallowest, alphabetically first path wins
+        for relpath in sorted(relpaths, key=lambda p: (p.count('/'), p)):
+            self.paths[relpath.lower()] = relpath
+            self.basenames.setdefault(relpath.rsplit('/', 1)[-1].lower(), relpath)
+
+    def allow_rescan(self):
+        """ Allow one more rescan on a missing or stale lookup. Called once per import.
+        """
+        self._can_rescan = True
+
+    def resolve(self, image_relpath):
+        """ Resolve the image path by relative path, fall back to the file name anywhere below root.
+            Args:
+                image_relpath ('str') - The relative path to the image.
+            Returns:
+                _ ('str') - The absolute path to the image, None if not found.
+        """
+        # The file at the relative path wins over the index, which may be outdated
+        path = os.path.join(self.root, os.path.normpath(image_relpath.strip('/')))
+        if os.path.isfile(path):
+            return path
+
+        if not self._loaded:
+            if not self.load():
+                self.scan()
+                self.save()
+        path = self._lookup(image_relpath)
+        if path is None or not os.path.isfile(path):
+            # The index is outdated, rescan at most once per import
+            if not self._can_rescan:
+                return None
+            self.scan()
+            self.save()
+            path = self._lookup(image_relpath)
+        return path
+
+    def _lookup(self, image_relpath):
+        key = os.path.normpath(image_relpath.strip('/')).replace(os.sep, '/').lower()
+        relpath = self.paths.get(key) or self.basenames.get(os.path.basename(key))
+        return os.path.join(self.root, relpath) if relpath else None
+
+    @property
+    def cache_path(self):
+        root_hash = hashlib.sha1(self.root.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(tempfile.gettempdir(), INDEX_FILE_PREFIX + root_hash + '.json')
+
+    def save(self):
+        """ Persist the index, so later sessions can skip the directory walk.
+        """
+        try:
+            with open(self.cache_path, 'w', encoding='utf-8') as file:
+                json.dump({'version': INDEX_VERSION, 'root': self.root, 'paths': list(self.paths.values())}, file)
+        except OSError:
+            log.debug('Texture index could not be saved: %s', self.cache_path)
+
+    def load(self):
+        """ Load the persisted index.
+            Returns:
+                _ ('bool') - True if the index was loaded.
+        """
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return False
+        if data.get('version') != INDEX_VERSION or data.get('root') != self.root:
+            return False
+
+        self._build(data['paths'])
+        self._loaded = True
+        return True
+
+
+def get_texture_index(working_dir, new_import=False):
+    """ Get the texture index of the directory, it is loaded or scanned on the first lookup that needs it.
+        Args:
+            working_dir ('str') - The source directory of the data3d file.
+        Kwargs:
+            new_import ('bool') - A new import starts, allow one rescan if the index turns out to be outdated.
+        Returns:
+            index ('TextureIndex') - The texture index.
+    """
+    root = os.path.normpath(os.path.abspath(working_dir))
+    index = _texture_indices.get(root)
+    if index is None:
+        index = TextureIndex(root)
+        _texture_indices[root] = index
+    elif new_import:
+        index.allow_rescan()
+    return index
+
+
+def _read_jpeg_frame(file):
+    """ Walk the marker segments up to the start of frame, the segments (EXIF, ICC profiles, ...) are skipped by
+        seeking, only the segment headers are read.
+        Args:
+            file ('file') - The JPEG file, opened in binary mode.
+        Returns:
+            error, size ('str', 'tuple') - The error (None if valid) and the (height, width), None if not found.
+    """
+    file.seek(2)
+    while True:
+        marker_bytes = file.read(2)
+        if len(marker_bytes) < 2:
+            return None, None
+        if marker_bytes[0] != 0xff:
+            return 'corrupt JPEG marker', None
+        marker = marker_bytes[1]
+        if marker == 0xff:
+            # Fill byte, the marker follows
+            file.seek(-1, os.SEEK_CUR)
+            continue
+        segment_header = file.read(2)
+        if len(segment_header) < 2:
+            return None, None
+        segment_length = struct.unpack('>H', segment_header)[0]
+        if marker in JPEG_SOF_MARKERS:
+            frame = file.read(5)
+            if len(frame) < 5:
+                return None, None
+            return None, struct.unpack('>HH', frame[1:5])
+        file.seek(segment_length - 2, os.SEEK_CUR)
+
+
+def probe_image(path):
+    """ Read and verify the image header without decoding the pixels. PNG and JPEG are checked for a valid
+        header, dimensions and a complete file, other formats only for being readable and not empty.
+        Args:
+            path ('str') - The absolute path to the image.
+        Returns:
+            info ('dict') - The image format, width, height and the error, None if the image is valid.
+    """
+    info = {'path': path, 'format': os.path.splitext(path)[1].lstrip('.').upper(), 'width': 0, 'height': 0, 'error': None}
+    try:
+        size = os.path.getsize(path)
+        with open(path, 'rb') as file:
+            head = file.read(64 * 1024)
+            file.seek(max(0, size - 16))
+            tail = file.read()
+    except OSError as error:
+        info['error'] = str(error)
+        return info
+
+    if size == 0:
+        info['error'] = 'empty file'
+
+    elif head.startswith(PNG_SIGNATURE):
+        info['format'] = 'PNG'
+        ihdr = head[8:33]
+        if len(ihdr) < 25 or ihdr[4:8] != b'IHDR':
+            info['error'] = 'missing PNG header'
+        elif zlib.crc32(ihdr[4:21]) != struct.unpack('>I', ihdr[21:25])[0]:
+            info['error'] = 'corrupt PNG header'
+        else:
+            info['width'], info['height'] = struct.unpack('>II', ihdr[8:16])
+            if not tail.endswith(PNG_END):
+                info['error'] = 'truncated PNG file'
+
+    elif head.startswith(JPEG_SOI):
+        info['format'] = 'JPEG'
+        try:
+            with open(path, 'rb') as file:
+                info['error'], size = _read_jpeg_frame(file)
+        except OSError as error:
+            info['error'], size = str(error), None
+        if size:
+            info['height'], info['width'] = size
+        if not info['error'] and not info['width']:
+            info['error'] = 'missing JPEG frame header'
+        elif not info['error'] and JPEG_EOI not in tail:
+            info['error'] = 'truncated JPEG file'
+
+    elif info['format'] in ('PNG', 'JPG', 'JPEG'):
+        info['error'] = 'unknown file signature'
+
+    return info
+
+
+def probe_images(paths, max_workers=8):
+    """ Probe the images concurrently.
+        Args:
+            paths ('iterable(str)') - The absolute image paths.
+        Kwargs:
+            max_workers ('int') - The number of reading threads.
+        Returns:
+            _ ('dict') - The absolute paths -> image info.
+    """
+    paths = list(paths)
+    if not paths:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(paths))) as executor:
+        return dict(zip(paths, executor.map(probe_image, paths)))
+
+
+def file_hash(path):
+    """ Hash the file content with BLAKE2, the file is read in blocks.
+        Args:
+            path ('str') - The file path.
+        Returns:
+            _ ('str') - The hex digest.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _is_unchanged(source, dest, source_stat, compare_content=True):
+    """ Check if the destination holds the source file already: the same file (hard link), the same size and
+        modification time (copies keep the time) or, with compare_content, the same content.
+    """
+    try:
+        dest_stat = os.stat(dest)
+    except OSError:
+        return False
+    if os.path.samestat(source_stat, dest_stat):
+        return True
+    if dest_stat.st_size != source_stat.st_size:
+        return False
+    if int(dest_stat.st_mtime) == int(source_stat.st_mtime):
+        return True
+    if not compare_content:
+        return False
+    if file_hash(dest) == file_hash(source):
+        # Align the time, the next export skips the hashing
+        os.utime(dest, (dest_stat.st_atime, source_stat.st_mtime))
+        return True
+    return False
+
+
+def _place_file(source, dest, use_hard_links):
+    """ Hard link or copy the source to the destination, the destination is replaced atomically.
+        Returns:
+            _ ('str') - 'linked' or 'copied'.
+    """
+    temp_path = '%s.%d.tmp' % (dest, os.getpid())
+    try:
+        if use_hard_links:
+            try:
+                os.link(source, temp_path)
+                os.replace(temp_path, dest)
+                return 'linked'
+            except OSError:
+                # Other file system or no link support
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+        shutil.copy2(source, temp_path)
+        os.replace(temp_path, dest)
+        return 'copied'
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _export_texture(source, dests, use_hard_links):
+    """ Export the source file to its destinations, the first destination is the source of the others.
+        Returns:
+            results ('list(str)') - 'skipped', 'linked', 'copied' or 'failed' per destination.
+    """
+    results = []
+    try:
+        source_stat = os.stat(source)
+        for dest in dests:
+            if _is_unchanged(source, dest, source_stat):
+                results.append('skipped')
+            else:
+                results.append(_place_file(source, dest, use_hard_links))
+            # The identical content is linked from the exported file
+            source, source_stat = dest, os.stat(dest)
+    except OSError as error:
+        log.warning('Texture could not be exported: %s (%s)', source, error)
+        results.extend(['failed'] * (len(dests) - len(results)))
+    return results
+
+
+def export_textures(paths, dest_dir, use_hard_links=True, max_workers=8):
+    """ Export the texture files to the directory. Files that are unchanged at the destination are skipped, the
+        others are hard linked (if possible) or copied concurrently. Sources with identical content are read once.
+        Args:
+            paths ('iterable(str)') - The absolute texture paths, the files keep their names.
+            dest_dir ('str') - The texture export directory.
+        Kwargs:
+            use_hard_links ('bool') - Hard link the files instead of copying them, where the file system allows.
+            max_workers ('int') - The number of copying threads.
+        Returns:
+            stats ('dict') - The number of skipped, linked, copied and failed files.
+    """
+    stats = {'skipped': 0, 'linked': 0, 'copied': 0, 'failed': 0}
+    # Distinct files, the destination name is the file name
+    sources = OrderedDict()
+    for path in paths:
+        path = os.path.realpath(path)
+        dest = os.path.join(dest_dir, os.path.basename(path))
+        if dest in sources.values():
+            if path not in sources:
+                log.warning('Texture file name used more than once, not exported: %s', path)
+            continue
+        sources[path] = dest
+    if not sources:
+        return stats
+    os.makedirs(dest_dir, exist_ok=True)
+
+    # Skip the unchanged destinations by their stat first, nothing is read for them
+    source_stats = {}
+    for path in list(sources):
+        try:
+            source_stats[path] = os.stat(path)
+        except OSError as error:
+            log.warning('Texture could not be exported: %s (%s)', path, error)
+            stats['failed'] += 1
+            del sources[path]
+            continue
+        if _is_unchanged(path, sources[path], source_stats[path], compare_content=False):
+            stats['skipped'] += 1
+            del sources[path]
+    if not sources:
+        log.debug('Exported textures: %s', stats)
+        return stats
+
+    # Identical content is only hashed for the files to place of the same size
+    by_size = {}
+    for path in sources:
+        by_size.setdefault(source_stats[path].st_size, []).append(path)
+    jobs = OrderedDict()
+    for size_paths in by_size.values():
+        by_hash = OrderedDict()
+        for path in size_paths:
+            by_hash.setdefault(file_hash(path) if len(size_paths) > 1 else path, []).append(path)
+        for same_paths in by_hash.values():
+            jobs[same_paths[0]] = [sources[path] for path in same_paths]
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs))) as executor:
+        futures = [executor.submit(_export_texture, source, dests, use_hard_links) for source, dests in jobs.items()]
+        for future in futures:
+            for result in future.result():
+                stats[result] += 1
+
+    log.debug('Exported textures: %s', stats)
+    return stats